@@ -19,8 +19,48 @@ import sys
 import argparse
 import json
 import pandas as pd
+import numpy as np
 import os
 
+def hash_protein_ids(protein_ids):
+    """
+    Stable 64-bit hashes of protein IDs, which key the binary protein map.
+    """
+    return pd.util.hash_array(np.asarray(protein_ids, dtype=object), categorize=False)
+
+def protein_index_paths(protein_json):
+    """
+    The files of the binary protein map that accompanies a JSON protein map.
+    """
+    stub = os.path.splitext(protein_json)[0]
+    return stub + ".keys.npy", stub + ".taxa.npy", stub + ".source_ids.txt"
+
+def write_protein_index(odict, protein_json):
+    """
+    Write the protein map as a sorted array of hashed protein IDs, the source ID index of
+    each of those proteins, and the list of source IDs, so that it can be memory-mapped
+    and searched rather than loaded whole. Returns 1 and writes nothing if two protein IDs
+    share a hash, in which case only the JSON protein map is used.
+    """
+    keys = hash_protein_ids(list(odict.keys()))
+    taxa, source_ids = pd.factorize(pd.Series(list(odict.values()), dtype=object).astype(str))
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    taxa = taxa[order].astype(np.int32)
+    if (np.diff(keys) == 0).any():
+        print("Protein IDs with identical hashes found; only the JSON protein map will be written.")
+        return 1
+    
+    keys_file, taxa_file, source_ids_file = protein_index_paths(protein_json)
+    for outfile, array in [(keys_file, keys), (taxa_file, taxa)]:
+        with open(outfile + ".tmp", 'wb') as f:
+            np.save(f, array)
+        os.replace(outfile + ".tmp", outfile)
+    with open(source_ids_file + ".tmp", 'w') as f:
+        f.write("".join([curr + "\n" for curr in source_ids]))
+    os.replace(source_ids_file + ".tmp", source_ids_file)
+    return 0
+
 def createProteinTable(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--infile_peptide', type = list, nargs='+', required=True) # this should be given as a list of the input files
@@ -108,6 +148,7 @@ def createProteinTable(args=None):
     tax_file.to_csv(args.output,sep="\t")
     with open(args.outfile_json, 'w') as f:
         json.dump(odict, f)
+    write_protein_index(odict, args.outfile_json)
         
     return 0
         
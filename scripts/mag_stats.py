@@ -65,8 +65,14 @@ def magStats(args=None):
         args = parser.parse_args()
     os.system("mkdir -p " + args.max_out_dir)
     os.system("mkdir -p " + args.outdir)
-    estimated_tax = pd.read_csv(args.estimated_taxonomy_file, sep='\t', index_col=0)
-    split_taxonomy_df = split_taxonomy(estimated_tax)
+    # imported here; EUKulele itself imports this script when it is loaded
+    from EUKulele.tax_placement import read_estimated_taxonomy
+    estimated_tax = read_estimated_taxonomy(args.estimated_taxonomy_file)
+    if set(levels).issubset(estimated_tax.columns):
+        # columnar output already carries the lineage split by level
+        split_taxonomy_df = estimated_tax.astype({l: object for l in levels})
+    else:
+        split_taxonomy_df = split_taxonomy(estimated_tax)
     tax_dict = create_tax_dictionary(split_taxonomy_df)
     max_df = get_max_levels(tax_dict)
     if not os.path.exists(args.outdir):
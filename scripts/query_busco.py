@@ -12,9 +12,7 @@ import numpy as np
 import os
 import sys
 import argparse
-import chardet
 import glob
-import multiprocessing
 from joblib import Parallel, delayed
 
 __author__ = "Arianna Krinos, Harriet Alexander"
@@ -24,6 +22,15 @@ __email__ = "akrinos@mit.edu"
 
 level_hierarchy = ['supergroup','division','class','order','family','genus','species']
 
+def read_taxonomy_counts(taxonomy_file_prefix, level):
+    """
+    Read the taxonomy counts of one level, which may have been written compressed.
+    """
+    from EUKulele.compression import find_compressed, open_compressed
+    
+    with open_compressed(find_compressed(taxonomy_file_prefix + "_all_" + str(level) + "_counts.csv")) as counts:
+        return pd.read_csv(counts, sep=",", header=0)
+
 def evaluate_organism(organism, taxonomy, tax_table, create_fasta, write_transcript_file, busco_out, 
                       taxonomy_file_prefix, busco_threshold, output_dir, sample_name, fasta_file):
     organism_format = organism
@@ -82,9 +89,7 @@ def evaluate_organism(organism, taxonomy, tax_table, create_fasta, write_transcr
             continue
 
         #### CREATE A "MOCK TRANSCRIPTOME" BY PULLING BY TAXONOMIC LEVEL ####
-        taxonomy_file = pd.read_csv(taxonomy_file_prefix + "_all_" + 
-                                    str(level_hierarchy[curr_level]) + 
-                                    "_counts.csv", sep=",",header=0)
+        taxonomy_file = read_taxonomy_counts(taxonomy_file_prefix, level_hierarchy[curr_level])
         taxonomy_file = taxonomy_file.loc[[tax in curr_taxonomy for tax in list(taxonomy_file[level_hierarchy[curr_level].capitalize()])],:]
         transcripts_to_search = list(taxonomy_file["GroupedTranscripts"])
         transcripts_to_search_sep = []
@@ -157,22 +162,10 @@ def evaluate_organism(organism, taxonomy, tax_table, create_fasta, write_transcr
                          "CtThreeCopies":number_tripled,"CtFourCopies":number_quadrupled,"CtFivePlusCopies":number_higher_mult,
                          "PercentageDuplicated":percent_multiples})
 
-def read_in_taxonomy(infile):
-    with open(infile, 'rb') as f:
-        result = chardet.detect(f.read())
-    tax_out = pd.read_csv(infile, sep='\t',encoding=result['encoding'])
-    classes = ['supergroup','division','class','order','family','genus','species']
-    for c in tax_out.columns:
-        if c.lower() in classes:
-            if (np.issubdtype(tax_out[str(c)].dtypes, np.number)) | (np.issubdtype(tax_out[str(c)].dtypes, np.float_)):
-                tax_out = tax_out.loc[:,~(tax_out.columns == c)]
-    tax_out.columns = tax_out.columns.str.lower()
-    tax_out = tax_out.set_index('source_id')
-    return tax_out
-
-def queryBusco(args=None):
+def queryBusco(args=None, tax_table=None):
     """
     Search through individual BUSCO outputs to find number of matches for each organism/taxonomic level.
+    A taxonomy table already read in by the caller can be passed as tax_table to skip re-reading it.
     """
     
     parser = argparse.ArgumentParser()
@@ -199,7 +192,7 @@ def queryBusco(args=None):
     parser.add_argument('--busco_location',default="busco",
                         help = "Location to store the BUSCO tar reference.")
     parser.add_argument('--output_dir',default="output")
-    parser.add_argument('--available_cpus',default=1)
+    parser.add_argument('--available_cpus',default=None,type=int)
     parser.add_argument('--busco_threshold',default=50)
     parser.add_argument('--write_transcript_file', default=False, action='store_true',
                        help = "Whether to write an actual file with the subsetted transcriptome.")
@@ -211,7 +204,13 @@ def queryBusco(args=None):
         
     organism = args.organism_group 
     taxonomy = args.taxonomic_level
-    tax_table = read_in_taxonomy(args.tax_table)
+    if tax_table is None:
+        # imported here; EUKulele itself imports this script when it is loaded
+        from EUKulele.tax_placement import read_in_taxonomy
+        tax_table = read_in_taxonomy(args.tax_table)
+    if args.available_cpus is None:
+        from EUKulele.resources import available_cpus
+        args.available_cpus = available_cpus()
 
     if (args.individual_or_summary == "individual") & ((len(args.organism_group) == 0) | (len(args.taxonomic_level) == 0)):
         print("You specified individual mode, but then did not provide a taxonomic group and/or accompanying taxonomic level.",
@@ -224,7 +223,7 @@ def queryBusco(args=None):
         sys.exit(1)
 
     if (args.individual_or_summary == "individual"):
-        results_frame = Parallel(n_jobs=multiprocessing.cpu_count())(delayed(evaluate_organism)(organism[curr], 
+        results_frame = Parallel(n_jobs=args.available_cpus)(delayed(evaluate_organism)(organism[curr], 
                                                                                                 taxonomy[curr], tax_table,
                                                                                                 args.create_fasta, 
                                                                                                 args.write_transcript_file, 
@@ -243,12 +242,11 @@ def queryBusco(args=None):
                                                         args.sample_name + ".tsv"), sep = "\t")
     else:
         for taxonomy in level_hierarchy:
-            taxonomy_file = pd.read_csv(args.taxonomy_file_prefix + "_all_" + str(taxonomy) + 
-                                        "_counts.csv", sep=",",header=0)
+            taxonomy_file = read_taxonomy_counts(args.taxonomy_file_prefix, taxonomy)
             if len(taxonomy_file.index) > 0:
-                curr_frame = taxonomy_file.nlargest(multiprocessing.cpu_count(), 'NumTranscripts')
+                curr_frame = taxonomy_file.nlargest(args.available_cpus, 'NumTranscripts')
                 organisms = list(set(list(curr_frame[taxonomy.capitalize()])))
-                results_frame = Parallel(n_jobs=multiprocessing.cpu_count())(delayed(evaluate_organism)(organism, taxonomy, tax_table, args.create_fasta, args.write_transcript_file, args.busco_out, args.taxonomy_file_prefix, args.busco_threshold, 
+                results_frame = Parallel(n_jobs=args.available_cpus)(delayed(evaluate_organism)(organism, taxonomy, tax_table, args.create_fasta, args.write_transcript_file, args.busco_out, args.taxonomy_file_prefix, args.busco_threshold, 
                                                                                                         args.output_dir, 
                                                                                                         args.sample_name, 
                                                                                                         args.fasta_file) \
@@ -93,12 +93,30 @@ def parseConfig(config_file):
     ## ALIGNMENT AND BUSCO OPTIONS ##
     if "alignment_choice" in config: 
         args = args + " --alignment_choice " + str(config["alignment_choice"])
+    if "stream_alignment" in config:
+        if config["stream_alignment"] == 1:
+            args = args + " --stream_alignment"
+    if "keep_alignment_hits" in config:
+        if config["keep_alignment_hits"] == 1:
+            args = args + " --keep_alignment_hits"
+    if "batch_alignment" in config:
+        if config["batch_alignment"] == 1:
+            args = args + " --batch_alignment"
+    if "shard_alignment" in config:
+        if config["shard_alignment"] == 1:
+            args = args + " --shard_alignment"
+    if "database_cache" in config:
+        args = args + " --database_cache " + str(config["database_cache"])
     if "cutoff" in config:    
         args = args + " --cutoff_file " + config["cutoff"]
     if "filter_metric" in config:
         args = args + " --filter_metric " + config["filter_metric"]
     if "consensus_cutoff" in config:
         args = args + " --consensus_cutoff " + str(config["consensus_cutoff"])
+    if "output_format" in config:
+        args = args + " --output_format " + str(config["output_format"])
+    if "compression" in config:
+        args = args + " --compression " + str(config["compression"])
     if "busco_file" in config:
         args = args + " --busco_file " + str(config["busco_file"])
     if "individual_or_summary" in config:
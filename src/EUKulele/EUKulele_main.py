@@ -9,7 +9,6 @@ import sys
 import yaml
 import chardet
 import argparse
-import multiprocessing
 import subprocess
 import shutil
 import glob
@@ -23,6 +22,8 @@ from EUKulele.manage_steps import manageEukulele
 from EUKulele.busco_runner import readBuscoFile
 from EUKulele.busco_runner import configRunBusco
 from EUKulele.busco_runner import manageBuscoQuery
+from EUKulele.tax_placement import ReferenceContext
+from EUKulele.resources import available_cpus, configure_pool
 
 import scripts as HelperScripts
 from scripts.names_to_reads import namesToReads
@@ -49,8 +50,10 @@ def main(args_in):
     parser.add_argument('--n_ext', '--nucleotide_extension', dest = "nucleotide_extension", default = ".fasta") 
     parser.add_argument('--p_ext', '--protein_extension', dest = "protein_extension", default = ".faa") 
     parser.add_argument('-f', '--force_rerun', action='store_true', default=False)
-    parser.add_argument('--scratch', default = '../scratch', 
-                        help = "The scratch location to store intermediate files.")
+    parser.add_argument('--scratch', default = '', 
+                        help = "The scratch location to store intermediate files, such as the working " + 
+                        "directory of each TransDecoder job; fast local storage is best. Defaults to the " + 
+                        "scratch folder of the output directory.")
     parser.add_argument('--config_file', default = '')
     parser.add_argument('--perc_mem', dest = "perc_mem", default = 0.75,
                         help = "The percentage of the total available memory which should be targeted for use by processes.")
@@ -83,6 +86,20 @@ def main(args_in):
     
     ## ALIGNMENT OPTIONS ##
     parser.add_argument('--alignment_choice', default = "diamond", choices = ["diamond", "blast"])
+    parser.add_argument('--stream_alignment', action='store_true', default=False,
+                        help = "Classify DIAMOND hits as they are produced, instead of writing the " + 
+                        "alignment file and reading it back.")
+    parser.add_argument('--keep_alignment_hits', action='store_true', default=False,
+                        help = "With --stream_alignment, also keep a gzip-compressed copy of the raw hits.")
+    parser.add_argument('--batch_alignment', action='store_true', default=False,
+                        help = "Align many samples with each DIAMOND run, which is faster for large numbers " + 
+                        "of small samples (such as MAGs).")
+    parser.add_argument('--shard_alignment', action='store_true', default=False,
+                        help = "Split very large samples into pieces that are aligned by DIAMOND side by side.")
+    parser.add_argument('--database_cache', default = "", type = str,
+                        help = "A directory where DIAMOND and BLAST databases are built and shared between " + 
+                        "projects. Defaults to $EUKULELE_DATABASE_CACHE; if neither is set, databases are " + 
+                        "built in the reference directory.")
 
     ## OPTIONS FOR CHECKING BUSCO COMPLETENESS FOR TAXONOMY ##
     parser.add_argument('--busco_file', default = "", type = str, 
@@ -101,9 +118,16 @@ def main(args_in):
     parser.add_argument('--cutoff_file', default = cutoff_file)
     parser.add_argument('--filter_metric', default = "evalue", choices = ["pid", "evalue", "bitscore"])
     parser.add_argument('--consensus_cutoff', default = 0.75, type = float)
+    parser.add_argument('--output_format', default = "tsv", choices = ["tsv", "parquet", "both"],
+                        help = "The format of the per-sample estimated taxonomy files. Parquet output " + 
+                        "requires pyarrow.")
+    parser.add_argument('--compression', default = "none", choices = ["none", "gzip", "zstd"],
+                        help = "Compression of the intermediate and output files written by EUKulele. " + 
+                        "pigz and zstd are used for multi-threaded compression when they are installed.")
     parser.add_argument('--transdecoder_orfsize', default = 100, type = int)
 
-    parser.add_argument('--CPUs', default=multiprocessing.cpu_count())
+    parser.add_argument('--CPUs', default=available_cpus(), type = int,
+                        help = "The number of CPUs shared by all of the jobs that EUKulele runs at once.")
     parser.add_argument('--busco_threshold', default=50)
     parser.add_argument('--create_fasta', action='store_true', default=False, 
                        help = "Whether to create FASTA files containing ID'd transcripts during BUSCO analysis.")
@@ -154,13 +178,45 @@ def main(args_in):
     USE_SALMON_COUNTS = args.use_salmon_counts
     SALMON_DIR = args.salmon_dir
     NAMES_TO_READS = os.path.join(REFERENCE_DIR, str(args.names_to_reads))
-    CPUS = args.CPUs                         
+    CPUS = args.CPUs
+    ## Every job reserves its CPUs and memory from one pool, so that the jobs never oversubscribe the machine ##
+    configure_pool(CPUS, PERC_MEM)
 
     ORGANISMS = args.organisms 
     ORGANISMS_TAXONOMY = args.taxonomy_organisms
     BUSCO_FILE = args.busco_file
     RERUN_RULES = args.force_rerun
     RUN_TRANSDECODER = args.run_transdecoder
+    OUTPUT_FORMAT = args.output_format
+    STREAM_ALIGNMENT = args.stream_alignment
+    BATCH_ALIGNMENT = args.batch_alignment
+    SHARD_ALIGNMENT = args.shard_alignment
+    COMPRESSION = args.compression
+    if (COMPRESSION == "zstd") & (shutil.which("zstd") is None):
+        try:
+            import zstandard
+        except ImportError:
+            print("zstd compression (--compression zstd) requires either the zstd program or the " + 
+                  "zstandard Python package, and neither is installed.")
+            sys.exit(1)
+    if STREAM_ALIGNMENT & (ALIGNMENT_CHOICE != "diamond"):
+        print("Streaming alignment (--stream_alignment) is only supported with DIAMOND; the " + 
+              ALIGNMENT_CHOICE + " alignment files will be written as usual.")
+        STREAM_ALIGNMENT = False
+    if BATCH_ALIGNMENT & (ALIGNMENT_CHOICE != "diamond"):
+        print("Batched alignment (--batch_alignment) is only supported with DIAMOND; the " + 
+              ALIGNMENT_CHOICE + " samples will be aligned one at a time.")
+        BATCH_ALIGNMENT = False
+    if SHARD_ALIGNMENT & (ALIGNMENT_CHOICE != "diamond"):
+        print("Sharded alignment (--shard_alignment) is only supported with DIAMOND; the " + 
+              ALIGNMENT_CHOICE + " samples will be aligned whole.")
+        SHARD_ALIGNMENT = False
+    if OUTPUT_FORMAT != "tsv":
+        try:
+            import pyarrow
+        except ImportError:
+            print("Parquet output (--output_format " + OUTPUT_FORMAT + ") requires pyarrow, which is not installed.")
+            sys.exit(1)
     
     ORGANISMS, ORGANISMS_TAXONOMY = readBuscoFile(individual_or_summary, BUSCO_FILE, 
                                                   ORGANISMS, ORGANISMS_TAXONOMY)
@@ -232,25 +288,23 @@ def main(args_in):
         else:
             print("Found database folder for " + REFERENCE_DIR + " in current directory; will not re-download.")
 
+        ## The taxonomy table and protein map are read at most once, and shared by every sample ##
+        REFERENCE = ReferenceContext(TAX_TAB, PROT_TAB)
+
     if SETUP:
         print("Creating a",ALIGNMENT_CHOICE,"reference from database files...")
         manageEukulele(piece = "setup_databases", ref_fasta = REF_FASTA, rerun_rules = RERUN_RULES, output_dir = OUTPUTDIR,
-                       alignment_choice = ALIGNMENT_CHOICE, database_dir = REFERENCE_DIR)
+                       alignment_choice = ALIGNMENT_CHOICE, database_dir = REFERENCE_DIR, 
+                       database_cache = args.database_cache)
 
     if ALIGNMENT:
         ## First, we need to perform TransDecoder if needed
         manageEukulele(piece = "transdecode", mets_or_mags = mets_or_mags, samples = samples, output_dir = OUTPUTDIR, 
                        rerun_rules = RERUN_RULES, sample_dir = SAMPLE_DIR, transdecoder_orf_size = TRANSDECODERORFSIZE, 
-                       nt_ext = NT_EXT, pep_ext = PEP_EXT, run_transdecoder = RUN_TRANSDECODER, perc_mem = PERC_MEM)
+                       nt_ext = NT_EXT, pep_ext = PEP_EXT, run_transdecoder = RUN_TRANSDECODER,
+                       compression = COMPRESSION, scratch = args.scratch)
         
-        ## Next to align against our database of choice ##
-        alignment_res = manageEukulele(piece = "align_to_db", alignment_choice = ALIGNMENT_CHOICE, samples = samples, 
-                                        filter_metric = args.filter_metric, output_dir = OUTPUTDIR, 
-                                        ref_fasta = REF_FASTA, mets_or_mags = mets_or_mags, database_dir = REFERENCE_DIR,
-                                        sample_dir = SAMPLE_DIR, rerun_rules = RERUN_RULES, 
-                                        nt_ext = NT_EXT, pep_ext = PEP_EXT, perc_mem = PERC_MEM)
-
-        ## Next to do salmon counts estimation. ##
+        ## Next to do salmon counts estimation; this is needed before alignment when streaming. ##
         if (USE_SALMON_COUNTS == True):
             try:
                 NAMES_TO_READS = namesToReads(REFERENCE_DIR, NAMES_TO_READS, SALMON_DIR)
@@ -258,18 +312,40 @@ def main(args_in):
                 print("The salmon directory provided could not be converted to a salmon file. Check " +
                       "above error messages, and",sys.exc_info()[0],"EUKulele will continue running without counts.")
                 USE_SALMON_COUNTS = 0
+                
+        if STREAM_ALIGNMENT:
+            ## Align against our database and estimate taxonomy in one pass ##
+            manageEukulele(piece = "stream_estimate_taxonomy", samples = samples, filter_metric = args.filter_metric, 
+                           output_dir = OUTPUTDIR, ref_fasta = REF_FASTA, mets_or_mags = mets_or_mags, 
+                           database_dir = REFERENCE_DIR, sample_dir = SAMPLE_DIR, nt_ext = NT_EXT, pep_ext = PEP_EXT, 
+                           tax_tab = TAX_TAB, cutoff_file = args.cutoff_file, consensus_cutoff = CONSENSUS_CUTOFF, 
+                           prot_tab = PROT_TAB, use_salmon_counts = USE_SALMON_COUNTS, 
+                           names_to_reads = NAMES_TO_READS, rerun_rules = RERUN_RULES, 
+                           reference = REFERENCE, output_format = OUTPUT_FORMAT, 
+                           keep_alignment_hits = args.keep_alignment_hits, compression = COMPRESSION)
+        else:
+            ## Next to align against our database of choice ##
+            alignment_res = manageEukulele(piece = "align_to_db", alignment_choice = ALIGNMENT_CHOICE, samples = samples, 
+                                            filter_metric = args.filter_metric, output_dir = OUTPUTDIR, 
+                                            ref_fasta = REF_FASTA, mets_or_mags = mets_or_mags, database_dir = REFERENCE_DIR,
+                                            sample_dir = SAMPLE_DIR, rerun_rules = RERUN_RULES, 
+                                            nt_ext = NT_EXT, pep_ext = PEP_EXT,
+                                            compression = COMPRESSION, batch_alignment = BATCH_ALIGNMENT,
+                                            shard_alignment = SHARD_ALIGNMENT)
 
-        manageEukulele(piece = "estimate_taxonomy", output_dir = OUTPUTDIR, mets_or_mags = mets_or_mags, 
-                       tax_tab = TAX_TAB, cutoff_file = args.cutoff_file, 
-                       consensus_cutoff = CONSENSUS_CUTOFF, prot_tab = PROT_TAB, use_salmon_counts = USE_SALMON_COUNTS, 
-                       names_to_reads = NAMES_TO_READS, alignment_res = alignment_res, 
-                       rerun_rules = RERUN_RULES, samples = samples, sample_dir = SAMPLE_DIR, pep_ext = PEP_EXT,
-                       nt_ext = NT_EXT, perc_mem = PERC_MEM)
+            manageEukulele(piece = "estimate_taxonomy", output_dir = OUTPUTDIR, mets_or_mags = mets_or_mags, 
+                           tax_tab = TAX_TAB, cutoff_file = args.cutoff_file, 
+                           consensus_cutoff = CONSENSUS_CUTOFF, prot_tab = PROT_TAB, use_salmon_counts = USE_SALMON_COUNTS, 
+                           names_to_reads = NAMES_TO_READS, alignment_res = alignment_res, 
+                           rerun_rules = RERUN_RULES, samples = samples, sample_dir = SAMPLE_DIR, pep_ext = PEP_EXT,
+                           nt_ext = NT_EXT, reference = REFERENCE,
+                           output_format = OUTPUT_FORMAT, compression = COMPRESSION)
 
         ## Now to visualize the taxonomy ##
         manageEukulele(piece = "visualize_taxonomy", output_dir = OUTPUTDIR, mets_or_mags = mets_or_mags, 
                        sample_dir = SAMPLE_DIR, pep_ext = PEP_EXT, nt_ext = NT_EXT, 
-                       use_salmon_counts = USE_SALMON_COUNTS, rerun_rules = RERUN_RULES)
+                       use_salmon_counts = USE_SALMON_COUNTS, rerun_rules = RERUN_RULES,
+                       compression = COMPRESSION)
 
         ## Next to assign taxonomy ##
         manageEukulele(piece = "assign_taxonomy", samples = samples, mets_or_mags = mets_or_mags, 
@@ -285,7 +361,8 @@ def main(args_in):
                          samples = samples, mets_or_mags = mets_or_mags, pep_ext = PEP_EXT, 
                          nt_ext = NT_EXT, sample_dir = SAMPLE_DIR, organisms = ORGANISMS, 
                          organisms_taxonomy = ORGANISMS_TAXONOMY, tax_tab = TAX_TAB, 
-                         busco_threshold = args.busco_threshold, perc_mem = PERC_MEM)
+                         busco_threshold = args.busco_threshold,
+                         reference = REFERENCE)
     
     if COREGENES & busco_matched:
         print("Investigating core genes...")
@@ -294,19 +371,21 @@ def main(args_in):
                                         filter_metric = args.filter_metric, output_dir = OUTPUTDIR, 
                                         ref_fasta = REF_FASTA, mets_or_mags = mets_or_mags, database_dir = REFERENCE_DIR,
                                         sample_dir = SAMPLE_DIR, rerun_rules = RERUN_RULES, 
-                                        nt_ext = NT_EXT, pep_ext = PEP_EXT)
+                                        nt_ext = NT_EXT, pep_ext = PEP_EXT, compression = COMPRESSION)
         if len(alignment_res) > 0:
             manageEukulele(piece = "core_estimate_taxonomy", output_dir = OUTPUTDIR, mets_or_mags = mets_or_mags, 
                            tax_tab = TAX_TAB, cutoff_file = args.cutoff_file, 
                            consensus_cutoff = CONSENSUS_CUTOFF, prot_tab = PROT_TAB, use_salmon_counts = USE_SALMON_COUNTS, 
                            names_to_reads = NAMES_TO_READS, alignment_res = alignment_res, 
                            rerun_rules = RERUN_RULES, samples = samples, sample_dir = SAMPLE_DIR, pep_ext = PEP_EXT,
-                           nt_ext = NT_EXT)
+                           nt_ext = NT_EXT, reference = REFERENCE, output_format = OUTPUT_FORMAT,
+                           compression = COMPRESSION)
 
             ## Now to visualize the taxonomy ##
             manageEukulele(piece = "core_visualize_taxonomy", output_dir = OUTPUTDIR, mets_or_mags = mets_or_mags, 
                            sample_dir = SAMPLE_DIR, pep_ext = PEP_EXT, nt_ext = NT_EXT, 
-                           use_salmon_counts = USE_SALMON_COUNTS, rerun_rules = RERUN_RULES)
+                           use_salmon_counts = USE_SALMON_COUNTS, rerun_rules = RERUN_RULES,
+                           compression = COMPRESSION)
 
             ## Next to assign taxonomy ##
             manageEukulele(piece = "core_assign_taxonomy", samples = samples, mets_or_mags = mets_or_mags, 
@@ -1,31 +1,15 @@
 import os
 import sys
 import subprocess
-import multiprocessing
 from joblib import Parallel, delayed
 import pandas as pd
-import math
-
-MEM_AVAIL_GB = 0
-while MEM_AVAIL_GB == 0:
-    try:
-        os.system("free -m > free.csv")
-        MEM_AVAIL_GB = pd.read_csv("free.csv", sep = "\s+").free[0] / 10**3
-    except:
-        pass
-
-def calc_max_jobs(num_files, size_in_bytes = 2147483648, max_mem_per_proc = 40, perc_mem = 0.75):
-    size_in_gb = size_in_bytes / (1024*1024*1024)
-    if size_in_gb == 0:
-        size_in_gb = 0.01
-    MAX_JOBS = math.floor(MEM_AVAIL_GB * perc_mem / (max_mem_per_proc * size_in_gb * num_files)) #48)
-    if MAX_JOBS == 0:
-        MAX_JOBS = 1
-    return MAX_JOBS
-
-MAX_JOBS = calc_max_jobs(10)
 
 from scripts.query_busco import queryBusco
+from EUKulele.tax_placement import ReferenceContext
+from EUKulele.compression import find_compressed, decompressed_input
+from EUKulele.fasta_scan import sequence_bytes
+from EUKulele.resources import resource_pool, job_memory_gb
+from EUKulele.manage_steps import scanSamples
 
 def readBuscoFile(individual_or_summary, busco_file, organisms, organisms_taxonomy):
     if individual_or_summary == "individual":
@@ -53,7 +37,11 @@ def configRunBusco(output_dir, mets_or_mags, pep_ext, nt_ext, sample_dir, sample
     ## Run BUSCO on the full dataset ##
     busco_db = "eukaryota_odb10"
     busco_config_res = configure_busco(busco_db,output_dir)
-    n_jobs_busco = min(multiprocessing.cpu_count(), len(samples), max(1, calc_max_jobs(len(samples))))
+    scanSamples(samples, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+    fastas = [busco_fasta(sample_name, output_dir, mets_or_mags, pep_ext, nt_ext, sample_dir)[0] for sample_name in samples]
+    pool = resource_pool()
+    n_jobs_busco = pool.slots(len(samples), max([job_memory_gb("busco", sequence_bytes(fasta)) for fasta in fastas] + [0]))
+    cpus, _ = pool.share(n_jobs_busco)
     print("Running busco with",n_jobs_busco,"simultaneous jobs...", flush=True)
     busco_res = Parallel(n_jobs=n_jobs_busco, prefer="threads")(delayed(run_busco)(sample_name, 
                                                                                                   os.path.join(output_dir, 
@@ -61,7 +49,7 @@ def configRunBusco(output_dir, mets_or_mags, pep_ext, nt_ext, sample_dir, sample
                                                                                                   output_dir,
                                                                                                   busco_db, mets_or_mags, 
                                                                                                   pep_ext, nt_ext,
-                                                                                                  sample_dir) \
+                                                                                                  sample_dir, cpus) \
                                                                                for sample_name in samples)
     print(os.listdir(os.path.join(output_dir, "busco", samples[0])), "is what is in BUSCO directory")
     all_codes = sum(busco_res) + busco_config_res
@@ -80,8 +68,9 @@ def configure_busco(busco_db,output_dir):
     rc1 = 0
     
     if not os.path.isdir(os.path.join("busco_downloads","lineages","eukaryota_odb10")):
-        p1 = subprocess.Popen(["configure_busco.sh", busco_db], stdout = busco_config_log, stderr = busco_config_err)
-        p1.wait()
+        with resource_pool().reserve(1):
+            p1 = subprocess.Popen(["configure_busco.sh", busco_db], stdout = busco_config_log, stderr = busco_config_err)
+            p1.wait()
         rc1 = p1.returncode
     else:
         print("BUSCO lineage database already found; not re-downloaded.")
@@ -90,32 +79,42 @@ def configure_busco(busco_db,output_dir):
     busco_config_err.close()
     return rc1
         
-def run_busco(sample_name, output_dir_busco, output_dir, busco_db, mets_or_mags, pep_ext, nt_ext, sample_dir):
-    CPUS = multiprocessing.cpu_count()
-    
+def busco_fasta(sample_name, output_dir, mets_or_mags, pep_ext, nt_ext, sample_dir):
+    """
+    The (possibly compressed) FASTA file that BUSCO runs on for a sample, and the BUSCO mode
+    it needs.
+    """
     if mets_or_mags == "mets":
-        if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)):
-            fastaname = os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext) 
+        if os.path.isfile(find_compressed(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext))):
+            fastaname = find_compressed(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)) 
             busco_mode = "proteins"
-        elif os.path.isfile(os.path.join(sample_dir, sample_name + "." + pep_ext)):
-            fastaname = os.path.join(sample_dir, sample_name + "." + pep_ext) 
+        elif os.path.isfile(find_compressed(os.path.join(sample_dir, sample_name + "." + pep_ext))):
+            fastaname = find_compressed(os.path.join(sample_dir, sample_name + "." + pep_ext)) 
             busco_mode = "proteins"
         else:
-            fastaname = os.path.join(sample_dir, sample_name + "." + nt_ext)
+            fastaname = find_compressed(os.path.join(sample_dir, sample_name + "." + nt_ext))
             busco_mode = "transcriptome"
     else:
-        fastaname = os.path.join(sample_dir, sample_name + "." + pep_ext)
+        fastaname = find_compressed(os.path.join(sample_dir, sample_name + "." + pep_ext))
         busco_mode = "proteins"
-        
+    return fastaname, busco_mode
+
+def run_busco(sample_name, output_dir_busco, output_dir, busco_db, mets_or_mags, pep_ext, nt_ext, sample_dir,
+              cpus = 1):
+    fastaname, busco_mode = busco_fasta(sample_name, output_dir, mets_or_mags, pep_ext, nt_ext, sample_dir)
+    mem_gb = job_memory_gb("busco", sequence_bytes(fastaname))
     busco_run_log = open(os.path.join(output_dir,"log","busco_run.out"), "w+")
     busco_run_err = open(os.path.join(output_dir,"log","busco_run.err"), "w+")
-    p1 = subprocess.Popen(["run_busco.sh", str(sample_name), str(output_dir_busco), 
-                              os.path.join(output_dir_busco, "config_" + sample_name + ".ini"), 
-                              fastaname, str(CPUS), busco_db, busco_mode], stdout = busco_run_log, stderr = busco_run_err)
-    
-    ## TRAVIS DEBUGGING!! ##
-    
-    p1.wait()
+    ## BUSCO cannot read compressed input ##
+    with decompressed_input(fastaname, os.path.join(output_dir, "decompressed")) as fastaname, \
+         resource_pool().reserve(cpus, mem_gb) as cpus:
+        p1 = subprocess.Popen(["run_busco.sh", str(sample_name), str(output_dir_busco), 
+                                  os.path.join(output_dir_busco, "config_" + sample_name + ".ini"), 
+                                  fastaname, str(cpus), busco_db, busco_mode], stdout = busco_run_log, stderr = busco_run_err)
+
+        ## TRAVIS DEBUGGING!! ##
+
+        p1.wait()
     rc1 = p1.returncode
     
     busco_run_log.close()
@@ -139,11 +138,13 @@ def run_busco(sample_name, output_dir_busco, output_dir, busco_db, mets_or_mags,
     return rc1 
 
 def manageBuscoQuery(output_dir, individual_or_summary, samples, mets_or_mags, pep_ext, nt_ext,
-                     sample_dir, organisms, organisms_taxonomy, tax_tab, busco_threshold, perc_mem):
+                     sample_dir, organisms, organisms_taxonomy, tax_tab, busco_threshold,
+                     reference = None):
     """
     Assess BUSCO completeness on the most prevalent members of the metatranscriptome at each taxonomic level.
     """
-    MAX_JOBS = calc_max_jobs(len(samples), perc_mem = perc_mem)
+    if reference is None:
+        reference = ReferenceContext(tax_tab, "")
     samples_complete = []
     if individual_or_summary == "individual":
         if (len(organisms) != len(organisms_taxonomy)):
@@ -179,27 +180,29 @@ def manageBuscoQuery(output_dir, individual_or_summary, samples, mets_or_mags, p
             taxfile_stub = os.path.join(output_dir, "taxonomy_counts", output_dir.split("/")[-1]) 
 
             if mets_or_mags == "mets":
-                if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)):
-                    fasta = os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext) 
+                if os.path.isfile(find_compressed(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext))):
+                    fasta = find_compressed(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)) 
                 else:
-                    fasta = os.path.join(sample_dir, sample_name + "." + nt_ext)
+                    fasta = find_compressed(os.path.join(sample_dir, sample_name + "." + nt_ext))
             else:
-                fasta = os.path.join(sample_dir, sample_name + "." + pep_ext)
+                fasta = find_compressed(os.path.join(sample_dir, sample_name + "." + pep_ext))
 
             query_busco_log = open(os.path.join(output_dir,"log","busco_query_" + sample_name + ".log"), "w+")
             query_busco_err = open(os.path.join(output_dir,"log","busco_query_" + sample_name + ".err"), "w+")
             sys.stdout = query_busco_log
             sys.stderr = query_busco_err
-            query_args = ["--organism_group",str(" ".join(organisms)),"--taxonomic_level",
-                          str(" ".join(organisms_taxonomy)),"--output_dir",output_dir,"--fasta_file",
-                          fasta,"--sample_name",sample_name,"--taxonomy_file_prefix",taxfile_stub,
-                          "--tax_table",tax_tab,"--busco_out",busco_table,"-i","individual",
-                          "--busco_threshold",str(busco_threshold)]
-            try:
-                rc = queryBusco(query_args)
-            except:
-                print("BUSCO query did not run successfully for sample " + sample_name + "; check log file for details.")
-                sys.exit(1)
+            with decompressed_input(fasta, os.path.join(output_dir, "decompressed")) as fasta:
+                query_args = ["--organism_group",str(" ".join(organisms)),"--taxonomic_level",
+                              str(" ".join(organisms_taxonomy)),"--output_dir",output_dir,"--fasta_file",
+                              fasta,"--sample_name",sample_name,"--taxonomy_file_prefix",taxfile_stub,
+                              "--tax_table",tax_tab,"--busco_out",busco_table,"-i","individual",
+                              "--busco_threshold",str(busco_threshold),
+                              "--available_cpus",str(resource_pool().cpus)]
+                try:
+                    rc = queryBusco(query_args, tax_table = reference.taxonomy())
+                except:
+                    print("BUSCO query did not run successfully for sample " + sample_name + "; check log file for details.")
+                    sys.exit(1)
 
             sys.stdout = sys.__stdout__
             sys.stderr = sys.__stderr__ 
@@ -228,27 +231,29 @@ def manageBuscoQuery(output_dir, individual_or_summary, samples, mets_or_mags, p
             taxfile_stub = os.path.join(output_dir, "taxonomy_counts", output_dir.split("/")[-1])
 
             if mets_or_mags == "mets":
-                fasta = os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext) 
+                fasta = find_compressed(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)) 
             else:
-                fasta = os.path.join(sample_dir, sample_name + "." + nt_ext)
+                fasta = find_compressed(os.path.join(sample_dir, sample_name + "." + nt_ext))
 
             query_busco_log = open(os.path.join(output_dir,"log","busco_query_" + sample_name + ".log"), "w+")
             query_busco_err = open(os.path.join(output_dir,"log","busco_query_" + sample_name + ".err"), "w+")
             sys.stdout = query_busco_log
             sys.stderr = query_busco_err
-            query_args = ["--output_dir",output_dir,"--fasta_file",fasta,"--sample_name",
-                          sample_name,"--taxonomy_file_prefix",taxfile_stub,"--tax_table",
-                          tax_tab,"--busco_out",busco_table,"-i","summary"]
+            with decompressed_input(fasta, os.path.join(output_dir, "decompressed")) as fasta:
+                query_args = ["--output_dir",output_dir,"--fasta_file",fasta,"--sample_name",
+                              sample_name,"--taxonomy_file_prefix",taxfile_stub,"--tax_table",
+                              tax_tab,"--busco_out",busco_table,"-i","summary",
+                              "--available_cpus",str(resource_pool().cpus)]
 
-            try:
-                rc = queryBusco(query_args)
-            except OSError as e:
-                print("Not all files needed to run BUSCO query (output of BUSCO run) found;",\
-                      "check log file for details. Here is the error:",e)
-                rc = 1
-            except:
-                print("Unexpected error:", sys.exc_info()[0])
-                rc = 1
+                try:
+                    rc = queryBusco(query_args, tax_table = reference.taxonomy())
+                except OSError as e:
+                    print("Not all files needed to run BUSCO query (output of BUSCO run) found;",\
+                          "check log file for details. Here is the error:",e)
+                    rc = 1
+                except:
+                    print("Unexpected error:", sys.exc_info()[0])
+                    rc = 1
                 
             sys.stdout = sys.__stdout__
             sys.stderr = sys.__stderr__ 
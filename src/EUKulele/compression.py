@@ -0,0 +1,205 @@
+import os
+import gzip
+import shutil
+import signal
+import tempfile
+import contextlib
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from EUKulele.resources import available_cpus
+
+## FILE SUFFIXES OF THE SUPPORTED COMPRESSION METHODS ##
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+# Bytes copied at a time when a compressed file is streamed to a plain one.
+COPY_BUFFER_BYTES = 2 ** 20
+
+class PipedFile:
+    """
+    A stream to or from a compression program. Closing the stream waits for the
+    program, and raises an error if it did not exit cleanly; a decompressing program
+    that was stopped by closing its output early is fine.
+    """
+    def __init__(self, process, stream, filename, reading = False):
+        self.process = process
+        self.stream = stream
+        self.filename = filename
+        self.reading = reading
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stream.close()
+        rc = self.process.wait()
+        if self.reading & (rc == -signal.SIGPIPE):
+            return
+        if rc != 0:
+            raise OSError("Compression program exited with code " + str(self.process.returncode) +
+                          " while processing " + str(self.filename) + ".")
+
+def compression_of(filename):
+    """
+    The compression method of a file, from its suffix; None for uncompressed files.
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if str(filename).endswith(suffix):
+            return compression
+    return None
+
+def strip_compression(filename):
+    compression = compression_of(filename)
+    if compression is None:
+        return filename
+    return filename[:-len(COMPRESSION_SUFFIXES[compression])]
+
+def compressed_name(filename, compression):
+    """
+    The name a file gets when written with a compression method ("none" for no compression).
+    """
+    return strip_compression(filename) + COMPRESSION_SUFFIXES.get(compression, "")
+
+def compressed_variants(filename):
+    filename = strip_compression(filename)
+    return [filename] + [filename + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+
+def find_compressed(filename):
+    """
+    Find a file, or a compressed copy of it, on disk. Returns the name it was found under,
+    or the name as given if there is no copy at all.
+    """
+    for curr in [filename] + compressed_variants(filename):
+        if os.path.isfile(curr):
+            return curr
+    return filename
+
+def file_size(filename):
+    """
+    The size in bytes of a file, or of its compressed copy; 0 if there is neither.
+    """
+    filename = find_compressed(filename)
+    if not os.path.isfile(filename):
+        return 0
+    return os.path.getsize(filename)
+
+def compression_command(compression, threads = None, decompress = False):
+    """
+    The command line of a multi-threaded compression program for the method, if one is
+    installed; pigz for gzip and zstd for zstd. Returns None if there is none.
+    """
+    if threads is None:
+        threads = available_cpus()
+    if (compression == "gzip") & (shutil.which("pigz") is not None):
+        if decompress:
+            return ["pigz", "-dc"]
+        return ["pigz", "-c", "-p", str(threads), "-" + str(COMPRESSION_LEVELS[compression])]
+    if (compression == "zstd") & (shutil.which("zstd") is not None):
+        if decompress:
+            return ["zstd", "-dcq"]
+        return ["zstd", "-cq", "-T" + str(threads), "-" + str(COMPRESSION_LEVELS[compression])]
+    return None
+
+def compressing_process(filename, threads = None, stdin = subprocess.PIPE, text = False):
+    """
+    Start a compression program that writes what it reads on standard input (a pipe by
+    default, or another program's output) to the file, compressed according to its suffix.
+    Returns None if no program is installed.
+    """
+    command = compression_command(compression_of(filename), threads)
+    if command is None:
+        return None
+    with open(filename, "wb") as outfile:
+        return subprocess.Popen(command, stdin = stdin, stdout = outfile, universal_newlines = text)
+
+def open_compressed(filename, mode = "rt", threads = None):
+    """
+    Open a file for streaming reads or writes, compressing or decompressing it on the fly
+    according to its suffix. The multi-threaded compression programs are used when they
+    are installed, and the Python libraries otherwise.
+    """
+    compression = compression_of(filename)
+    if compression is None:
+        return open(filename, mode)
+    text = "b" not in mode
+    if mode[0] == "w":
+        process = compressing_process(filename, threads, text = text)
+        if process is not None:
+            return PipedFile(process, process.stdin, filename)
+    elif mode[0] == "r":
+        command = compression_command(compression, threads, decompress = True)
+        if command is not None:
+            process = subprocess.Popen(command + [filename], stdout = subprocess.PIPE, universal_newlines = text)
+            return PipedFile(process, process.stdout, filename, reading = True)
+    mode = mode[0] + ("t" if text else "b")
+    if compression == "gzip":
+        return gzip.open(filename, mode, compresslevel = COMPRESSION_LEVELS[compression])
+    if zstandard is None:
+        raise OSError("Reading or writing " + str(filename) + " needs either the zstd program or the " +
+                      "zstandard Python package.")
+    return zstandard.open(filename, mode)
+
+def decompressed_copy(filename, scratch_dir):
+    """
+    Return the name of an uncompressed copy of a file, for programs that cannot read
+    compressed input. Uncompressed files are returned as they are; compressed ones are
+    streamed into the scratch directory, unless an up-to-date copy is already there.
+    """
+    if compression_of(filename) is None:
+        return filename
+    os.makedirs(scratch_dir, exist_ok = True)
+    plain_file = os.path.join(scratch_dir, os.path.basename(strip_compression(filename)))
+    if os.path.isfile(plain_file):
+        if os.path.getmtime(plain_file) >= os.path.getmtime(filename):
+            return plain_file
+    with open_compressed(filename, "rb") as infile, open(plain_file + ".tmp", "wb") as outfile:
+        shutil.copyfileobj(infile, outfile, COPY_BUFFER_BYTES)
+    os.replace(plain_file + ".tmp", plain_file)
+    return plain_file
+
+@contextlib.contextmanager
+def decompressed_input(filename, scratch_dir, readable = ()):
+    """
+    Within a with block, the name of an uncompressed copy of a file, for a program that
+    cannot read its compression (the methods in readable it reads itself). The copy is made
+    in a directory of its own under the scratch directory and removed when the block ends,
+    so it never outlives the job; other files are given as they are.
+    """
+    compression = compression_of(filename)
+    if (compression is None) or (compression in readable):
+        yield filename
+        return
+    os.makedirs(scratch_dir, exist_ok = True)
+    copy_dir = tempfile.mkdtemp(prefix = "input_", dir = scratch_dir)
+    try:
+        yield decompressed_copy(filename, copy_dir)
+    finally:
+        shutil.rmtree(copy_dir, ignore_errors = True)
+
+def compress_file(filename, compression, threads = None):
+    """
+    Compress a finished file in place, removing the uncompressed file. Returns the name of
+    the compressed file (or the file as it was, if the method is "none").
+    """
+    if (compression not in COMPRESSION_SUFFIXES) | (compression_of(filename) is not None):
+        return filename
+    outfile = compressed_name(filename, compression)
+    with open(filename, "rb") as infile, open_compressed(outfile + ".tmp" + COMPRESSION_SUFFIXES[compression],
+                                                         "wb", threads) as compressed:
+        shutil.copyfileobj(infile, compressed, COPY_BUFFER_BYTES)
+    os.replace(outfile + ".tmp" + COMPRESSION_SUFFIXES[compression], outfile)
+    os.remove(filename)
+    return outfile
@@ -0,0 +1,107 @@
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import contextlib
+
+from EUKulele.manifest import file_digest, tool_version
+
+## WHERE REFERENCE DATABASES ARE BUILT, SHARED BY EVERY PROJECT THAT OPTS IN ##
+# Used when no cache directory is given; without either, databases are built in the reference directory.
+DATABASE_CACHE_ENV = "EUKULELE_DATABASE_CACHE"
+# Written into each finished build, to say what it was built from.
+BUILD_INFO_FILE = "build.json"
+
+def default_cache_dir():
+    """
+    The shared cache directory set in the environment, or "" if there is none.
+    """
+    return os.environ.get(DATABASE_CACHE_ENV, "")
+
+def build_key(reference_fasta, tool, parameters = dict()):
+    """
+    The name of the cached build of a reference FASTA by a tool: the same for every copy of
+    the same reference built with the same version of the tool and the same parameters.
+    """
+    key = {"reference": file_digest(reference_fasta), "tool": tool, "version": tool_version(tool),
+           "parameters": parameters}
+    digest = hashlib.blake2b(json.dumps(key, sort_keys = True).encode(), digest_size = 16).hexdigest()
+    return tool + "-" + digest, key
+
+@contextlib.contextmanager
+def build_lock(lock_file):
+    """
+    Hold an exclusive lock on a file for the duration of a with block, waiting for any other
+    process (or thread) that holds it.
+    """
+    with open(lock_file, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def cached_build(cache_dir, name, key, build, rebuild = False):
+    """
+    The path of a cached build, which build(directory) makes if it is not in the cache yet,
+    returning 0 if it succeeds. Each build is made in a fresh directory of its own, under a
+    lock that other builds of the same key wait on, and the path (a link) is then pointed
+    at it, so a build is only ever made once and never seen half-made. With rebuild, a
+    cached build is made anew and swapped in the same way; the build it replaces is left
+    where it is, as other projects may still be reading it. Returns the path, and the
+    return code of the build (0 if the build was cached).
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    build_dir = os.path.join(cache_dir, name)
+    with build_lock(build_dir + ".lock"):
+        if os.path.isfile(os.path.join(build_dir, BUILD_INFO_FILE)) & (not rebuild):
+            return build_dir, 0
+        new_dir = build_dir + "." + uuid.uuid4().hex[:12]
+        os.makedirs(new_dir)
+        rc = build(new_dir)
+        if rc != 0:
+            shutil.rmtree(new_dir, ignore_errors = True)
+            return build_dir, rc
+        with open(os.path.join(new_dir, BUILD_INFO_FILE), "w") as outfile:
+            json.dump(key, outfile, indent = 1, sort_keys = True)
+        if os.path.lexists(build_dir + ".tmp"):
+            os.remove(build_dir + ".tmp")
+        os.symlink(os.path.basename(new_dir), build_dir + ".tmp")
+        os.replace(build_dir + ".tmp", build_dir)
+    return build_dir, 0
+
+def move_build(build_dir, prefix, target_prefix):
+    """
+    Move the files of a build whose names start with prefix to the same names with
+    target_prefix instead, replacing any files (or links to a cached build) already there.
+    Returns the files.
+    """
+    targets = []
+    for curr in sorted(os.listdir(build_dir)):
+        if not curr.startswith(prefix):
+            continue
+        target = target_prefix + curr[len(prefix):]
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok = True)
+        os.replace(os.path.join(build_dir, curr), target)
+        targets.append(target)
+    return targets
+
+def link_build(build_dir, prefix, link_prefix):
+    """
+    Link the files of a cached build whose names start with prefix to the same names with
+    link_prefix instead, replacing any files already there. Returns the links.
+    """
+    links = []
+    for curr in sorted(os.listdir(build_dir)):
+        if not curr.startswith(prefix):
+            continue
+        link = link_prefix + curr[len(prefix):]
+        os.makedirs(os.path.dirname(os.path.abspath(link)), exist_ok = True)
+        if os.path.lexists(link + ".tmp"):
+            os.remove(link + ".tmp")
+        os.symlink(os.path.abspath(os.path.join(build_dir, curr)), link + ".tmp")
+        os.replace(link + ".tmp", link)
+        links.append(link)
+    return links
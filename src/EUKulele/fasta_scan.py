@@ -0,0 +1,105 @@
+import os
+import json
+from joblib import Parallel, delayed
+
+from EUKulele.compression import open_compressed, find_compressed
+
+## WHAT A PRE-FLIGHT SCAN OF A SAMPLE FASTA FILE RECORDS ##
+NUCLEOTIDE_BYTES = b"ACGTUNacgtun"
+# A file is nucleotide if at least this fraction of its residues are nucleotides.
+NUCLEOTIDE_FRACTION = 0.9
+# At most this many malformed header lines are listed for each file.
+MAX_REPORTED_HEADERS = 5
+# Scans made by this process, by (path, size, modification time).
+SCANS = dict()
+
+def file_key(filename):
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+def scan_fasta(filename):
+    """
+    Read a (possibly compressed) FASTA file once, and return its sequence type ("protein",
+    "nucleotide", or "empty"), the number of records, the total and the largest number of
+    residues in a record, and the number of malformed header lines (without a sequence ID,
+    or sequence before the first header), with the line numbers of the first few.
+    """
+    records = residues = nucleotides = longest = curr_length = 0
+    malformed_lines = []
+    n_malformed = 0
+    with open_compressed(filename, "rb") as infile:
+        for line_number, line in enumerate(infile, 1):
+            if line.startswith(b">"):
+                longest = max(longest, curr_length)
+                curr_length = 0
+                records += 1
+                if len(line[1:].split()) == 0:
+                    n_malformed += 1
+                    if len(malformed_lines) < MAX_REPORTED_HEADERS:
+                        malformed_lines.append(line_number)
+                continue
+            line = line.rstrip()
+            if (records == 0) & (len(line) > 0):
+                n_malformed += 1
+                if len(malformed_lines) < MAX_REPORTED_HEADERS:
+                    malformed_lines.append(line_number)
+            curr_length += len(line)
+            residues += len(line)
+            nucleotides += len(line) - len(line.translate(None, NUCLEOTIDE_BYTES))
+    longest = max(longest, curr_length)
+    sequence_type = "empty"
+    if residues > 0:
+        sequence_type = "nucleotide" if nucleotides >= NUCLEOTIDE_FRACTION * residues else "protein"
+    return {"sequence_type": sequence_type, "records": records, "residues": residues,
+            "longest": longest, "malformed_headers": n_malformed, "malformed_lines": malformed_lines}
+
+def read_scan_cache(cache_file):
+    try:
+        with open(cache_file) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return dict()
+
+def scan_fastas(fastas, cache_file = None, n_jobs = 1):
+    """
+    Scan FASTA files in parallel (see scan_fasta), reusing the scans in the cache file of files
+    that have not changed size or modification time since, and saving the scans to it. Returns
+    the scans, in the order of the files.
+    """
+    fastas = [find_compressed(fasta) for fasta in fastas]
+    cache = dict()
+    if cache_file is not None:
+        cache = read_scan_cache(cache_file)
+    keys = [file_key(fasta) for fasta in fastas]
+    for key in keys:
+        entry = cache.get(key[0])
+        if (entry is not None) and (entry["size"] == key[1]) and (entry["mtime_ns"] == key[2]):
+            SCANS.setdefault(key, entry["scan"])
+    to_scan = sorted(set([key for key in keys if key not in SCANS]))
+    if len(to_scan) > 0:
+        scans = Parallel(n_jobs = max(1, min(n_jobs, len(to_scan))))(delayed(scan_fasta)(key[0]) for key in to_scan)
+        for key, scan in zip(to_scan, scans):
+            SCANS[key] = scan
+    if cache_file is not None:
+        for key in keys:
+            cache[key[0]] = {"size": key[1], "mtime_ns": key[2], "scan": SCANS[key]}
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok = True)
+        with open(cache_file + ".tmp", "w") as outfile:
+            json.dump(cache, outfile, indent = 1, sort_keys = True)
+        os.replace(cache_file + ".tmp", cache_file)
+    return [SCANS[key] for key in keys]
+
+def fasta_info(fasta):
+    """
+    The scan of a FASTA file (see scan_fasta), scanning it now unless this process already has.
+    """
+    return scan_fastas([fasta])[0]
+
+def sequence_bytes(fasta):
+    """
+    The number of residues in a FASTA file, which memory estimates are based on; unlike the
+    size of the file, it does not depend on compression, line breaks or header length.
+    """
+    if not os.path.isfile(find_compressed(fasta)):
+        return 0
+    return fasta_info(fasta)["residues"]
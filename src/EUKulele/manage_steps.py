@@ -1,52 +1,57 @@
 import os
 import sys
 import subprocess
-import multiprocessing
 from joblib import Parallel, delayed
 import shutil
 import pathlib
+import tempfile
 import pandas as pd
 import math
+import traceback
 
 import EUKulele
-from EUKulele.tax_placement import place_taxonomy
+from EUKulele.tax_placement import place_taxonomy, ReferenceContext
+from EUKulele.tax_placement import estimated_taxonomy_files, cutoff_file_path, ALIGNMENT_COLUMNS
 from EUKulele.visualize_results import visualize_all_results
+from EUKulele.compression import compression_of, strip_compression, compressed_name, find_compressed
+from EUKulele.compression import open_compressed, compressing_process, decompressed_copy, compress_file
+from EUKulele.compression import decompressed_input
+from EUKulele.compression import COPY_BUFFER_BYTES
+from EUKulele.resources import resource_pool, job_memory_gb
+from EUKulele.manifest import step_is_current, record_step, MANIFEST_DIR
+from EUKulele.fasta_scan import scan_fastas, fasta_info, sequence_bytes
+from EUKulele.database_cache import default_cache_dir, build_key, cached_build, link_build, move_build
 
 from scripts.mag_stats import magStats
 
-MEM_AVAIL_GB = 0
-while MEM_AVAIL_GB == 0:
-    try:
-        os.system("free -m > free.csv")
-        MEM_AVAIL_GB = pd.read_csv("free.csv", sep = "\s+").free[0] / 10**3
-    except:
-        pass
-    
-# 25 GB memory per GB file size
-# add a parameter that changes between the requirement per file size (reducing to 10 GB for now)
-# also add a parameter to EUKulele that decides whether you use 100% of available memory and scales
-# MEM_AVAIL_GB by that amount (default to 75%)
-def calc_max_jobs(num_files, size_in_bytes = 2147483648, max_mem_per_proc = 10, perc_mem = 0.75):
-    size_in_gb = size_in_bytes / (1024*1024*1024)
-    if size_in_gb == 0:
-        size_in_gb = 0.01
-    MAX_JOBS = math.floor(MEM_AVAIL_GB * perc_mem / (max_mem_per_proc * size_in_gb * num_files)) #48)
-    if MAX_JOBS == 0:
-        MAX_JOBS = 1
-    return MAX_JOBS
-        
-MAX_JOBS = max(1, calc_max_jobs(1))
-
-# For DIAMOND: The program can be expected to use roughly six times this number of memory (in GB). 
-# So for the default value of -b2.0, the memory usage will be about 12 GB.
-# So we want alignment to have -b6.0
+# For DIAMOND: The program can be expected to use roughly six times the block size (-b) in GB of memory
+# with the default of four index chunks (-c4), and more with fewer chunks; we take it to use
+# b * (2 + 16 / c) GB, so 12 GB for -b2.0 -c4 and 36 GB for -b2.0 -c1.
+DIAMOND_BLOCK_SIZE_RANGE = (0.4, 12.0)
+DIAMOND_INDEX_CHUNKS = [1, 2, 4]
+# The share of a streamed sample's memory and CPUs that goes to DIAMOND; the rest is left to the classifier.
+STREAM_DIAMOND_MEM_FRACTION = 0.75
+STREAM_DIAMOND_CPU_FRACTION = 0.75
+# Query IDs of batched alignments are prefixed with the sample's place in the batch and this separator.
+BATCH_ID_SEPARATOR = "|"
+# At most this many samples go in one batch, as the alignment file of each is open while it runs.
+BATCH_MAX_SAMPLES = 250
+# A sample is sharded into one piece per this many sequences, as far as there are CPUs for shards
+# of at least SHARD_MIN_THREADS threads each; a shard is never larger than one DIAMOND block.
+SHARD_MIN_SEQUENCES = 10**6
+SHARD_MIN_THREADS = 4
+# Where the pre-flight scans of the sample files are cached, in the manifest folder of the output directory.
+FASTA_SCAN_CACHE = "fasta_scan.json"
 
 def manageEukulele(piece, mets_or_mags = "", samples = [], database_dir = "", 
                    output_dir = "", ref_fasta = "", alignment_choice = "diamond", 
                    rerun_rules = False, cutoff_file = "", sample_dir = "", nt_ext = "", pep_ext = "",
                    consensus_cutoff = 0.75, tax_tab = "", prot_tab = "", use_salmon_counts = False,
                    names_to_reads = "", alignment_res = "", filter_metric = "evalue", 
-                   run_transdecoder = False, transdecoder_orf_size = 100, perc_mem = 0.75):
+                   run_transdecoder = False, transdecoder_orf_size = 100,
+                   reference = None, output_format = "tsv", keep_alignment_hits = False,
+                   compression = "none", batch_alignment = False, shard_alignment = False,
+                   database_cache = "", scratch = ""):
     
     """
     This function diverts management tasks to the below helper functions.
@@ -55,41 +60,50 @@ def manageEukulele(piece, mets_or_mags = "", samples = [], database_dir = "",
     if piece == "setup_eukulele":
         setupEukulele(output_dir)
     elif piece == "setup_databases":
-        createAlignmentDatabase(ref_fasta, rerun_rules, output_dir, alignment_choice, database_dir)
+        createAlignmentDatabase(ref_fasta, rerun_rules, output_dir, alignment_choice, database_dir, database_cache)
     elif piece == "get_samples":
         return getSamples(mets_or_mags, sample_dir, nt_ext, pep_ext)
     elif piece == "transdecode":
         if mets_or_mags == "mets":
             manageTrandecode(samples, output_dir, rerun_rules, sample_dir,
-                     mets_or_mags = "mets", transdecoder_orf_size = 100,
+                     mets_or_mags = "mets", transdecoder_orf_size = transdecoder_orf_size,
                      nt_ext = "." + nt_ext.strip('.'), pep_ext = "." + pep_ext.strip('.'),
-                     run_transdecoder = run_transdecoder, perc_mem = perc_mem)
+                     run_transdecoder = run_transdecoder, compression = compression, scratch = scratch)
     elif piece == "align_to_db":
         return manageAlignment(alignment_choice, samples, filter_metric, output_dir, ref_fasta, 
                         mets_or_mags, database_dir, sample_dir, rerun_rules, nt_ext, pep_ext, core = "full",
-                              perc_mem = perc_mem)
+                              compression = compression, batch_alignment = batch_alignment,
+                              shard_alignment = shard_alignment)
     elif piece == "estimate_taxonomy":
         manageTaxEstimation(output_dir, mets_or_mags, tax_tab, cutoff_file, consensus_cutoff,
                             prot_tab, use_salmon_counts, names_to_reads, alignment_res,
-                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, perc_mem)
+                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, reference,
+                            output_format, compression)
+    elif piece == "stream_estimate_taxonomy":
+        return manageStreamedTaxEstimation(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, 
+                                           database_dir, sample_dir, nt_ext, pep_ext, tax_tab, cutoff_file, 
+                                           consensus_cutoff, prot_tab, use_salmon_counts, names_to_reads, 
+                                           rerun_rules, reference, output_format, keep_alignment_hits,
+                                           compression)
     elif piece == "visualize_taxonomy":
         manageTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt_ext, 
-                               use_salmon_counts, rerun_rules)
+                               use_salmon_counts, rerun_rules, compression)
     elif piece == "assign_taxonomy":
         manageTaxAssignment(samples, mets_or_mags, output_dir, sample_dir, pep_ext, core = False)
     elif piece == "core_align_to_db":
         alignment_res = manageAlignment(alignment_choice, samples, filter_metric, output_dir, ref_fasta, 
                         mets_or_mags, database_dir, sample_dir, rerun_rules, nt_ext, pep_ext, core = "core",
-                                       perc_mem = perc_mem)
+                                       compression = compression)
         alignment_res = [curr for curr in alignment_res if curr != ""]
         return alignment_res
     elif piece == "core_estimate_taxonomy":
         manageCoreTaxEstimation(output_dir, mets_or_mags, tax_tab, cutoff_file, consensus_cutoff,
                             prot_tab, use_salmon_counts, names_to_reads, alignment_res,
-                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, perc_mem)
+                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, reference,
+                            output_format, compression)
     elif piece == "core_visualize_taxonomy":
         manageCoreTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt_ext, 
-                               use_salmon_counts, rerun_rules, core = True)
+                               use_salmon_counts, rerun_rules, core = True, compression = compression)
     elif piece == "core_assign_taxonomy":
         manageTaxAssignment(samples, mets_or_mags, output_dir, sample_dir, pep_ext, core = True)
     else:
@@ -100,18 +114,20 @@ def manageEukulele(piece, mets_or_mags = "", samples = [], database_dir = "",
 def getSamples(mets_or_mags, sample_dir, nt_ext, pep_ext):
     """
     Get the names of the metagenomic or metatranscriptomic samples from the provided folder.
+    Sample files may be gzip or zstd compressed.
     """
     
+    sample_files = [strip_compression(curr) for curr in os.listdir(sample_dir)]
     if (mets_or_mags == "mets"):
-        samples_nt = [".".join(curr.split(".")[0:-1]) for curr in os.listdir(sample_dir) if curr.split(".")[-1] == nt_ext]
-        samples_pep = [".".join(curr.split(".")[0:-1]) for curr in os.listdir(sample_dir) if curr.split(".")[-1] == pep_ext]
+        samples_nt = [".".join(curr.split(".")[0:-1]) for curr in sample_files if curr.split(".")[-1] == nt_ext]
+        samples_pep = [".".join(curr.split(".")[0:-1]) for curr in sample_files if curr.split(".")[-1] == pep_ext]
         samples = list(set(samples_nt + samples_pep))
         print(samples)
         if len(samples) == 0:
             print("No samples found in sample directory with specified nucleotide or peptide extension.")
             sys.exit(1)
     else:
-        samples = [".".join(curr.split(".")[0:-1]) for curr in os.listdir(sample_dir) if curr.split(".")[-1] == pep_ext]
+        samples = [".".join(curr.split(".")[0:-1]) for curr in sample_files if curr.split(".")[-1] == pep_ext]
         if len(samples) == 0:
             print("No samples found in sample directory with specified peptide extension.")
             sys.exit(1)
@@ -119,106 +135,120 @@ def getSamples(mets_or_mags, sample_dir, nt_ext, pep_ext):
     return samples
             
 
+def moveIntoPlace(source, destination):
+    """
+    Move a finished file to its destination so that it appears there whole or not at all,
+    even from another file system: it is moved next to the destination first, and then
+    renamed over it.
+    """
+    shutil.move(source, destination + ".tmp")
+    os.replace(destination + ".tmp", destination)
+
 def transdecodeToPeptide(sample_name, output_dir, rerun_rules, sample_dir, 
                          mets_or_mags = "mets", transdecoder_orf_size = 100,
-                         nt_ext = ".fasta", pep_ext = ".faa", run_transdecoder = False):
+                         nt_ext = ".fasta", pep_ext = ".faa", run_transdecoder = False, compression = "none",
+                         mem_gb = 0, scratch = ""):
     """
     Use TransDecoder to convert input nucleotide metatranscriptomic sequences to peptide sequences.
+    TransDecoder runs on a single CPU, which is reserved along with mem_gb GB of memory. Each
+    sample runs in its own working directory in the scratch directory (the output directory's
+    scratch folder by default), so that samples can run side by side without sharing
+    TransDecoder's checkpoint files; its results are then moved into the output directory.
     """
     
     if (not run_transdecoder):
         return 0
     print("Running TransDecoder for sample " + str(sample_name) + "...", flush = True)
     os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags, "transdecoder"))
-    if (os.path.isfile(os.path.join(output_dir, mets_or_mags, 
-                                    sample_name + pep_ext))) & (not rerun_rules):
+    sample_pep = find_compressed(os.path.join(sample_dir, sample_name + pep_ext))
+    sample_nt = find_compressed(os.path.join(sample_dir, sample_name + nt_ext))
+    output_pep = os.path.join(output_dir, mets_or_mags, sample_name + pep_ext)
+    parameters = {"orf_size": int(transdecoder_orf_size), "refine_starts": False}
+    if step_is_current(output_pep, "transdecoder", [sample_nt], parameters, ["TransDecoder.LongOrfs"]) & \
+       (not rerun_rules):
         print("TransDecoder file already detected for sample " + 
               str(sample_name) + "; will not re-run step.", flush = True)
         return 0
-    elif (os.path.isfile(os.path.join(sample_dir, sample_name + pep_ext))) & (not rerun_rules):
+    elif (os.path.isfile(sample_pep)) & (not rerun_rules):
         print("Protein files detected for sample in sample directory; " +
               "will not TransDecode.", flush = True)
-        os.system("cp " + os.path.join(sample_dir, sample_name + pep_ext) + " " +
-                  os.path.join(output_dir, mets_or_mags, sample_name + pep_ext))
+        os.system("cp " + sample_pep + " " +
+                  os.path.join(output_dir, mets_or_mags, os.path.basename(sample_pep)))
         return 0
     
+    if (not os.path.isfile(sample_nt)):
+        print("File: " + os.path.join(sample_dir, sample_name + nt_ext) + " was called by TransDecoder and "
+              "does not exist. Check for typos.", flush = True)
+        return 1
+    if scratch == "":
+        scratch = os.path.join(output_dir, "scratch")
+    os.makedirs(scratch, exist_ok = True)
+    work_dir = tempfile.mkdtemp(prefix = "transdecoder_" + sample_name + "_", dir = scratch)
+    ## TransDecoder cannot read compressed input ##
+    transdecoder_nt = os.path.abspath(decompressed_copy(sample_nt, work_dir))
+    
     TD_log = open(os.path.join(output_dir,"log","transdecoder_longorfs_" + sample_name + ".log"), "w+")
     TD_err = open(os.path.join(output_dir,"log","transdecoder_longorfs_" + sample_name + ".err"), "w+")
-    if (not os.path.isfile(os.path.join(sample_dir, sample_name + nt_ext))):
-        print("File: " + os.path.join(sample_dir, sample_name + nt_ext) + " was called by TransDecoder and "
-              "does not exist. Check for typos.")
-        sys.exit(1)
-    rc1 = subprocess.Popen(["TransDecoder.LongOrfs", "-t", os.path.join(sample_dir, sample_name + nt_ext),
-               "-m", str(transdecoder_orf_size)], stdout = TD_log, stderr = TD_err).wait()
-    TD_log.close()
-    TD_err.close()
-    
-    TD_log = open(os.path.join(output_dir,"log","transdecoder_predict_" + sample_name + ".log"), "w+") 
-    TD_err = open(os.path.join(output_dir,"log","transdecoder_predict_" + sample_name + ".err"), "w+")
-    rc2 = subprocess.Popen(["TransDecoder.Predict", "-t", os.path.join(sample_dir, sample_name + nt_ext),
-               "--no_refine_starts"], stdout = TD_log, stderr = TD_err).wait()
-    #rc2 = p2.returncode
-    TD_log.close()
-    TD_err.close()
+    with resource_pool().reserve(1, mem_gb):
+        rc1 = subprocess.Popen(["TransDecoder.LongOrfs", "-t", transdecoder_nt,
+                   "-m", str(transdecoder_orf_size)], stdout = TD_log, stderr = TD_err, cwd = work_dir).wait()
+        TD_log.close()
+        TD_err.close()
+
+        TD_log = open(os.path.join(output_dir,"log","transdecoder_predict_" + sample_name + ".log"), "w+") 
+        TD_err = open(os.path.join(output_dir,"log","transdecoder_predict_" + sample_name + ".err"), "w+")
+        rc2 = 1
+        if rc1 == 0:
+            rc2 = subprocess.Popen(["TransDecoder.Predict", "-t", transdecoder_nt,
+                       "--no_refine_starts"], stdout = TD_log, stderr = TD_err, cwd = work_dir).wait()
+        TD_log.close()
+        TD_err.close()
     
     if (rc1 + rc2) != 0:
         print("TransDecoder did not complete successfully for sample " + 
               str(sample_name) + ". Check <output_dir>/log/ folder for details.")
-        sys.exit(1)
+        shutil.rmtree(work_dir, ignore_errors = True)
+        return rc1 + rc2
         
-    merged_name = sample_name + nt_ext
-    
-    os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags))
-    os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags, "transdecoder"))
-    
-    os.replace(merged_name + ".transdecoder.pep", os.path.join(output_dir, mets_or_mags, 
-                                                               sample_name + pep_ext))
-    os.replace(merged_name + ".transdecoder.cds", os.path.join(output_dir, mets_or_mags, 
-                                                               "transdecoder", sample_name + 
-                                                               ".fasta.transdecoder.cds"))
-    os.replace(merged_name + ".transdecoder.gff3", os.path.join(output_dir, mets_or_mags, 
-                                                                "transdecoder", sample_name + 
-                                                                ".fasta.transdecoder.gff3"))
-    os.replace(merged_name + ".transdecoder.bed", os.path.join(output_dir, mets_or_mags, 
-                                                               "transdecoder", sample_name + 
-                                                               ".fasta.transdecoder.bed"))
-    #shutil.rmtree
-    os.system("rm -rf " + merged_name + "*.transdecoder_dir*")
+    merged_name = os.path.join(work_dir, os.path.basename(transdecoder_nt))
+    for suffix in ["cds", "gff3", "bed"]:
+        moveIntoPlace(merged_name + ".transdecoder." + suffix, 
+                      os.path.join(output_dir, mets_or_mags, "transdecoder", 
+                                   sample_name + ".fasta.transdecoder." + suffix))
+    pep_file = compress_file(merged_name + ".transdecoder.pep", compression)
+    moveIntoPlace(pep_file, compressed_name(output_pep, compression))
+    shutil.rmtree(work_dir, ignore_errors = True)
+    record_step(output_pep, "transdecoder", [sample_nt], parameters, ["TransDecoder.LongOrfs"])
     return rc1 + rc2
     
 def manageTrandecode(met_samples, output_dir, rerun_rules, sample_dir, 
                      mets_or_mags = "mets", transdecoder_orf_size = 100,
-                     nt_ext = "fasta", pep_ext = ".faa", run_transdecoder = False, perc_mem = 0.75):
+                     nt_ext = "fasta", pep_ext = ".faa", run_transdecoder = False, compression = "none",
+                     scratch = ""):
     """
-    Now for some TransDecoding - a manager for TransDecoder steps.
+    Now for some TransDecoding - a manager for TransDecoder steps. Each sample runs in its own
+    working directory, and waits for its CPU and memory from the resource pool, so as many
+    samples run at once as fit.
     """
     
     if (not run_transdecoder):
         return 0
     
     print("Running TransDecoder for MET samples...", flush = True)
-    MAX_JOBS = 1
-    MAX_JOBS_SAMPS = [calc_max_jobs(len(met_samples), pathlib.Path(os.path.join(sample_dir, sample + nt_ext)).stat().st_size,
-                                     max_mem_per_proc = 48, perc_mem = perc_mem) \
-                        for sample in met_samples  \
-                        if os.path.isfile(os.path.join(sample_dir, sample + nt_ext))]
-    if len(MAX_JOBS_SAMPS) > 0:
-        MAX_JOBS = min([calc_max_jobs(len(met_samples), pathlib.Path(os.path.join(sample_dir, sample + nt_ext)).stat().st_size,
-                                     max_mem_per_proc = 48, perc_mem = perc_mem) \
-                        for sample in met_samples  \
-                        if os.path.isfile(os.path.join(sample_dir, sample + nt_ext))])
-    n_jobs_align = min(multiprocessing.cpu_count(), len(met_samples), max(1,MAX_JOBS))
-    transdecoder_res = Parallel(n_jobs=n_jobs_align)(delayed(transdecodeToPeptide)(sample_name, output_dir, 
+    scanSamples(met_samples, output_dir, mets_or_mags, sample_dir, nt_ext.strip('.'), pep_ext.strip('.'))
+    mem_gbs = [job_memory_gb("transdecoder", sequence_bytes(os.path.join(sample_dir, sample + nt_ext))) 
+               for sample in met_samples]
+    n_jobs_align = resource_pool().slots(len(met_samples))
+    transdecoder_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(transdecodeToPeptide)(met_samples[t], output_dir, 
                                                                                    rerun_rules, sample_dir, 
-                         mets_or_mags = "mets", transdecoder_orf_size = 100,
+                         mets_or_mags = "mets", transdecoder_orf_size = transdecoder_orf_size,
                          nt_ext = nt_ext, pep_ext = pep_ext, 
-                         run_transdecoder = run_transdecoder) for sample_name in met_samples)
+                         run_transdecoder = run_transdecoder, compression = compression,
+                         mem_gb = mem_gbs[t], scratch = scratch) for t in range(len(met_samples)))
     all_codes = sum(transdecoder_res)
-    os.system("rm -f pipeliner*")
     if all_codes > 0:
         print("TransDecoder did not complete successfully; check log folder for details.")
         sys.exit(1)
-    #rcodes = [os.remove(curr) for curr in glob.glob("pipeliner*")]
               
 def setupEukulele(output_dir):
     print("Setting things up...")
@@ -239,60 +269,40 @@ def setupEukulele(output_dir):
 
 def manageAlignment(alignment_choice, samples, filter_metric, output_dir, ref_fasta,
                     mets_or_mags, database_dir, sample_dir, rerun_rules, nt_ext, pep_ext, core = "full",
-                    perc_mem = 0.75):
+                    compression = "none", batch_alignment = False, shard_alignment = False):
     """
     Manage the multithreaded management of aligning to either BLAST or DIAMOND database.
+    The CPUs are split between as many samples as fit in memory at once, sized by the
+    largest sample. With batch_alignment, many samples are aligned with DIAMOND at once;
+    with shard_alignment, large samples are split and their pieces aligned side by side.
     """
     
     print("Aligning to reference database...")
-    if mets_or_mags == "mets":
-        fastas = []
-        for sample in samples:
-            if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext)):
-                fp = open(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext))
-                for i, line in enumerate(fp):
-                    if i == 2:
-                        chars = set(list(line))
-                        if len(chars) <= 5:
-                            print("Peptide extension used, but this file, " +
-                                  str(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext)) + 
-                                  ", does not appear to be a peptide file.")
-                            break
-                    elif i > 2:
-                        fastas.append(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext))
-                        break
-                fp.close()
-            elif os.path.isfile(os.path.join(sample_dir, sample + "." + pep_ext)):
-                fp = open(os.path.join(sample_dir, sample + "." + pep_ext))
-                for i, line in enumerate(fp):
-                    if i == 2:
-                        chars = set(list(line))
-                        if len(chars) <= 5:
-                            print("Peptide extension used, but this file, " + 
-                                  str(os.path.join(sample_dir, sample + "." + pep_ext)) + 
-                                  ", does not appear to be a peptide file.")
-                            break
-                    elif i > 2:
-                        fastas.append(os.path.join(sample_dir, sample + "." + pep_ext))
-                        break
-                fastas.append(os.path.join(sample_dir, sample + "." + pep_ext))
-            else:
-                fastas.append(os.path.join(sample_dir, sample + "." + nt_ext))
-    else:
-        fastas = [os.path.join(sample_dir, sample + "." + pep_ext) for sample in samples]
+    scanSamples(samples, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+    if batch_alignment & (alignment_choice == "diamond") & (core == "full"):
+        return manageBatchAlignment(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                                    sample_dir, rerun_rules, nt_ext, pep_ext, compression)
+    if shard_alignment & (alignment_choice == "diamond") & (core == "full"):
+        return manageShardedAlignment(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                                      sample_dir, rerun_rules, nt_ext, pep_ext, compression)
+    fastas = [sampleFasta(sample, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)[0] for sample in samples]
         
     print(fastas)
-    MAX_JOBS = 1
-    if len(fastas) > 0:
-        MAX_JOBS = min([calc_max_jobs(len(fastas), pathlib.Path(sample).stat().st_size,
-                                     max_mem_per_proc = 10, perc_mem = perc_mem) for sample in fastas])
-    n_jobs_align = min(multiprocessing.cpu_count(), len(samples), max(1,MAX_JOBS))
+    pool = resource_pool()
+    if alignment_choice == "diamond":
+        job_mem_gb = max([diamondJobMemory(sequence_bytes(fasta)) for fasta in fastas] + [0])
+    else:
+        job_mem_gb = max([job_memory_gb("alignment", sequence_bytes(fasta)) for fasta in fastas] + [0])
+    n_jobs_align = pool.slots(len(samples), job_mem_gb)
+    cpus, mem_gb = pool.share(n_jobs_align)
     alignment_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(alignToDatabase)(alignment_choice,
                                                                                                sample_name, filter_metric, 
                                                                                                output_dir, ref_fasta, 
                                                                                                mets_or_mags, database_dir, 
                                                                                                sample_dir, rerun_rules, nt_ext, 
-                                                                                               pep_ext, core = core) \
+                                                                                               pep_ext, core = core,
+                                                                                               compression = compression,
+                                                                                               cpus = cpus, mem_gb = mem_gb) \
                                                                     for sample_name in samples)
     #alignment_res = []
     #for sample_name in samples:
@@ -305,28 +315,43 @@ def manageAlignment(alignment_choice, samples, filter_metric, output_dir, ref_fa
         
     return alignment_res
 
-def createAlignmentDatabase(ref_fasta, rerun_rules, output_dir, alignment_choice="diamond", database_dir=""):
+def createAlignmentDatabase(ref_fasta, rerun_rules, output_dir, alignment_choice="diamond", database_dir="",
+                            database_cache=""):
     """
     Creates a database from the provided reference fasta file and reference database,
-    whether or not it has been autogenerated.
+    whether or not it has been autogenerated. If a cache directory is given (or set in the
+    environment), databases are built once there and shared by every project that uses it
+    (see database_cache.py), under the checksum of the reference and the version of the
+    aligner, and linked into the reference directory. Otherwise they are built in the
+    reference directory itself.
     """
     
     rc2 = 0
+    pool = resource_pool()
+    if database_cache == "":
+        database_cache = default_cache_dir()
               
     output_log = os.path.join(output_dir, "log", "alignment_out.log")
     error_log = os.path.join(output_dir, "log", "alignment_err.log")
+    reference_fasta = os.path.join(database_dir, ref_fasta)
     if alignment_choice == "diamond":
         align_db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa') + '.dmnd')
-        if (not os.path.isfile(align_db)) | (rerun_rules):
-            ## DIAMOND database creation ##
-            os.system("mkdir -p " + os.path.join(database_dir, "diamond"))
-            db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa'))
-            rc2 = os.system("diamond makedb --in " + os.path.join(database_dir, ref_fasta) + " --db " + db + 
-                            " 1> " + output_log + " 2> " + error_log)
-        else:
+        if step_is_current(align_db, "diamond_database", [reference_fasta], tools = ["diamond"]) & (not rerun_rules):
             print("Diamond database file already created; will not re-create database.", flush = True)
+            return rc2
+        ## DIAMOND database creation ##
+        db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa'))
+        def build(build_dir):
+            with pool.reserve(pool.cpus) as cpus:
+                return os.system("diamond makedb --in " + reference_fasta + " --db " + 
+                                 os.path.join(build_dir, "database") + " --threads " + str(cpus) + 
+                                 " 1> " + output_log + " 2> " + error_log)
+        name, key = build_key(reference_fasta, "diamond")
     else:
         db = os.path.join(database_dir, "blast", ref_fasta.strip('.fa'), "database")
+        if step_is_current(db, "blast_database", [reference_fasta], tools = ["makeblastdb"]) & (not rerun_rules):
+            print("BLAST database files already created; will not re-create database.", flush = True)
+            return rc2
         os.system("mkdir -p " + db)
         db_type = "prot"
         blast_version = 5
@@ -337,39 +362,225 @@ def createAlignmentDatabase(ref_fasta, rerun_rules, output_dir, alignment_choice
         #          os.path.join(database_dir, ref_fasta + "decoy.pep.fa"))
         # os.system("sed -i $'s/ //g' " + os.path.join(database_dir, ref_fasta))
         # makeblastdb -in tests/aux_data/mmetsp/sample_ref_MAG/reference.pep.fa -parse_seqids -title referencefa -dbtype prot -out tests/aux_data/mmetsp/sample_ref_MAG/blast/reference.pep/database
-        rc2 = os.system("makeblastdb -in " + os.path.join(database_dir, ref_fasta) + 
-                        " -parse_seqids -title " + database + 
-                        " -dbtype " + db_type + " -out " + db + " 1> " + output_log + " 2> " + 
-                        error_log)
+        def build(build_dir):
+            with pool.reserve(1):
+                return os.system("makeblastdb -in " + reference_fasta + 
+                                 " -parse_seqids -title " + database + 
+                                 " -dbtype " + db_type + " -out " + os.path.join(build_dir, "database") + 
+                                 " 1> " + output_log + " 2> " + error_log)
+        name, key = build_key(reference_fasta, "makeblastdb", {"title": database, "dbtype": db_type})
+    
+    if database_cache == "":
+        ## Build next to the reference, then move the files over any old ones ##
+        build_dir = db + ".build"
+        shutil.rmtree(build_dir, ignore_errors = True)
+        os.makedirs(build_dir)
+        rc2 = build(build_dir)
+        if rc2 == 0:
+            links = move_build(build_dir, "database", db)
+        shutil.rmtree(build_dir, ignore_errors = True)
+    else:
+        build_dir, rc2 = cached_build(database_cache, name, key, build, rebuild = rerun_rules)
+        if rc2 == 0:
+            print("Using the " + alignment_choice.upper() + " database built in " + build_dir + ".", flush = True)
+            links = link_build(build_dir, "database", db)
+    if rc2 != 0:
+        print(alignment_choice.upper() + " database creation did not complete successfully. Check " + 
+              error_log + " for details.", flush = True)
+        return rc2
+    if alignment_choice == "diamond":
+        record_step(align_db, "diamond_database", [reference_fasta], tools = ["diamond"], outputs = links)
+    else:
+        record_step(db, "blast_database", [reference_fasta], tools = ["makeblastdb"], outputs = links)
     return rc2
  
+def diamondArguments(alignment_method, align_db, fasta, filter_metric, settings):
+    """
+    Build the DIAMOND command line for aligning a sample, without an output file; DIAMOND
+    writes the hits to standard output when none is given. Only the tabular columns used
+    for taxonomic estimation are requested. The threads, block size and index chunks come
+    from diamondSettings.
+    """
+    outfmt = 6
+    k = 100
+    e = 1e-5
+    bitscore = 50
+    pid_cutoff = 75
+    if filter_metric == "bitscore":
+        filter_args = ["--min-score", str(bitscore)]
+    elif filter_metric == "pid":
+        filter_args = ["--id", str(pid_cutoff)]
+    else:
+        filter_args = ["-e", str(e)]
+    return ["diamond", alignment_method, "--db", align_db, "-q", fasta, "--outfmt", str(outfmt)] + \
+           ALIGNMENT_COLUMNS + ["-k", str(k)] + filter_args + \
+           ["--threads", str(settings[0]), "-b" + str(settings[1]), "-c" + str(settings[2])]
+    
+def diamondMemory(block_size, index_chunks):
+    """
+    The memory in GB that DIAMOND is expected to use with the given block size and index chunks.
+    """
+    return block_size * (2 + 16 / index_chunks)
+
+def diamondSettings(cpus, mem_gb, query_bytes):
+    """
+    Choose DIAMOND's block size (-b) and index chunks (-c) for a job with the given CPUs and
+    memory (in GB). A block never needs to be larger than the query itself (taking a byte of
+    FASTA as a letter), so small samples get small blocks and little memory. The whole query,
+    up to the largest block size, is aligned in one block with as few index chunks as fit;
+    otherwise the block is made as large as fits with four chunks. Returns the threads, block
+    size and index chunks, and the memory that DIAMOND is expected to use with them.
+    """
+    min_block, max_block = DIAMOND_BLOCK_SIZE_RANGE
+    wanted_block = min(max(query_bytes / 10**9, min_block), max_block)
+    index_chunks = DIAMOND_INDEX_CHUNKS[-1]
+    block_size = mem_gb / diamondMemory(1, index_chunks)
+    for curr_chunks in DIAMOND_INDEX_CHUNKS:
+        if mem_gb / diamondMemory(1, curr_chunks) >= wanted_block:
+            index_chunks = curr_chunks
+            block_size = wanted_block
+            break
+    block_size = max(min_block, math.floor(min(block_size, wanted_block) * 10) / 10)
+    return cpus, block_size, index_chunks, diamondMemory(block_size, index_chunks)
+
+def largestBlockBytes(pool):
+    """
+    The query bytes in the largest DIAMOND block (with four index chunks) that fits in the
+    memory of the whole resource pool.
+    """
+    min_block, max_block = DIAMOND_BLOCK_SIZE_RANGE
+    return max(min_block, min(max_block, pool.mem_gb / diamondMemory(1, DIAMOND_INDEX_CHUNKS[-1]))) * 10**9
+
+def diamondJobMemory(query_bytes):
+    """
+    The memory in GB that a DIAMOND job would like for a query of the given size: enough to
+    align the whole query (up to the largest block size) in one block with one index chunk.
+    """
+    min_block, max_block = DIAMOND_BLOCK_SIZE_RANGE
+    return diamondMemory(min(max(query_bytes / 10**9, min_block), max_block), DIAMOND_INDEX_CHUNKS[0])
+
+def logDiamondSettings(job_name, settings, log):
+    """
+    Report the DIAMOND parameters chosen for a sample or batch, on screen and in its log.
+    """
+    threads, block_size, index_chunks, mem_gb = settings
+    message = "DIAMOND settings for " + str(job_name) + ": --threads " + str(threads) + \
+              " -b" + str(block_size) + " -c" + str(index_chunks) + " (about " + str(round(mem_gb, 1)) + \
+              " GB of memory)"
+    print(message, flush = True)
+    log.write(message + "\n")
+    log.flush()
+    
+def sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext):
+    """
+    Find the (possibly compressed) FASTA file that a sample is aligned from, along with the
+    alignment method: translated peptides if there are any, and otherwise the nucleotide
+    sequences of a metatranscriptome, which are aligned with blastx. Whether a file holds
+    peptides or nucleotides is taken from its pre-flight scan, not from its extension.
+    """
+    candidates = [os.path.join(sample_dir, sample_name + "." + pep_ext)]
+    if mets_or_mags == "mets":
+        candidates = [os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext),
+                      os.path.join(sample_dir, sample_name + "." + pep_ext),
+                      os.path.join(sample_dir, sample_name + "." + nt_ext)]
+    nucleotide_fasta = None
+    for fasta in [find_compressed(curr) for curr in candidates]:
+        if not os.path.isfile(fasta):
+            continue
+        if fasta_info(fasta)["sequence_type"] != "nucleotide":
+            return fasta, "blastp"
+        if nucleotide_fasta is None:
+            nucleotide_fasta = fasta
+    if nucleotide_fasta is not None:
+        return nucleotide_fasta, "blastx"
+    return find_compressed(candidates[-1]), "blastx" if mets_or_mags == "mets" else "blastp"
+
+def scanSamples(samples, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext):
+    """
+    Pre-flight scan of all of the samples' FASTA files in parallel (see fasta_scan.py), cached
+    in the output directory for reruns, with a warning for each file whose contents do not
+    match its extension or that has malformed headers.
+    """
+    fastas = []
+    for sample_name in samples:
+        for curr in [os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext),
+                     os.path.join(sample_dir, sample_name + "." + pep_ext),
+                     os.path.join(sample_dir, sample_name + "." + nt_ext)]:
+            if os.path.isfile(find_compressed(curr)) & (find_compressed(curr) not in fastas):
+                fastas.append(find_compressed(curr))
+    pool = resource_pool()
+    with pool.reserve(pool.slots(len(fastas))) as cpus:
+        scans = scan_fastas(fastas, os.path.join(output_dir, MANIFEST_DIR, FASTA_SCAN_CACHE), cpus)
+    for fasta, scan in zip(fastas, scans):
+        if (scan["sequence_type"] == "nucleotide") & (strip_compression(fasta).endswith("." + pep_ext)):
+            print("Peptide extension used, but this file, " + str(fasta) + 
+                  ", does not appear to be a peptide file.", flush = True)
+        if scan["malformed_headers"] > 0:
+            print("File " + str(fasta) + " has " + str(scan["malformed_headers"]) + " malformed FASTA " + 
+                  "header lines (e.g. line " + str(scan["malformed_lines"][0]) + ").", flush = True)
+    return dict(zip(fastas, scans))
+
+## WHAT THE OUTPUT OF EACH STEP DEPENDS ON, AS RECORDED IN THE STEP MANIFEST ##
+def alignmentParameters(alignment_method, filter_metric):
+    """
+    The parameters an alignment file depends on. DIAMOND's threads, block size and index
+    chunks only change how fast it runs, so they are left out.
+    """
+    return {"alignment_method": alignment_method, "filter_metric": filter_metric, "columns": ALIGNMENT_COLUMNS}
+
+def estimationInputs(tax_tab, cutoff_file, prot_tab, use_salmon_counts, names_to_reads):
+    inputs = [tax_tab, cutoff_file_path(cutoff_file), prot_tab]
+    if int(use_salmon_counts) == 1:
+        inputs.append(names_to_reads)
+    return inputs
+
+def estimationParameters(consensus_cutoff, use_salmon_counts, output_format):
+    return {"consensus_cutoff": float(consensus_cutoff), "use_counts": int(use_salmon_counts),
+            "output_format": output_format}
+
+def runToCompressedFile(arguments, outfile, stderr, threads = None):
+    """
+    Run a program that writes its results to standard output, compressing them into the
+    output file as they are produced. Returns the exit code of the program, or of the
+    compressor if it fails; if either fails, the partial output file is removed.
+    """
+    p1 = subprocess.Popen(arguments, stdout = subprocess.PIPE, stderr = stderr)
+    p2 = compressing_process(outfile, threads, stdin = p1.stdout)
+    if p2 is None:
+        with open_compressed(outfile, "wb") as compressed:
+            shutil.copyfileobj(p1.stdout, compressed, COPY_BUFFER_BYTES)
+    p1.stdout.close()
+    rc = p1.wait()
+    if p2 is not None:
+        if rc != 0:
+            p2.terminate()
+            p2.wait()
+        else:
+            rc = p2.wait()
+    if (rc != 0) & os.path.isfile(outfile):
+        os.remove(outfile)
+    return rc
+
 def alignToDatabase(alignment_choice, sample_name, filter_metric, output_dir, ref_fasta,
-                      mets_or_mags, database_dir, sample_dir, rerun_rules, nt_ext, pep_ext, core = "full"):
+                      mets_or_mags, database_dir, sample_dir, rerun_rules, nt_ext, pep_ext, core = "full",
+                      compression = "none", cpus = 1, mem_gb = 0):
     """
-    Align the samples against the created database.
+    Align the samples against the created database. Compressed samples are read directly
+    where the aligner supports it, and the alignment is compressed as it is written when a
+    compression method is chosen. The aligner runs on the given number of CPUs, once they
+    and the memory it needs are reserved; DIAMOND's parameters are tuned to the CPUs and
+    the memory (in GB) of the job.
     """
     
     print("Aligning sample " + sample_name + "...")
     if alignment_choice == "diamond":
         os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags + "_" + core, "diamond"))
         diamond_out = os.path.join(output_dir, mets_or_mags + "_" + core, "diamond", sample_name + ".diamond.out")
-        if (os.path.isfile(diamond_out)):
-            if (pathlib.Path(diamond_out).stat().st_size != 0) & (not rerun_rules):
-                print("Diamond alignment file already detected; will not re-run step.")
-                return diamond_out
         
         align_db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa') + '.dmnd')
         alignment_method = "blastp"
-        if (mets_or_mags == "mets") & (core == "full"):
-            if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)):
-                fasta = os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)
-            elif os.path.isfile(os.path.join(sample_dir, sample_name + "." + pep_ext)):
-                fasta = os.path.join(sample_dir, sample_name + "." + pep_ext)
-            else:
-                fasta = os.path.join(sample_dir, sample_name + "." + nt_ext)
-                alignment_method = "blastx"
-        elif core == "full":
-            fasta = os.path.join(sample_dir, sample_name + "." + pep_ext)
+        if core == "full":
+            fasta, alignment_method = sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
         elif core == "core":
             # now concatenate the BUSCO output
             fasta = os.path.join(output_dir, sample_name + "_busco" + "." + pep_ext)
@@ -377,60 +588,46 @@ def alignToDatabase(alignment_choice, sample_name, filter_metric, output_dir, re
             if not os.path.isfile(fasta):
                 print("No BUSCO matches found for sample: " + sample_name)
                 return ""
-            
-        other = "--outfmt 6 -k 100 -e 1e-5"
-        outfmt = 6
-        k = 100
-        e = 1e-5
-        bitscore = 50
-        pid_cutoff = 75
-        diamond_log = open(os.path.join(output_dir,"log",core + "_diamond_align_" + sample_name + ".log"), "w+")
-        diamond_err = open(os.path.join(output_dir,"log",core + "_diamond_align_" + sample_name + ".err"), "w+")
-        if filter_metric == "bitscore":
-            rc1 = subprocess.Popen(["diamond", alignment_method, "--db", align_db, "-q", fasta, "-o", 
-                                   diamond_out, "--outfmt", str(outfmt), "-k", str(k), "--min-score", 
-                                   str(bitscore), '-b3.0'], stdout = diamond_log, stderr = diamond_err).wait()
-            print("Diamond process exited for sample " + str(sample_name) + ".", flush = True)
-        elif filter_metric == "pid":
-            rc1 = subprocess.Popen(["diamond", alignment_method, "--db", align_db, "-q", fasta, "-o", 
-                                   diamond_out, "--outfmt", str(outfmt), "-k", str(k), "--id", 
-                                   str(pid_cutoff), '-b3.0'], stdout = diamond_log, stderr = diamond_err).wait()
-            print("Diamond process exited for sample " + str(sample_name) + ".", flush = True)
-        else:
-            rc1 = subprocess.Popen(["diamond", alignment_method, "--db", align_db, "-q", fasta, "-o", 
-                                   diamond_out, "--outfmt", str(outfmt), "-k", str(k), "-e", 
-                                   str(e), '-b3.0'], stdout = diamond_log, stderr = diamond_err).wait()
-            # For debugging.
-            #, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            #stdout, stderr = p.communicate()
-            #rc1 = p.returncode
-            #print(stderr)
-            #print(stdout)
-            print("Diamond process exited for sample " + str(sample_name) + ".", flush = True)
+        inputs = [fasta, align_db]
+        parameters = alignmentParameters(alignment_method, filter_metric)
+        if step_is_current(diamond_out, "diamond_alignment", inputs, parameters, ["diamond"]) & (not rerun_rules):
+            print("Diamond alignment file already detected; will not re-run step.")
+            return find_compressed(diamond_out)
+        diamond_out = compressed_name(diamond_out, compression)
+        ## DIAMOND reads gzipped queries, but not zstd ones ##
+        with decompressed_input(fasta, os.path.join(output_dir, "decompressed"), readable = ["gzip"]) as fasta:
+            diamond_log = open(os.path.join(output_dir,"log",core + "_diamond_align_" + sample_name + ".log"), "w+")
+            diamond_err = open(os.path.join(output_dir,"log",core + "_diamond_align_" + sample_name + ".err"), "w+")
+            settings = diamondSettings(cpus, mem_gb, sequence_bytes(inputs[0]))
+            logDiamondSettings("sample " + sample_name, settings, diamond_log)
+            with resource_pool().reserve(settings[0], settings[3]):
+                if compression_of(diamond_out) is None:
+                    rc1 = subprocess.Popen(diamondArguments(alignment_method, align_db, fasta, filter_metric, settings) + 
+                                           ["-o", diamond_out], stdout = diamond_log, stderr = diamond_err).wait()
+                else:
+                    rc1 = runToCompressedFile(diamondArguments(alignment_method, align_db, fasta, filter_metric, settings), 
+                                              diamond_out, diamond_err, settings[0])
+        # For debugging.
+        #, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        #stdout, stderr = p.communicate()
+        #rc1 = p.returncode
+        #print(stderr)
+        #print(stdout)
+        print("Diamond process exited for sample " + str(sample_name) + ".", flush = True)
         if rc1 != 0:
             print("Diamond did not complete successfully for sample",str(sample_name),"with rc code",str(rc1))
             os.system("rm -f " + diamond_out)
             return 1
+        record_step(diamond_out, "diamond_alignment", inputs, parameters, ["diamond"])
         return diamond_out
     else:
         blast_out = os.path.join(output_dir, mets_or_mags + "_" + core, "blast", sample_name + ".blast.txt")
         os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags + "_" + core, "blast"))
-        if (os.path.isfile(blast_out)) & (not rerun_rules):
-            print("BLAST alignment file already detected; will not re-run step.")
-            return blast_out
         
         align_db = os.path.join(database_dir, "blast", ref_fasta.strip('.fa'), "database")
         alignment_method = "blastp"
-        if mets_or_mags == "mets":
-            if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)):
-                fasta = os.path.join(output_dir, mets_or_mags, sample_name + "." + pep_ext)
-            elif os.path.isfile(os.path.join(sample_dir, sample_name + "." + pep_ext)):
-                fasta = os.path.join(sample_dir, sample_name + "." + pep_ext)
-            else:
-                fasta = os.path.join(sample_dir, sample_name + "." + nt_ext)
-                alignment_method = "blastx"
-        elif core == "full":
-            fasta = os.path.join(sample_dir, sample_name + "." + pep_ext)
+        if (mets_or_mags == "mets") | (core == "full"):
+            fasta, alignment_method = sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
         elif core == "core":
             # now concatenate the BUSCO output
             fasta = os.path.join(output_dir, sample_name + "_busco" + "." + pep_ext)
@@ -441,105 +638,567 @@ def alignToDatabase(alignment_choice, sample_name, filter_metric, output_dir, re
             
         outfmt = 6 # tabular output format
         e = 1e-5
+        inputs = [fasta, os.path.join(database_dir, ref_fasta)]
+        parameters = dict(alignmentParameters(alignment_method, filter_metric), evalue = e)
+        if step_is_current(blast_out, "blast_alignment", inputs, parameters, [alignment_method]) & (not rerun_rules):
+            print("BLAST alignment file already detected; will not re-run step.")
+            return find_compressed(blast_out)
+        blast_out = compressed_name(blast_out, compression)
         os.system("export BLASTDB=" + align_db)
-        blast_log = open(os.path.join(output_dir,"log","blast_align_" + sample_name + ".log"), "w+")
-        blast_err = open(os.path.join(output_dir,"log","blast_align_" + sample_name + ".err"), "w+")
-        rc1 = subprocess.Popen([alignment_method, "-query", fasta, "-db", align_db, "-out", 
-                              blast_out,"-outfmt",str(outfmt),"-evalue", str(e)],
-                             stdout = blast_log, stderr = blast_err).wait()
+        ## BLAST cannot read compressed queries ##
+        with decompressed_input(fasta, os.path.join(output_dir, "decompressed")) as fasta:
+            blast_log = open(os.path.join(output_dir,"log","blast_align_" + sample_name + ".log"), "w+")
+            blast_err = open(os.path.join(output_dir,"log","blast_align_" + sample_name + ".err"), "w+")
+            with resource_pool().reserve(cpus, job_memory_gb("alignment", sequence_bytes(inputs[0]))) as cpus:
+                blast_args = [alignment_method, "-query", fasta, "-db", align_db,
+                              "-outfmt"," ".join([str(outfmt)] + ALIGNMENT_COLUMNS),"-evalue", str(e),
+                              "-num_threads", str(cpus)]
+                if compression_of(blast_out) is None:
+                    rc1 = subprocess.Popen(blast_args + ["-out", blast_out], stdout = blast_log, stderr = blast_err).wait()
+                else:
+                    rc1 = runToCompressedFile(blast_args, blast_out, blast_err, cpus)
         if rc1 != 0:
             print("BLAST did not complete successfully.")
             return 1
+        record_step(blast_out, "blast_alignment", inputs, parameters, [alignment_method])
         return blast_out
     
     
+def batchSamples(sizes, target_bytes, max_samples = BATCH_MAX_SAMPLES):
+    """
+    Split samples, in order, into batches of at most target_bytes of query and max_samples
+    samples; a sample larger than target_bytes is a batch on its own. Returns lists of
+    sample indices.
+    """
+    batches = []
+    batch_bytes = 0
+    for t in range(len(sizes)):
+        if (len(batches) == 0) or (batch_bytes + sizes[t] > target_bytes) or (len(batches[-1]) >= max_samples):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(t)
+        batch_bytes += sizes[t]
+    return batches
+
+def writeBatchFasta(fastas, batch_fasta):
+    """
+    Concatenate the (possibly compressed) FASTA files of a batch, prefixing every sequence ID
+    with the position of its sample in the batch.
+    """
+    with open(batch_fasta, "w") as outfile:
+        for t in range(len(fastas)):
+            with open_compressed(fastas[t]) as infile:
+                line = "\n"
+                for line in infile:
+                    if line.startswith(">"):
+                        line = ">" + str(t) + BATCH_ID_SEPARATOR + line[1:]
+                    outfile.write(line)
+                if not line.endswith("\n"):
+                    outfile.write("\n")
+    
+def alignBatchToDatabase(batch_name, sample_names, fastas, outfiles, alignment_method, filter_metric,
+                         output_dir, align_db, cpus, mem_gb, query_bytes):
+    """
+    Align a batch of samples with one DIAMOND run, so that the reference database is loaded
+    and scanned once for all of them, and split the hits back into one alignment file per
+    sample as they come out of the pipe; the files are compressed once the batch is done, if
+    their names say so. DIAMOND is tuned to the query_bytes residues of the batch. Returns 0,
+    or 1 if DIAMOND failed.
+    """
+    batch_dir = os.path.dirname(outfiles[0])
+    batch_fasta = os.path.join(batch_dir, batch_name + ".faa")
+    print("Aligning " + str(len(sample_names)) + " samples together in " + batch_name + "...", flush = True)
+    writeBatchFasta(fastas, batch_fasta)
+    
+    diamond_log = open(os.path.join(output_dir, "log", "full_diamond_align_" + batch_name + ".log"), "w+")
+    diamond_err = open(os.path.join(output_dir, "log", "full_diamond_align_" + batch_name + ".err"), "w+")
+    diamond_log.write("Samples in " + batch_name + ": " + " ".join(sample_names) + "\n")
+    settings = diamondSettings(cpus, mem_gb, query_bytes)
+    logDiamondSettings(batch_name, settings, diamond_log)
+    splits = [open(strip_compression(outfile) + ".tmp", "w") for outfile in outfiles]
+    rc1 = 1
+    try:
+        with resource_pool().reserve(settings[0], settings[3]):
+            p = subprocess.Popen(diamondArguments(alignment_method, align_db, batch_fasta, filter_metric, settings),
+                                 stdout = subprocess.PIPE, stderr = diamond_err, universal_newlines = True)
+            try:
+                for line in p.stdout:
+                    sample_index, hit = line.split(BATCH_ID_SEPARATOR, 1)
+                    splits[int(sample_index)].write(hit)
+                rc1 = p.wait()
+            finally:
+                ## Stop DIAMOND if the hits could not be split ##
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+                p.stdout.close()
+    finally:
+        for split in splits:
+            split.close()
+        diamond_log.close()
+        diamond_err.close()
+        os.remove(batch_fasta)
+        if rc1 != 0:
+            for outfile in outfiles:
+                os.system("rm -f " + strip_compression(outfile) + ".tmp")
+    print("Diamond process exited for " + batch_name + ".", flush = True)
+    
+    if rc1 == 0:
+        for outfile in outfiles:
+            os.replace(strip_compression(outfile) + ".tmp", strip_compression(outfile))
+            compress_file(strip_compression(outfile), compression_of(outfile), settings[0])
+    if rc1 != 0:
+        print("Diamond did not complete successfully for", batch_name, "with rc code", str(rc1))
+        return 1
+    return 0
+
+def manageBatchAlignment(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                         sample_dir, rerun_rules, nt_ext, pep_ext, compression = "none"):
+    """
+    Align the samples to the DIAMOND database in batches: the queries of many samples are
+    concatenated and aligned by one DIAMOND run, and the hits are split back into the usual
+    per-sample alignment files. A batch holds as much query as one DIAMOND block that fits
+    in the memory of the resource pool.
+    """
+    diamond_dir = os.path.join(output_dir, mets_or_mags + "_full", "diamond")
+    os.system("mkdir -p " + diamond_dir)
+    align_db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa') + '.dmnd')
+    alignment_res = []
+    to_align = dict()
+    for sample_name in samples:
+        diamond_out = os.path.join(diamond_dir, sample_name + ".diamond.out")
+        fasta, alignment_method = sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+        if step_is_current(diamond_out, "diamond_alignment", [fasta, align_db], 
+                           alignmentParameters(alignment_method, filter_metric), ["diamond"]) & (not rerun_rules):
+            print("Diamond alignment file already detected for sample " + sample_name + "; will not re-run step.")
+            alignment_res.append(find_compressed(diamond_out))
+            continue
+        alignment_res.append(compressed_name(diamond_out, compression))
+        to_align.setdefault(alignment_method, []).append((len(alignment_res) - 1, sample_name, fasta))
+    
+    pool = resource_pool()
+    target_bytes = largestBlockBytes(pool)
+    batches = []
+    for alignment_method, entries in to_align.items():
+        for batch in batchSamples([sequence_bytes(entry[2]) for entry in entries], target_bytes):
+            batches.append((alignment_method, [entries[t] for t in batch]))
+    if len(batches) == 0:
+        return alignment_res
+    
+    batch_bytes = [sum(sequence_bytes(entry[2]) for entry in batch) for _, batch in batches]
+    n_jobs_align = pool.slots(len(batches), diamondJobMemory(max(batch_bytes)))
+    cpus, mem_gb = pool.share(n_jobs_align)
+    print("Aligning " + str(sum(len(batch) for _, batch in batches)) + " samples in " + str(len(batches)) + 
+          " DIAMOND batches...", flush = True)
+    batch_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(alignBatchToDatabase)("batch_" + str(b + 1),
+                                                                        [entry[1] for entry in batches[b][1]],
+                                                                        [entry[2] for entry in batches[b][1]],
+                                                                        [alignment_res[entry[0]] for entry in batches[b][1]],
+                                                                        batches[b][0], filter_metric, output_dir, 
+                                                                        align_db, cpus, mem_gb, batch_bytes[b]) \
+                                                                for b in range(len(batches)))
+    if sum(batch_res) != 0:
+        print("Alignment did not complete successfully.")
+        sys.exit(1)
+    for alignment_method, batch in batches:
+        for entry in batch:
+            record_step(alignment_res[entry[0]], "diamond_alignment", [entry[2], align_db], 
+                        alignmentParameters(alignment_method, filter_metric), ["diamond"])
+    return alignment_res
+    
+def shardCount(n_sequences, query_bytes, pool):
+    """
+    How many shards to split a sample into: one per SHARD_MIN_SEQUENCES sequences while
+    there are CPUs to run them with SHARD_MIN_THREADS threads each, and at least enough
+    that each shard fits in one DIAMOND block.
+    """
+    by_sequences = math.ceil(n_sequences / SHARD_MIN_SEQUENCES)
+    by_cpus = max(1, pool.cpus // SHARD_MIN_THREADS)
+    by_memory = math.ceil(query_bytes / largestBlockBytes(pool))
+    return max(1, min(n_sequences, max(by_memory, min(by_sequences, by_cpus))))
+
+def splitFasta(fasta, n_sequences, n_shards, shard_stub):
+    """
+    Split a (possibly compressed) FASTA file into n_shards files of consecutive records,
+    named shard_stub + ".shard_<i>.faa". Records are counted as they are read; n_sequences
+    (the expected count) only sets the shard size, and any records beyond it go into the
+    last shard. Returns the shard file names, in order.
+    """
+    per_shard = max(1, math.ceil(n_sequences / n_shards))
+    shards = [shard_stub + ".shard_" + str(t + 1) + ".faa" for t in range(n_shards)]
+    outfile = None
+    curr_shard = -1
+    n_records = 0
+    with open_compressed(fasta, "rb") as infile:
+        for line in infile:
+            if line.startswith(b">"):
+                if min(n_records // per_shard, n_shards - 1) != curr_shard:
+                    curr_shard = min(n_records // per_shard, n_shards - 1)
+                    if outfile is not None:
+                        outfile.close()
+                    outfile = open(shards[curr_shard], "wb")
+                n_records += 1
+            if outfile is not None:
+                if not line.endswith(b"\n"):
+                    line = line + b"\n"
+                outfile.write(line)
+    if outfile is not None:
+        outfile.close()
+    return [shard for shard in shards if os.path.isfile(shard)]
+
+def alignShardToDatabase(job_name, log_name, alignment_method, align_db, fasta, outfile, filter_metric, output_dir,
+                         cpus, mem_gb, query_bytes):
+    """
+    Align one shard of a sample with DIAMOND, tuned to the CPUs and memory of the job and the
+    query_bytes residues of the shard. Returns DIAMOND's exit code.
+    """
+    diamond_log = open(os.path.join(output_dir, "log", "full_diamond_align_" + log_name + ".log"), "w+")
+    diamond_err = open(os.path.join(output_dir, "log", "full_diamond_align_" + log_name + ".err"), "w+")
+    settings = diamondSettings(cpus, mem_gb, query_bytes)
+    logDiamondSettings(job_name, settings, diamond_log)
+    with resource_pool().reserve(settings[0], settings[3]):
+        rc1 = subprocess.Popen(diamondArguments(alignment_method, align_db, fasta, filter_metric, settings) + 
+                               ["-o", outfile], stdout = diamond_log, stderr = diamond_err).wait()
+    diamond_log.close()
+    diamond_err.close()
+    return rc1
+
+def mergeShardAlignments(shard_outs, outfile):
+    """
+    Concatenate the alignments of a sample's shards, in order, into the sample's alignment
+    file (compressed if its name says so), and remove the shards' files.
+    """
+    tmp_file = strip_compression(outfile) + ".tmp" + outfile[len(strip_compression(outfile)):]
+    with open_compressed(tmp_file, "wb") as merged:
+        for shard_out in shard_outs:
+            with open(shard_out, "rb") as infile:
+                shutil.copyfileobj(infile, merged, COPY_BUFFER_BYTES)
+    os.replace(tmp_file, outfile)
+    for shard_out in shard_outs:
+        os.remove(shard_out)
+    
+def manageShardedAlignment(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                           sample_dir, rerun_rules, nt_ext, pep_ext, compression = "none"):
+    """
+    Align the samples to the DIAMOND database, splitting large samples into shards of
+    consecutive sequences that are aligned side by side (see shardCount), so that one very
+    large sample does not hold up the rest of the pipeline. The alignments of the shards
+    are merged, in order, into the usual alignment file of each sample.
+    """
+    diamond_dir = os.path.join(output_dir, mets_or_mags + "_full", "diamond")
+    shard_dir = os.path.join(diamond_dir, "shards")
+    os.system("mkdir -p " + shard_dir)
+    align_db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa') + '.dmnd')
+    pool = resource_pool()
+    alignment_res = []
+    jobs = []
+    shard_outs = dict()
+    shard_inputs = dict()
+    for sample_name in samples:
+        diamond_out = os.path.join(diamond_dir, sample_name + ".diamond.out")
+        fasta, alignment_method = sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+        if step_is_current(diamond_out, "diamond_alignment", [fasta, align_db], 
+                           alignmentParameters(alignment_method, filter_metric), ["diamond"]) & (not rerun_rules):
+            print("Diamond alignment file already detected for sample " + sample_name + "; will not re-run step.")
+            alignment_res.append(find_compressed(diamond_out))
+            continue
+        alignment_res.append(compressed_name(diamond_out, compression))
+        shard_inputs[sample_name] = ([fasta, align_db], alignmentParameters(alignment_method, filter_metric))
+        n_sequences = fasta_info(fasta)["records"]
+        query_bytes = sequence_bytes(fasta)
+        n_shards = shardCount(n_sequences, query_bytes, pool)
+        if n_shards > 1:
+            print("Splitting sample " + sample_name + " (" + str(n_sequences) + " sequences) into " + 
+                  str(n_shards) + " shards...", flush = True)
+            shards = splitFasta(fasta, n_sequences, n_shards, os.path.join(shard_dir, sample_name))
+        else:
+            ## DIAMOND reads gzipped queries, but not zstd ones; the copy goes once aligned ##
+            shards = [fasta]
+            if compression_of(fasta) == "zstd":
+                shards = [decompressed_copy(fasta, shard_dir)]
+        shard_outs[sample_name] = []
+        for t in range(len(shards)):
+            job_name = "sample " + sample_name
+            log_name = sample_name
+            if len(shards) > 1:
+                job_name = job_name + " shard " + str(t + 1)
+                log_name = log_name + "_shard_" + str(t + 1)
+            shard_out = os.path.join(shard_dir, log_name + ".diamond.out")
+            shard_outs[sample_name].append(shard_out)
+            jobs.append((job_name, log_name, alignment_method, shards[t], shard_out, shards[t] != fasta, 
+                         math.ceil(query_bytes / len(shards))))
+    if len(jobs) == 0:
+        return alignment_res
+    
+    n_jobs_align = pool.slots(len(jobs), max([diamondJobMemory(job[6]) for job in jobs]))
+    cpus, mem_gb = pool.share(n_jobs_align)
+    try:
+        align_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(alignShardToDatabase)(job[0], job[1], job[2], 
+                                                                                                     align_db, job[3], job[4], 
+                                                                                                     filter_metric, output_dir, 
+                                                                                                     cpus, mem_gb, job[6]) \
+                                                                    for job in jobs)
+    finally:
+        for job in jobs:
+            if job[5] & os.path.isfile(job[3]):
+                os.remove(job[3])
+    if sum(align_res) != 0:
+        print("Alignment did not complete successfully for " + 
+              ", ".join([jobs[t][0] for t in range(len(jobs)) if align_res[t] != 0]) + ".")
+        sys.exit(1)
+    for t in range(len(alignment_res)):
+        if samples[t] in shard_outs:
+            mergeShardAlignments(shard_outs[samples[t]], alignment_res[t])
+            record_step(alignment_res[t], "diamond_alignment", shard_inputs[samples[t]][0], 
+                        shard_inputs[samples[t]][1], ["diamond"])
+    return alignment_res
+    
+def estimateSampleTaxonomy(log_prefix, output_dir, tax_tab, cutoff_file, consensus_cutoff,
+                           prot_tab, use_salmon_counts, names_to_reads, alignment_file, outfile,
+                           rerun_rules, mem_budget_gb, n_workers, reference, output_format = "tsv",
+                           compression = "none"):
+    """
+    Estimate taxonomy for a single sample, writing its progress and errors to the sample's own
+    log files instead of redirecting the streams of the whole process. The sample's CPUs and
+    memory budget are reserved from the resource pool while it runs.
+    """
+    log_stub = os.path.join(output_dir, "log", log_prefix + str(alignment_file).split("/")[-1].split(".")[0])
+    with open(log_stub + ".out", "w") as log, open(log_stub + ".err", "w") as err, \
+         resource_pool().reserve(n_workers, mem_budget_gb) as n_workers:
+        try:
+            inputs = [alignment_file] + estimationInputs(tax_tab, cutoff_file, prot_tab, use_salmon_counts, 
+                                                         names_to_reads)
+            parameters = estimationParameters(consensus_cutoff, use_salmon_counts, output_format)
+            if step_is_current(outfile, "estimation", inputs, parameters) & (not rerun_rules):
+                print("Taxonomic placement already complete at", outfile + "; will not re-run step.", file = log)
+                return 0
+            place_taxonomy(tax_tab, cutoff_file, consensus_cutoff, prot_tab, use_salmon_counts, 
+                           names_to_reads, alignment_file, outfile, True, 
+                           mem_budget_gb = mem_budget_gb, n_workers = n_workers, 
+                           reference = reference, log = log, output_format = output_format,
+                           compression = compression)
+            record_step(outfile, "estimation", inputs, parameters, outputs = estimated_taxonomy_files(outfile))
+        except Exception:
+            traceback.print_exc(file = err)
+            return 1
+    return 0
+
+def estimateSamplesTaxonomy(log_prefix, fastas, output_dir, tax_tab, cutoff_file, consensus_cutoff,
+                            prot_tab, use_salmon_counts, names_to_reads, alignment_res, outfiles,
+                            rerun_rules, reference, job_kind, output_format = "tsv",
+                            compression = "none"):
+    """
+    Estimate taxonomy for all samples, running as many samples at once as fit in memory.
+    The memory budget and the CPUs are split evenly between the samples that run together.
+    """
+    if reference is None:
+        reference = ReferenceContext(tax_tab, prot_tab)
+    pool = resource_pool()
+    n_jobs_align = pool.slots(len(alignment_res), max([job_memory_gb(job_kind, sequence_bytes(fasta)) for fasta in fastas] + [0]))
+    n_workers, mem_budget_gb = pool.share(n_jobs_align)
+    est_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(estimateSampleTaxonomy)(log_prefix, output_dir, 
+                                                                                                 tax_tab, cutoff_file, 
+                                                                                                 consensus_cutoff, prot_tab, 
+                                                                                                 use_salmon_counts, 
+                                                                                                 names_to_reads, 
+                                                                                                 alignment_res[t], 
+                                                                                                 outfiles[t], rerun_rules, 
+                                                                                                 mem_budget_gb, n_workers, 
+                                                                                                 reference, output_format,
+                                                                                                 compression) \
+                                                              for t in range(len(alignment_res)))
+    for t in range(len(est_res)):
+        if est_res[t] != 0:
+            print("Taxonomic estimation did not complete successfully for " + str(alignment_res[t]) + 
+                  ". Check log file for details.", flush=True)
+    return est_res
+    
 def manageTaxEstimation(output_dir, mets_or_mags, tax_tab, cutoff_file, consensus_cutoff,
                         prot_tab, use_salmon_counts, names_to_reads, alignment_res,
-                        rerun_rules, samples, sample_dir, pep_ext, nt_ext, perc_mem):
+                        rerun_rules, samples, sample_dir, pep_ext, nt_ext, reference = None,
+                        output_format = "tsv", compression = "none"):
     print("Performing taxonomic estimation steps...", flush=True)
     os.system("mkdir -p " + os.path.join(output_dir, "taxonomy_estimation"))
     outfiles = [os.path.join(output_dir, "taxonomy_estimation", samp + "-estimated-taxonomy.out") for samp in samples]
     
-    if mets_or_mags == "mets":
-        fastas = []
-        for sample in samples:
-            if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext)):
-                fastas.append(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext))
-            elif os.path.isfile(os.path.join(sample_dir, sample + "." + pep_ext)):
-                fastas.append(os.path.join(sample_dir, sample + "." + pep_ext))
-            else:
-                fastas.append(os.path.join(sample_dir, sample + "." + nt_ext))
-    else:
-        fastas = [os.path.join(sample_dir, sample + "." + pep_ext) for sample in samples]
+    fastas = [sampleFasta(sample, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)[0] for sample in samples]
+        
+    estimateSamplesTaxonomy("tax_est_", fastas, output_dir, tax_tab, cutoff_file, consensus_cutoff,
+                            prot_tab, use_salmon_counts, names_to_reads, alignment_res, outfiles,
+                            rerun_rules, reference, job_kind = "estimation",
+                            output_format = output_format, compression = compression)
         
-    MAX_JOBS = min([calc_max_jobs(len(fastas), pathlib.Path(sample).stat().st_size,
-                                 max_mem_per_proc = 5, perc_mem = perc_mem) for sample in fastas])
-    n_jobs_align = min(multiprocessing.cpu_count(), len(alignment_res), max(1, MAX_JOBS))
-    for t in range(len(alignment_res)): 
-        #curr_out = place_taxonomy(tax_tab, cutoff_file, consensus_cutoff,\
-        #                                        prot_tab, use_salmon_counts, names_to_reads,\
-        #                                        alignment_res[t], outfiles[t], rerun_rules)
+class TeeStream:
+    """
+    Wrap the output pipe of an aligner so that the hits read from it by the classifier
+    are also written to a copy (such as a compressed audit file).
+    """
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+        
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        self.copy.write(data)
+        return data
+    
+    def readline(self, size = -1):
+        line = self.stream.readline(size)
+        self.copy.write(line)
+        return line
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+def streamSampleTaxonomy(sample_name, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                         sample_dir, nt_ext, pep_ext, tax_tab, cutoff_file, consensus_cutoff, prot_tab,
+                         use_salmon_counts, names_to_reads, outfile, rerun_rules, mem_budget_gb, n_workers,
+                         reference, output_format = "tsv", keep_alignment_hits = False, compression = "none"):
+    """
+    Align a sample with DIAMOND and classify its hits as they come out of the pipe, so that
+    the tabular alignment file is never written (unless a compressed copy is requested; it
+    is gzipped unless another compression method is chosen). DIAMOND and the classifier
+    split the n_workers CPUs and the memory budget reserved for the sample between them;
+    DIAMOND's parameters are tuned to its part.
+    """
+    align_db = os.path.join(database_dir, "diamond", ref_fasta.strip('.fa') + '.dmnd')
+    fasta, alignment_method = sampleFasta(sample_name, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+    hits_file = os.path.join(output_dir, mets_or_mags + "_full", "diamond", sample_name + ".diamond.out")
+    inputs = [fasta, align_db] + estimationInputs(tax_tab, cutoff_file, prot_tab, use_salmon_counts, names_to_reads)
+    parameters = dict(alignmentParameters(alignment_method, filter_metric), 
+                      keep_alignment_hits = bool(keep_alignment_hits),
+                      **estimationParameters(consensus_cutoff, use_salmon_counts, output_format))
+    if step_is_current(outfile, "streamed_estimation", inputs, parameters, ["diamond"]) & (not rerun_rules):
+        print("Taxonomic estimation file already detected for sample " + sample_name + "; will not re-run step.")
+        return 0
+    
+    print("Aligning and classifying sample " + sample_name + "...", flush = True)
+    diamond_err = open(os.path.join(output_dir,"log","full_diamond_align_" + sample_name + ".err"), "w+")
+    log_stub = os.path.join(output_dir, "log", "tax_est_" + sample_name)
+    hits_copy = None
+    hits_copy_file = compressed_name(hits_file, "gzip" if compression == "none" else compression)
+    ## DIAMOND reads gzipped queries, but not zstd ones ##
+    with decompressed_input(fasta, os.path.join(output_dir, "decompressed"), readable = ["gzip"]) as fasta, \
+         open(log_stub + ".out", "w") as log, open(log_stub + ".err", "w") as err, \
+         resource_pool().reserve(n_workers, mem_budget_gb) as n_workers:
+        diamond_cpus = max(1, min(n_workers - 1, int(round(n_workers * STREAM_DIAMOND_CPU_FRACTION))))
+        n_workers = max(1, n_workers - diamond_cpus)
+        settings = diamondSettings(diamond_cpus, mem_budget_gb * STREAM_DIAMOND_MEM_FRACTION, sequence_bytes(inputs[0]))
+        mem_budget_gb = max(mem_budget_gb - settings[3], mem_budget_gb * (1 - STREAM_DIAMOND_MEM_FRACTION))
+        logDiamondSettings("sample " + sample_name, settings, log)
+        p = subprocess.Popen(diamondArguments(alignment_method, align_db, fasta, filter_metric, settings), 
+                             stdout = subprocess.PIPE, stderr = diamond_err, universal_newlines = True)
+        hits = p.stdout
+        if keep_alignment_hits:
+            os.system("mkdir -p " + os.path.join(output_dir, mets_or_mags + "_full", "diamond"))
+            hits_copy = open_compressed(hits_copy_file, "wt")
+            hits = TeeStream(p.stdout, hits_copy)
+        rc2 = 0
         try:
-            sys.stdout = open(os.path.join(output_dir, "log", "tax_est_" + 
-                                           alignment_res[t].split("/")[-1].split(".")[0] + ".out"), "w")
-            sys.stderr = open(os.path.join(output_dir, "log", "tax_est_" + 
-                                           alignment_res[t].split("/")[-1].split(".")[0] + ".err"), "w")
-            curr_out = place_taxonomy(tax_tab, cutoff_file, consensus_cutoff,\
-                                                    prot_tab, use_salmon_counts, names_to_reads,\
-                                                    alignment_res[t], outfiles[t], rerun_rules)
-        except:
-            print("Taxonomic estimation did not complete successfully. Check log file for details.")
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
+            place_taxonomy(tax_tab, cutoff_file, consensus_cutoff, prot_tab, use_salmon_counts, 
+                           names_to_reads, hits, outfile, True, 
+                           mem_budget_gb = mem_budget_gb, n_workers = n_workers, 
+                           reference = reference, log = log, output_format = output_format,
+                           compression = compression)
+        except Exception:
+            traceback.print_exc(file = err)
+            p.kill()
+            rc2 = 1
+        p.stdout.close()
+        rc1 = p.wait()
+        if hits_copy is not None:
+            hits_copy.close()
+    diamond_err.close()
+    print("Diamond process exited for sample " + str(sample_name) + ".", flush = True)
+    
+    if (rc1 != 0) | (rc2 != 0):
+        if rc1 != 0:
+            print("Diamond did not complete successfully for sample",str(sample_name),"with rc code",str(rc1))
+        for estimated_file in estimated_taxonomy_files(outfile):
+            os.system("rm -f " + estimated_file)
+        if hits_copy is not None:
+            os.system("rm -f " + hits_copy_file)
+        return 1
+    outputs = list(estimated_taxonomy_files(outfile))
+    if keep_alignment_hits:
+        outputs.append(hits_file)
+    record_step(outfile, "streamed_estimation", inputs, parameters, ["diamond"], outputs)
+    return 0
+
+def manageStreamedTaxEstimation(samples, filter_metric, output_dir, ref_fasta, mets_or_mags, database_dir,
+                                sample_dir, nt_ext, pep_ext, tax_tab, cutoff_file, consensus_cutoff, prot_tab,
+                                use_salmon_counts, names_to_reads, rerun_rules, reference = None,
+                                output_format = "tsv", keep_alignment_hits = False, compression = "none"):
+    """
+    Align and classify the samples in streaming mode, splitting the memory budget and the
+    CPUs evenly between the samples that run together.
+    """
+    print("Performing alignment and taxonomic estimation steps...", flush=True)
+    os.system("mkdir -p " + os.path.join(output_dir, "taxonomy_estimation"))
+    outfiles = [os.path.join(output_dir, "taxonomy_estimation", samp + "-estimated-taxonomy.out") for samp in samples]
+    if reference is None:
+        reference = ReferenceContext(tax_tab, prot_tab)
+        
+    scanSamples(samples, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)
+    fastas = [sampleFasta(sample, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)[0] for sample in samples]
+    pool = resource_pool()
+    n_jobs_align = pool.slots(len(samples), max([diamondJobMemory(sequence_bytes(fasta)) / STREAM_DIAMOND_MEM_FRACTION 
+                                                 for fasta in fastas] + [0]))
+    n_workers, mem_budget_gb = pool.share(n_jobs_align)
+    est_res = Parallel(n_jobs=n_jobs_align, prefer="threads")(delayed(streamSampleTaxonomy)(samples[t], filter_metric, 
+                                                                                               output_dir, ref_fasta, 
+                                                                                               mets_or_mags, database_dir, 
+                                                                                               sample_dir, nt_ext, pep_ext, 
+                                                                                               tax_tab, cutoff_file, 
+                                                                                               consensus_cutoff, prot_tab, 
+                                                                                               use_salmon_counts, 
+                                                                                               names_to_reads, outfiles[t], 
+                                                                                               rerun_rules, mem_budget_gb, 
+                                                                                               n_workers, reference, 
+                                                                                               output_format, 
+                                                                                               keep_alignment_hits, 
+                                                                                               compression) \
+                                                              for t in range(len(samples)))
+    for t in range(len(est_res)):
+        if est_res[t] != 0:
+            print("Alignment and taxonomic estimation did not complete successfully for sample " + 
+                  str(samples[t]) + ". Check log files for details.", flush=True)
+    return est_res
         
 def manageCoreTaxEstimation(output_dir, mets_or_mags, tax_tab, cutoff_file, consensus_cutoff,
                             prot_tab, use_salmon_counts, names_to_reads, alignment_res,
-                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, perc_mem):
+                            rerun_rules, samples, sample_dir, pep_ext, nt_ext, reference = None,
+                            output_format = "tsv", compression = "none"):
     print("Performing taxonomic estimation steps...", flush=True)
     os.system("mkdir -p " + os.path.join(output_dir, "core_taxonomy_estimation"))
     outfiles = [os.path.join(output_dir, "core_taxonomy_estimation", samp + "-estimated-taxonomy.out") for samp in samples]
     
-    if mets_or_mags == "mets":
-        fastas = []
-        for sample in samples:
-            if os.path.isfile(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext)):
-                fastas.append(os.path.join(output_dir, mets_or_mags, sample + "." + pep_ext))
-            elif os.path.isfile(os.path.join(sample_dir, sample + "." + pep_ext)):
-                fastas.append(os.path.join(sample_dir, sample + "." + pep_ext))
-            else:
-                fastas.append(os.path.join(sample_dir, sample + "." + nt_ext))
-    else:
-        fastas = [os.path.join(sample_dir, sample + "." + pep_ext) for sample in samples]
+    fastas = [sampleFasta(sample, output_dir, mets_or_mags, sample_dir, nt_ext, pep_ext)[0] for sample in samples]
         
-    MAX_JOBS = min([calc_max_jobs(len(fastas), pathlib.Path(sample).stat().st_size,
-                                 max_mem_per_proc = 10, perc_mem = perc_mem) for sample in fastas])
-    n_jobs_align = min(multiprocessing.cpu_count(), len(alignment_res), MAX_JOBS)
-    for t in range(len(alignment_res)): 
-        try:
-            sys.stdout = open(os.path.join(output_dir, "log", "core_tax_est_" + 
-                                           alignment_res[t].split("/")[-1].split(".")[0] + ".out"), "w")
-            sys.stderr = open(os.path.join(output_dir, "log", "core_tax_est_" + 
-                                           alignment_res[t].split("/")[-1].split(".")[0] + ".err"), "w")
-            curr_out = place_taxonomy(tax_tab, cutoff_file, consensus_cutoff,\
-                                                    prot_tab, use_salmon_counts, names_to_reads,\
-                                                    alignment_res[t], outfiles[t], rerun_rules)
-        except:
-            print("Taxonomic estimation for core genes did not complete successfully. Check log file for details.")
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
+    estimateSamplesTaxonomy("core_tax_est_", fastas, output_dir, tax_tab, cutoff_file, consensus_cutoff,
+                            prot_tab, use_salmon_counts, names_to_reads, alignment_res, outfiles,
+                            rerun_rules, reference, job_kind = "core_estimation",
+                            output_format = output_format, compression = compression)
         
-def manageTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt_ext, use_salmon_counts, rerun_rules):
+def manageTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt_ext, use_salmon_counts, rerun_rules,
+                           compression = "none"):
     print("Performing taxonomic visualization steps...", flush=True)
     out_prefix = output_dir.split("/")[-1]
     sys.stdout = open(os.path.join(output_dir, "log", "tax_vis.out"), "w")
     sys.stderr = open(os.path.join(output_dir, "log", "tax_vis.err"), "w")
     visualize_all_results(out_prefix, output_dir, os.path.join(output_dir, "taxonomy_estimation"), 
-                          sample_dir, pep_ext, nt_ext, use_salmon_counts, rerun_rules)
+                          sample_dir, pep_ext, nt_ext, use_salmon_counts, rerun_rules, compression = compression)
     sys.stdout = sys.__stdout__
     sys.stderr = sys.__stderr__
     
 def manageCoreTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt_ext, use_salmon_counts, 
-                               rerun_rules, core = False):
+                               rerun_rules, core = False, compression = "none"):
     print("Performing taxonomic visualization steps...", flush=True)
     out_prefix = output_dir.split("/")[-1]
     sys.stdout = open(os.path.join(output_dir, "log", "core_tax_vis.out"), "w")
@@ -548,20 +1207,18 @@ def manageCoreTaxVisualization(output_dir, mets_or_mags, sample_dir, pep_ext, nt
                           est_dir = os.path.join(output_dir, "core_taxonomy_estimation"), 
                           samples_dir = sample_dir, prot_extension = pep_ext, 
                           nucle_extension = nt_ext, use_counts = use_salmon_counts, rerun = rerun_rules, 
-                          core = core)
+                          core = core, compression = compression)
     #except:
     #    print("Taxonomic visualization of core genes did not complete successfully. Check log files for details.")
     sys.stdout = sys.__stdout__
     sys.stderr = sys.__stderr__
 
-def manageTaxAssignment(samples, mets_or_mags, output_dir, sample_dir, pep_ext, core = False, perc_mem = 0.75):
+def manageTaxAssignment(samples, mets_or_mags, output_dir, sample_dir, pep_ext, core = False):
     if mets_or_mags == "mags":
         print("Performing taxonomic assignment steps...", flush=True)
-        MAX_JOBS = min([calc_max_jobs(len(samples), 
-                                      pathlib.Path(os.path.join(sample_dir, sample + "." + pep_ext)).stat().st_size,
-                                     max_mem_per_proc = 10, perc_mem = perc_mem) 
-                        for sample in samples])
-        n_jobs_viz = min(multiprocessing.cpu_count(), len(samples), max(1,MAX_JOBS))
+        n_jobs_viz = resource_pool().slots(len(samples), max([job_memory_gb("assignment", 
+                                                                            sequence_bytes(os.path.join(sample_dir, sample + "." + pep_ext)))
+                                                              for sample in samples] + [0]))
         try:
             if core:
                 assign_res = Parallel(n_jobs=n_jobs_viz, prefer="threads")(delayed(assignTaxonomy)(samp, output_dir, 
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import functools
+import subprocess
+
+from EUKulele.compression import find_compressed, strip_compression
+
+## THE STEP MANIFEST: WHAT EACH OUTPUT WAS MADE FROM ##
+# The record of an output lives in this folder next to it, under the output's uncompressed name.
+MANIFEST_DIR = ".manifest"
+HASH_BUFFER_BYTES = 2 ** 20
+# The arguments that make each tool print its version.
+TOOL_VERSION_ARGUMENTS = {"diamond": ["--version"], "blastp": ["-version"], "blastx": ["-version"],
+                          "makeblastdb": ["-version"], "TransDecoder.LongOrfs": ["--version"]}
+# Digests of files already hashed by this process, by (path, size, modification time).
+DIGESTS = dict()
+
+def manifest_file(output):
+    output = strip_compression(os.path.abspath(output))
+    return os.path.join(os.path.dirname(output), MANIFEST_DIR, os.path.basename(output) + ".json")
+
+def file_stat(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+def file_digest(filename, known = None):
+    """
+    The BLAKE2 digest of a file's contents. The file is only read if it has changed size or
+    modification time since it was last hashed by this process, or since the known record
+    (with "size", "mtime_ns" and "digest") was made.
+    """
+    size, mtime_ns = file_stat(filename)
+    if (known is not None) and (known.get("size") == size) and (known.get("mtime_ns") == mtime_ns):
+        return known["digest"]
+    key = (os.path.abspath(filename), size, mtime_ns)
+    if key not in DIGESTS:
+        digest = hashlib.blake2b(digest_size = 20)
+        with open(filename, "rb") as infile:
+            for block in iter(lambda: infile.read(HASH_BUFFER_BYTES), b""):
+                digest.update(block)
+        DIGESTS[key] = digest.hexdigest()
+    return DIGESTS[key]
+
+@functools.lru_cache(maxsize = None)
+def tool_version(tool):
+    """
+    The first line a tool prints when asked for its version, or "unavailable".
+    """
+    try:
+        result = subprocess.run([tool] + TOOL_VERSION_ARGUMENTS.get(tool, ["--version"]),
+                                stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                                universal_newlines = True, timeout = 60)
+    except (OSError, subprocess.SubprocessError):
+        return "unavailable"
+    lines = result.stdout.strip().splitlines()
+    if len(lines) == 0:
+        return "unavailable"
+    return lines[0].strip()
+
+def input_files(inputs):
+    return sorted(set([os.path.abspath(find_compressed(curr)) for curr in inputs if curr != ""]))
+
+def step_record(step, inputs, parameters, tools, known = None):
+    """
+    What a step's output depends on: the contents of its input files, its parameters, and
+    the versions of the tools it runs.
+    """
+    record = {"step": step, "inputs": dict(), "parameters": json.loads(json.dumps(parameters)),
+              "tools": dict([(tool, tool_version(tool)) for tool in sorted(set(tools))])}
+    known_inputs = dict()
+    if known is not None:
+        known_inputs = known.get("inputs", dict())
+    for curr in input_files(inputs):
+        if not os.path.isfile(curr):
+            record["inputs"][curr] = None
+            continue
+        size, mtime_ns = file_stat(curr)
+        record["inputs"][curr] = {"size": size, "mtime_ns": mtime_ns,
+                                  "digest": file_digest(curr, known_inputs.get(curr))}
+    return record
+
+def read_manifest(output):
+    try:
+        with open(manifest_file(output)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+def step_is_current(output, step, inputs, parameters = dict(), tools = ()):
+    """
+    Whether an output (found under any compression suffix) was made by the same step from
+    inputs with the same contents, with the same parameters and tool versions, and has not
+    changed size since. Outputs without a manifest record are never current.
+    """
+    known = read_manifest(output)
+    if known is None:
+        return False
+    for curr, size in known.get("outputs", dict()).items():
+        if (not os.path.isfile(curr)) or (os.path.getsize(curr) != size):
+            return False
+    if len(known.get("outputs", dict())) == 0:
+        return False
+    current = step_record(step, inputs, parameters, tools, known)
+    for key in ["step", "parameters", "tools"]:
+        if current[key] != known.get(key):
+            return False
+    known_inputs = known.get("inputs", dict())
+    if sorted(current["inputs"].keys()) != sorted(known_inputs.keys()):
+        return False
+    for curr, entry in current["inputs"].items():
+        if (entry is None) or (known_inputs[curr] is None) or (entry["digest"] != known_inputs[curr]["digest"]):
+            return False
+    return True
+
+def record_step(output, step, inputs, parameters = dict(), tools = (), outputs = None):
+    """
+    Record what a step's output was made from, once the step has finished. The output is
+    found under any compression suffix; outputs lists every file the step made, if there
+    are others.
+    """
+    if outputs is None:
+        outputs = [output]
+    record = step_record(step, inputs, parameters, tools)
+    record["outputs"] = dict()
+    for curr in outputs:
+        curr = os.path.abspath(find_compressed(curr))
+        if os.path.isfile(curr):
+            record["outputs"][curr] = os.path.getsize(curr)
+    filename = manifest_file(output)
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    with open(filename + ".tmp", "w") as outfile:
+        json.dump(record, outfile, indent = 1, sort_keys = True)
+    os.replace(filename + ".tmp", filename)
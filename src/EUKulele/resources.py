@@ -0,0 +1,225 @@
+import os
+import math
+import functools
+import threading
+import contextlib
+
+## WHERE THE KERNEL REPORTS MEMORY AND CONTROL GROUPS ##
+MEMINFO_FILE = "/proc/meminfo"
+PROC_CGROUP_FILE = "/proc/self/cgroup"
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Limits at or above this are how cgroup v1 says "no limit".
+UNLIMITED_BYTES = 2 ** 60
+BYTES_PER_GB = 1024 ** 3
+
+def read_value(filename):
+    try:
+        with open(filename) as infile:
+            return infile.read().strip()
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize = None)
+def cgroup_paths():
+    """
+    The control groups this process belongs to, by controller name; "" is the key of the
+    unified (cgroup v2) hierarchy.
+    """
+    paths = dict()
+    contents = read_value(PROC_CGROUP_FILE)
+    if contents is None:
+        return paths
+    for line in contents.splitlines():
+        _, controllers, path = line.split(":", 2)
+        for controller in controllers.split(","):
+            paths[controller] = path.lstrip("/")
+    return paths
+
+def cgroup_dirs(controller, v1_dir):
+    """
+    The control group directories that can hold limits for a controller, from this
+    process's own group up to the root of the hierarchy. Inside a container the group
+    path may not exist in the mounted tree, in which case only the root is checked.
+    """
+    dirs = []
+    paths = cgroup_paths()
+    for path, mount in [(paths.get(controller), os.path.join(CGROUP_ROOT, v1_dir)),
+                        (paths.get(""), CGROUP_ROOT)]:
+        if (path is None) | (not os.path.isdir(mount)):
+            continue
+        curr = os.path.join(mount, path) if path != "" else mount
+        while os.path.normpath(curr) != os.path.normpath(mount):
+            dirs.append(curr)
+            curr = os.path.dirname(curr)
+        dirs.append(mount)
+    return dirs
+
+def meminfo_bytes(field):
+    contents = read_value(MEMINFO_FILE)
+    if contents is None:
+        return None
+    for line in contents.splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    return None
+
+def cgroup_memory_available():
+    """
+    Bytes the memory control group still allows this process, or None without a limit.
+    Reclaimable page cache counts as available, as it does for the host.
+    """
+    available = None
+    for curr in cgroup_dirs("memory", "memory"):
+        for limit_file, usage_file, cache_field in [("memory.max", "memory.current", "inactive_file"),
+                                                    ("memory.limit_in_bytes", "memory.usage_in_bytes",
+                                                     "total_inactive_file")]:
+            limit = read_value(os.path.join(curr, limit_file))
+            usage = read_value(os.path.join(curr, usage_file))
+            if (limit is None) | (usage is None) | (limit == "max"):
+                continue
+            if int(limit) >= UNLIMITED_BYTES:
+                continue
+            cache = 0
+            stats = read_value(os.path.join(curr, "memory.stat"))
+            for line in (stats or "").splitlines():
+                if line.split()[0] == cache_field:
+                    cache = int(line.split()[1])
+            curr_available = max(0, int(limit) - int(usage) + cache)
+            if (available is None) or (curr_available < available):
+                available = curr_available
+    return available
+
+def memory_available_gb():
+    """
+    Memory available to EUKulele in GB: the smaller of what the host has available and
+    what is left under the memory limit of the job's control group (e.g. SLURM or a
+    container). Read anew on each call.
+    """
+    available = meminfo_bytes("MemAvailable")
+    if available is None:
+        available = meminfo_bytes("MemFree")
+    limit = cgroup_memory_available()
+    if (available is None) | ((limit is not None) and (available is not None) and (limit < available)):
+        available = limit
+    if available is None:
+        return 0
+    return available / BYTES_PER_GB
+
+def cgroup_cpu_limit():
+    """
+    The number of CPUs the CPU control group allows, rounded up, or None without a quota.
+    """
+    limit = None
+    for curr in cgroup_dirs("cpu", "cpu"):
+        quota = period = None
+        cpu_max = read_value(os.path.join(curr, "cpu.max"))
+        if cpu_max is not None:
+            quota, period = cpu_max.split()
+        else:
+            quota = read_value(os.path.join(curr, "cpu.cfs_quota_us"))
+            period = read_value(os.path.join(curr, "cpu.cfs_period_us"))
+        if (quota is None) | (period is None) | (quota in ["max", "-1"]):
+            continue
+        curr_limit = max(1, math.ceil(int(quota) / int(period)))
+        if (limit is None) or (curr_limit < limit):
+            limit = curr_limit
+    return limit
+
+@functools.lru_cache(maxsize = None)
+def available_cpus():
+    """
+    The number of CPUs EUKulele may use: those in the process's affinity mask (set by
+    SLURM, taskset, or container runtimes), capped by any control group CPU quota.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(1, cpus)
+
+## MEMORY A JOB IS EXPECTED TO NEED, IN GB PER GB OF ITS INPUT FILE ##
+MEM_PER_GB_INPUT = {"transdecoder": 48, "alignment": 10, "estimation": 5, "core_estimation": 10,
+                    "busco": 40, "assignment": 10}
+# Input files are assumed to be at least this large when estimating memory.
+MIN_INPUT_GB = 0.01
+
+def job_memory_gb(kind, size_in_bytes = 2147483648):
+    """
+    The memory estimated for a job of the given kind on an input file of the given size.
+    """
+    return MEM_PER_GB_INPUT[kind] * max(size_in_bytes / BYTES_PER_GB, MIN_INPUT_GB)
+
+class ResourcePool:
+    """
+    CPU and memory tokens shared by every job that EUKulele launches. A job reserves the
+    CPUs and memory it will use before it starts, and waits until they are free, so jobs
+    run side by side as long as they fit in the pool and never oversubscribe it. A job
+    asking for more than the whole pool is cut down to the pool, and so runs on its own.
+    """
+    def __init__(self, cpus, mem_gb):
+        self.cpus = max(1, int(cpus))
+        self.mem_gb = max(0, mem_gb)
+        self.free_cpus = self.cpus
+        self.free_mem_gb = self.mem_gb
+        self.condition = threading.Condition()
+
+    def slots(self, n_jobs, mem_per_job_gb = 0):
+        """
+        How many of n_jobs jobs can run side by side: no more than there are CPUs, and
+        no more than fit in memory, but always at least one.
+        """
+        fit = n_jobs
+        if mem_per_job_gb > 0:
+            fit = math.floor(self.mem_gb / mem_per_job_gb)
+        return max(1, min(n_jobs, self.cpus, fit))
+
+    def share(self, n_slots):
+        """
+        The CPUs and memory (in GB) of each job when the pool is split between n_slots jobs.
+        """
+        return max(1, self.cpus // max(1, n_slots)), self.mem_gb / max(1, n_slots)
+
+    @contextlib.contextmanager
+    def reserve(self, cpus = 1, mem_gb = 0):
+        """
+        Hold CPUs and memory (in GB) from the pool for the duration of a with block, waiting
+        until enough are free. Yields the number of CPUs held.
+        """
+        cpus = min(max(1, int(cpus)), self.cpus)
+        mem_gb = min(max(0, mem_gb), self.mem_gb)
+        with self.condition:
+            self.condition.wait_for(lambda: (self.free_cpus >= cpus) & (self.free_mem_gb >= mem_gb))
+            self.free_cpus -= cpus
+            self.free_mem_gb -= mem_gb
+        try:
+            yield cpus
+        finally:
+            with self.condition:
+                self.free_cpus += cpus
+                self.free_mem_gb += mem_gb
+                self.condition.notify_all()
+
+POOL = None
+
+def configure_pool(cpus = None, perc_mem = 0.75):
+    """
+    Set up the resource pool: the given number of CPUs (all available ones by default),
+    and the given fraction of the memory that is available now.
+    """
+    global POOL
+    if cpus is None:
+        cpus = available_cpus()
+    POOL = ResourcePool(int(cpus), memory_available_gb() * float(perc_mem))
+    return POOL
+
+def resource_pool():
+    """
+    The resource pool that jobs reserve CPUs and memory from, set up with the defaults if
+    configure_pool has not been called.
+    """
+    if POOL is None:
+        configure_pool()
+    return POOL
@@ -1,15 +1,58 @@
 #!/usr/bin/env python
 import ujson
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 import yaml
-import chardet
+from chardet import UniversalDetector
 import argparse
 import multiprocessing
+import collections
 import os
-from joblib import Parallel, delayed
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 import EUKulele
+from EUKulele.compression import compression_of, compressed_name, compressed_variants, find_compressed
+from EUKulele.compression import open_compressed
+from scripts.create_protein_table import hash_protein_ids, protein_index_paths
+
+# Parsed alignment chunks (and the intermediate frames built while classifying them)
+# take roughly this many times the size of the text they were read from.
+CHUNK_MEMORY_FACTOR = 12
+MIN_CHUNKSIZE = 10 ** 4
+# Chunks classified on a worker pool are held in memory up to this many times at once: the
+# chunk being read, the chunk being dispatched, and the workers' copies of the batches in flight.
+POOL_CHUNK_COPIES = 3
+# Each chunk is split into up to this many batches per worker, so that a slow batch does not
+# leave the other workers idle, but not into batches of fewer rows than this.
+BATCHES_PER_WORKER = 4
+MIN_BATCH_ROWS = 2000
+# Assumed length of a tabular alignment line when reading hits from a stream.
+STREAM_LINE_BYTES = 120
+# Tabular alignment columns requested from the aligners, the only ones classification reads.
+# They sit in the same place in the default 12-column tabular output.
+ALIGNMENT_COLUMNS = ['qseqid', 'sseqid', 'pident']
+ALIGNMENT_DTYPES = {0: 'category', 1: 'category', 2: np.float32}
+
+# Taxonomy tables are cached next to themselves as a pickle with this suffix. The encoding
+# is guessed from at most ENCODING_SAMPLE_BYTES, and cache entries are validated by hashing
+# TAX_CACHE_HASH_BYTES from each end of the table.
+TAX_CACHE_SUFFIX = ".cache.pkl"
+ENCODING_SAMPLE_BYTES = 2 ** 20
+TAX_CACHE_HASH_BYTES = 2 ** 20
+
+# The number of distinct best-hit sets whose classification is remembered by each
+# classification process, at a few hundred bytes apiece.
+CLASSIFICATION_CACHE_SIZE = 2 * 10 ** 5
 
 def tax_placement(pident, tax_cutoffs):
     if pident >= tax_cutoffs['species']:
@@ -24,10 +67,51 @@ def tax_placement(pident, tax_cutoffs):
         out = 'class'; level = 3;
     return out, level
 
-def read_in_taxonomy(infile):
+def taxonomy_cache_key(infile):
+    """
+    Identify the contents of a taxonomy table by its size, modification time, and a hash of
+    its first and last blocks, without reading the whole file.
+    """
+    stat = os.stat(infile)
+    digest = hashlib.sha1()
     with open(infile, 'rb') as f:
-        result = chardet.detect(f.read())
-    tax_out = pd.read_csv(infile, sep='\t',encoding=result['encoding'])
+        digest.update(f.read(TAX_CACHE_HASH_BYTES))
+        if stat.st_size > TAX_CACHE_HASH_BYTES:
+            f.seek(max(TAX_CACHE_HASH_BYTES, stat.st_size - TAX_CACHE_HASH_BYTES))
+            digest.update(f.read())
+    return (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+def detect_encoding(infile, sample_bytes = ENCODING_SAMPLE_BYTES):
+    """
+    Guess the encoding of a file from at most sample_bytes of its beginning.
+    """
+    detector = UniversalDetector()
+    with open(infile, 'rb') as f:
+        while (f.tell() < sample_bytes) & (not detector.done):
+            line = f.readline()
+            if not line:
+                break
+            detector.feed(line)
+    detector.close()
+    return detector.result['encoding']
+
+def read_in_taxonomy(infile):
+    """
+    Read and column-filter a taxonomy table, reusing the cached copy saved next to it by
+    a previous run as long as the table has not changed since.
+    """
+    cache_file = infile + TAX_CACHE_SUFFIX
+    cache_key = taxonomy_cache_key(infile)
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['key'] == cache_key:
+                return cached['table']
+        except Exception:
+            pass
+    
+    tax_out = pd.read_csv(infile, sep='\t',encoding=detect_encoding(infile))
     classes = ['supergroup','division','class','order','family','genus','species']
     for c in tax_out.columns:
         if c.lower() in classes:
@@ -35,6 +119,15 @@ def read_in_taxonomy(infile):
                 tax_out = tax_out.loc[:,~(tax_out.columns == c)]
     tax_out.columns = tax_out.columns.str.lower()
     tax_out = tax_out.set_index('source_id')
+    
+    ## The cache is only an optimization; skip it if the reference directory is read-only ##
+    try:
+        tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'key': cache_key, 'table': tax_out}, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
     return tax_out
 
 def read_in_tax_cutoffs(yamlfile):
@@ -42,11 +135,58 @@ def read_in_tax_cutoffs(yamlfile):
         co_out = yaml.safe_load(stream)
     return co_out
 
+class ProteinIndex(collections.namedtuple("ProteinIndex", ["keys", "taxa", "source_ids"])):
+    """
+    The binary protein index. When it is sent to a worker process, its memory-mapped arrays
+    are mapped again from their files rather than copied.
+    """
+    def __reduce__(self):
+        if is_memory_mapped(self):
+            return (open_protein_index, (self.keys.filename, self.taxa.filename, self.source_ids))
+        return (ProteinIndex, tuple(self))
+
+def is_memory_mapped(pmap):
+    """
+    Whether a protein map is the binary protein index mapped from its files, which worker
+    processes share rather than copy.
+    """
+    return isinstance(pmap, ProteinIndex) and isinstance(pmap.keys, np.memmap) and \
+           isinstance(pmap.taxa, np.memmap)
+
+def open_protein_index(keys_file, taxa_file, source_ids):
+    return ProteinIndex(np.load(keys_file, mmap_mode='r'), np.load(taxa_file, mmap_mode='r'), source_ids)
+
 def read_in_protein_map(protjson):
+    """
+    Read the protein map, preferring the memory-mapped binary index written alongside the
+    JSON map by createProteinTable, as long as it is not older than the JSON map.
+    """
+    keys_file, taxa_file, source_ids_file = protein_index_paths(protjson)
+    if all([os.path.isfile(curr) for curr in [keys_file, taxa_file, source_ids_file]]):
+        if (not os.path.isfile(protjson)) or (os.path.getmtime(keys_file) >= os.path.getmtime(protjson)):
+            with open(source_ids_file, 'r') as f:
+                source_ids = np.array(f.read().splitlines(), dtype=object)
+            return open_protein_index(keys_file, taxa_file, source_ids)
     with open(protjson, 'rb') as f:
         pout = ujson.load(f)
     return pout
 
+def map_protein_ids(sseqid, pmap):
+    """
+    Look up the source ID of each protein ID in a Series, in either the JSON protein map or
+    the binary protein index; proteins that are not in the map get NaN.
+    """
+    if not isinstance(pmap, ProteinIndex):
+        return sseqid.map(pmap)
+    if len(pmap.keys) == 0:
+        return pd.Series(np.nan, index=sseqid.index, dtype=object)
+    protein_codes, proteins = pd.factorize(sseqid)
+    hashes = hash_protein_ids(proteins)
+    positions = np.minimum(np.searchsorted(pmap.keys, hashes), len(pmap.keys) - 1)
+    found = np.asarray(pmap.keys[positions] == hashes)
+    source_ids = np.append(np.where(found, pmap.source_ids[pmap.taxa[positions]], np.nan), np.nan)
+    return pd.Series(source_ids[protein_codes], index=sseqid.index)
+
 def gen_dict(tax_table):
     classes = ['supergroup','division','class','order','family','genus','species']
     tax_table["Classification"] = ""
@@ -60,146 +200,583 @@ def gen_dict(tax_table):
     return(dict(zip(tax_table.index, tax_table["Classification"])))
 
 def gen_reads_dict(names_to_reads):
-    names_to_reads = pd.read_csv(names_to_reads,header=0,sep="\t")
-    return(dict(zip(names_to_reads["TranscriptNames"],names_to_reads["NumReads"])))
+    """
+    Read the salmon read counts into a Series indexed by transcript name. As with a dict,
+    the last count listed for a repeated transcript name wins.
+    """
+    names_to_reads = pd.read_csv(names_to_reads,header=0,sep="\t",usecols=["TranscriptNames","NumReads"])
+    names_to_reads = names_to_reads.drop_duplicates("TranscriptNames", keep="last")
+    return names_to_reads.set_index("TranscriptNames")["NumReads"]
+
+def query_counts(qseqid, namestoreads):
+    """
+    Look up the read count of the transcript behind each alignment query. The transcript name
+    (the query name up to its first "." or ":") is worked out once per distinct query, and
+    transcripts without a count get 0.
+    """
+    query_codes, queries = pd.factorize(qseqid)
+    transcripts = pd.Series(queries).str.split(r"[.:]", n=1, regex=True).str[0]
+    counts = np.append(namestoreads.to_numpy(), 0)[namestoreads.index.get_indexer(transcripts)]
+    return counts[query_codes]
 
-def lca(full_classifications):
+def placement_levels(pident, tax_cutoffs):
+    """
+    Vectorized counterpart of tax_placement: the name and depth of the most specific
+    taxonomic level supported by each percent identity in an array.
+    """
+    conditions = [pident >= tax_cutoffs['species'], pident >= tax_cutoffs['genus'],
+                  pident >= tax_cutoffs['family'], pident >= tax_cutoffs['order']]
+    names = np.select(conditions, ['species','genus','family','order'], default='class')
+    depths = np.select(conditions, [7,6,5,4], default=3)
+    return names, depths
+
+def gen_lineage_codes(tax_table):
+    """
+    Intern the taxonomy as an integer matrix with one row per source ID and one column per
+    level from supergroup to species, so that lineages can be truncated and compared as
+    arrays. As in gen_dict, only the levels filled in for every source ID are used, in order
+    from supergroup down. Code 0 marks a level absent from a lineage; every other code
+    indexes the taxon name in names.
+    """
     classes = ['supergroup','division','class','order','family','genus','species']
-    full_classifications_split = [[str(subtax).strip() for subtax in curr.split(";")] for curr in full_classifications]
-    length_classes = [len(curr) for curr in full_classifications_split]
-    if len(set(length_classes)) != 1:
-        print("Error: not all classifications at at the same taxonomic level.", flush = True)
-        sys.exit(1)
-    for l in reversed(range(length_classes[0])):
-        set_classifications = [curr[l] for curr in full_classifications_split]
-        if len(set(set_classifications)) == 1:
-            return classes[l], set_classifications[0], "; ".join(full_classifications_split[0][0:(l+1)])
-    return "","","" # if there are no common ancestors
-
-def match_maker(dd, consensus_cutoff, tax_dict, use_counts, tax_cutoffs):
-    ambiguous = 0 # we assume unambiguous
-    md = dd.pident.max()
-    transcript_name = set(list(dd["qseqid"]))
-    if len(transcript_name) > 1:
-        print("More than 1 transcript name included in the group.", flush = True)
-    transcript_name = list(transcript_name)[0]
-    ds = list(set(dd[dd.pident==md]['ssqid_TAXID']))
-    counts = list(set(dd[dd.pident==md]['counts']))
-    if (len(counts) >= 1):
-        chosen_count = counts[0]
-    else:
-        chosen_count = 0
-    assignment, level = tax_placement(md, tax_cutoffs) # most specific taxonomic level assigned
-    if len(ds)==1:
-        if ds[0] not in tax_dict:
-            return(pd.DataFrame(columns=['transcript_name','classification_level', 'full_classification', 
-                                         'classification', 'max_pid', 'counts', 'ambiguous']))
-        full_classification = str(tax_dict[ds[0]]).split(";")[0:level]
-        best_classification = full_classification[len(full_classification) - 1] # the most specific taxonomic level we can classify by
-        full_classification = '; '.join(full_classification) # the actual assignments based on that
-    else:
-        classification_0 = []
-        full_classification_0 = []
-        for d in ds:
-            if d not in tax_dict:
-                return(pd.DataFrame(columns=['transcript_name','classification_level', 'full_classification', 
-                                             'classification', 'max_pid', 'counts', 'ambiguous']))
-            d_full_class = str(tax_dict[d]).split(";")[0:level]
-            classification_0.append(d_full_class[len(d_full_class) - 1]) # the most specific taxonomic level we can classify by
-            full_classification_0.append('; '.join(d_full_class)) # the actual assignments based on that
-        entries = list(set(full_classification_0))
-        if len(entries) == 1:
-            best_classification = classification_0[0]
-            full_classification = full_classification_0[0]
-        else:
-            ambiguous = 1
-            best_frac = 0
-            best_one_class = 0
-            best_full_class = 0
-            for e in entries:
-                curr_frac = len(np.where(full_classification_0 == e)) / len(full_classification_0)
-                if (isinstance(curr_frac, float)) & (curr_frac > best_frac):
-                    best_frac = curr_frac
-                    best_full_class = e
-                    best_one_class = str(e.split(";")[len(e.split(";")) - 1]).strip()
-            if best_frac >= consensus_cutoff:
-                best_classification = best_one_class
-                full_classification = best_full_class
-            else:
-                assignment, best_classification, full_classification = lca(full_classification_0)
+    tax_table = tax_table.loc[:,~tax_table.columns.duplicated()]
+    tax_table = tax_table.loc[~tax_table.index.duplicated(keep='last')]
+    levels = [c for c in classes if (tax_table[c].notna() & 
+                                     (tax_table[c].astype(str).str.lower() != "nan")).all()]
+    values = np.stack([tax_table[c].astype(str).str.strip().to_numpy() for c in levels], axis=1) \
+             if len(levels) > 0 else np.empty((len(tax_table.index), 0), dtype=object)
+    codes, names = pd.factorize(values.ravel())
+    codes[values.ravel() == ""] = -1
+    lineage_codes = np.zeros((len(tax_table.index), len(classes)), dtype=np.int32)
+    lineage_codes[:,:len(levels)] = (codes + 1).reshape(values.shape)
+    return {'source_ids': tax_table.index, 'codes': lineage_codes, 
+            'names': np.concatenate([np.array([""], dtype=object), np.asarray(names, dtype=object)])}
 
-    if use_counts == 1:
-        return pd.DataFrame([[transcript_name, assignment, full_classification, best_classification, md,\
-                              chosen_count, ambiguous]],\
-                       columns=['transcript_name','classification_level', 'full_classification', 
-                                'classification', 'max_pid', 'counts', 'ambiguous'])
-    else:
-        return pd.DataFrame([[transcript_name, assignment, full_classification, best_classification, md, ambiguous]],\
-                       columns=['transcript_name', 'classification_level', 'full_classification', 
-                                'classification', 'max_pid', 'ambiguous'])
+def lineage_strings(codes, names):
+    """
+    Build the full classification string and the most specific classification for each
+    row of a lineage code matrix, formatting each distinct lineage only once.
+    """
+    distinct_lineages, inverse = np.unique(codes, axis=0, return_inverse=True)
+    full_classification = []
+    classification = []
+    for lineage in distinct_lineages:
+        lineage = names[lineage[lineage != 0]]
+        full_classification.append("; ".join(lineage))
+        classification.append(lineage[-1] if len(lineage) > 0 else "")
+    inverse = inverse.reshape(-1)
+    return np.array(full_classification, dtype=object)[inverse], np.array(classification, dtype=object)[inverse]
 
-def apply_parallel(grouped_data, match_maker, consensus_cutoff, tax_dict, use_counts, tax_cutoffs):
-    resultdf = Parallel(n_jobs=multiprocessing.cpu_count(), prefer="threads")(delayed(match_maker)(group, consensus_cutoff, 
-                                                                                                   tax_dict, use_counts, 
-                                                                                                   tax_cutoffs) for name, group \
-                                                                              in grouped_data)
-    return pd.concat(resultdf)
+def classify_taxon_sets(set_ids, rows, depths, lineages, consensus_cutoff):
+    """
+    Classify sets of best hits, given as the set each hit belongs to (numbered from 0), the
+    taxonomy table row of its source, and the depth its percent identity supports. Lineages
+    are truncated to that depth, and each set is assigned the lineage all of its hits share,
+    the lineage held by at least consensus_cutoff of them, or otherwise their lowest common
+    ancestor. Returns the assigned lineage codes, classification level, and ambiguity of
+    each set.
+    """
+    classes = ['supergroup','division','class','order','family','genus','species']
+    first_hit = np.unique(set_ids, return_index=True)[1]
+    codes = lineages['codes'][rows]
+    codes[np.arange(len(classes))[np.newaxis,:] >= depths[:,np.newaxis]] = 0
+    distinct_lineages, lineage_ids = np.unique(codes, axis=0, return_inverse=True)
+    
+    ## Count the votes for each distinct truncated lineage of each set ##
+    votes = pd.DataFrame({'query': set_ids, 'lineage': lineage_ids.reshape(-1)})
+    votes = votes.groupby(['query','lineage'], sort=False).size().rename('votes').reset_index()
+    votes_by_query = votes.groupby('query', sort=False)['votes']
+    votes['frac'] = votes['votes'] / votes_by_query.transform('sum')
+    votes['n_lineages'] = votes_by_query.transform('size')
+    top = votes.loc[votes.groupby('query')['frac'].idxmax()]
+    
+    assigned = distinct_lineages[top['lineage'].to_numpy()]
+    classification_level = np.array(classes, dtype=object)[depths[first_hit] - 1]
+    consensus = ((top['n_lineages'] == 1) | (top['frac'] >= consensus_cutoff)).to_numpy()
+    
+    ## Fall back to the lowest common ancestor where there is no consensus ##
+    lca_sets = np.flatnonzero(~consensus)
+    if len(lca_sets) > 0:
+        in_lca = np.isin(set_ids, lca_sets)
+        by_set = pd.DataFrame(codes[in_lca], columns=classes).groupby(set_ids[in_lca])
+        lowest = by_set.min().to_numpy()
+        agree = (lowest == by_set.max().to_numpy()) & (lowest != 0)
+        lca_depth = np.where(agree.any(axis=1), len(classes) - 1 - np.argmax(agree[:,::-1], axis=1), -1)
+        lca_lineages = codes[first_hit[lca_sets]]
+        lca_lineages[np.arange(len(classes))[np.newaxis,:] > lca_depth[:,np.newaxis]] = 0
+        assigned[lca_sets] = lca_lineages
+        classification_level[lca_sets] = np.array(classes + [""], dtype=object)[lca_depth]
+    return assigned, classification_level, (top['n_lineages'].to_numpy() > 1).astype(int)
 
-def classify_taxonomy_parallel(df, tax_dict, namestoreads, pdict, consensus_cutoff, tax_cutoffs):
-    chunksize = 2 * 10 ** 6
-    counter = 0
+def taxon_sets(query_ids, rows, depths):
+    """
+    Find the distinct sets of best hits among queries: a query's set is its placement depth
+    together with the sorted taxonomy table rows of its hits. Returns a bytes key for each
+    distinct set, the set of each query, and the hits of one query holding each set (as set
+    numbers, rows, and depths, with rows sorted within each set).
+    """
+    order = np.lexsort((rows, query_ids))
+    sorted_queries = query_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_queries[1:] != sorted_queries[:-1]])
+    n_hits = np.diff(np.r_[starts, len(order)])
     
-    ## Return an empty dataframe if no matches made ##
-    if os.stat(str(df)).st_size == 0:
-        if namestoreads != 0:
-            return pd.DataFrame([[transcript_name, assignment, full_classification, best_classification, 
-                                  md, chosen_count, ambiguous]],\
-                       columns=['transcript_name','classification_level', 'full_classification', 
-                                'classification', 'max_pid', 'counts', 'ambiguous'])
-        else:
-            return pd.DataFrame(columns=['transcript_name', 'classification_level', 'full_classification', 
-                                'classification', 'max_pid', 'ambiguous'])
+    ## One row per query: its depth and its sorted rows, padded with -1 ##
+    keys = np.full((len(starts), n_hits.max() + 1), -1, dtype=np.int64)
+    keys[:,0] = depths[order][starts]
+    keys[sorted_queries, np.arange(len(order)) - np.repeat(starts, n_hits) + 1] = rows[order]
+    distinct_keys, first_query, set_of_query = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    set_keys = [key[:n + 1].tobytes() for key, n in zip(distinct_keys, n_hits[first_query])]
+    
+    set_number = np.full(len(starts), -1)
+    set_number[first_query] = np.arange(len(first_query))
+    representative = set_number[sorted_queries] >= 0
+    set_hits = (set_number[sorted_queries[representative]], rows[order][representative], 
+                depths[order][representative])
+    return set_keys, set_of_query.reshape(-1), set_hits
+
+def classify_hits(hits, lineages, consensus_cutoff, tax_cutoffs, use_counts, cache = None, stats = None):
+    """
+    Classify every query in a frame of alignment hits with a handful of array operations.
+    For each query only the hits with the maximum percent identity are considered. Queries
+    with the same set of best hits get the same classification, so each distinct set is
+    classified once; finished classifications are also kept in cache (an OrderedDict, if
+    given) and evicted least recently used first once it holds CLASSIFICATION_CACHE_SIZE
+    sets. Cache hits and misses are added to stats (a dict or Counter), if given.
+    """
+    classes = ['supergroup','division','class','order','family','genus','species']
+    columns = ['transcript_name','classification_level', 'full_classification', 
+               'classification', 'max_pid', 'counts', 'ambiguous']
+    if use_counts != 1:
+        columns.remove('counts')
         
-    for chunk in pd.read_csv(str(df), sep = '\t', header = None, chunksize=chunksize):
-        chunk.columns = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen', 'qstart', 
-                         'qend', 'sstart', 'send', 'evalue', 'bitscore']
-        chunk['ssqid_TAXID']=chunk.sseqid.map(pdict)
-        chunk = chunk[['qseqid','pident', 'evalue', 'bitscore', 'ssqid_TAXID']]
-        if namestoreads != 0:
-            chunk['counts']=[namestoreads[curr.split(".")[0].split(":")[0]] if curr.split(".")[0].split(":")[0] in 
-                             namestoreads else 0 for curr in chunk.qseqid]
-            use_counts = 1
+    max_pid = hits.groupby('qseqid', sort=False)['pident'].transform('max')
+    best = hits.loc[hits['pident'] == max_pid, ['qseqid','pident','ssqid_TAXID','counts']]
+    best = best.drop_duplicates(['qseqid','ssqid_TAXID'])
+    
+    ## Queries with a best hit that is not in the taxonomy table cannot be placed ##
+    rows = lineages['source_ids'].get_indexer(best['ssqid_TAXID'])
+    placed = ~best['qseqid'].isin(best.loc[rows < 0, 'qseqid']).to_numpy()
+    best = best.loc[placed]
+    rows = rows[placed]
+    if len(best.index) == 0:
+        return pd.DataFrame(columns=columns)
+    
+    query_ids, query_names = pd.factorize(best['qseqid'])
+    first_hit = np.unique(query_ids, return_index=True)[1]
+    depths = placement_levels(best['pident'].to_numpy(), tax_cutoffs)[1]
+    set_keys, set_of_query, set_hits = taxon_sets(query_ids, rows, depths)
+    
+    ## Look up each distinct set in the cache, and classify the ones that are missing ##
+    if cache is None:
+        cache = collections.OrderedDict()
+    set_keys = [(key, consensus_cutoff) for key in set_keys]
+    outcomes = [cache.get(key) for key in set_keys]
+    missing = np.array([outcome is None for outcome in outcomes])
+    if missing.any():
+        missing_sets = np.flatnonzero(missing)
+        missing_hits = np.isin(set_hits[0], missing_sets)
+        renumbered = np.cumsum(missing) - 1
+        assigned, levels, ambiguous = classify_taxon_sets(renumbered[set_hits[0][missing_hits]], 
+                                                          set_hits[1][missing_hits], set_hits[2][missing_hits],
+                                                          lineages, consensus_cutoff)
+        for i, curr in enumerate(missing_sets):
+            outcomes[curr] = (assigned[i].tobytes(), levels[i], ambiguous[i])
+            cache[set_keys[curr]] = outcomes[curr]
+    for curr in np.flatnonzero(~missing):
+        cache.move_to_end(set_keys[curr])
+    while len(cache) > CLASSIFICATION_CACHE_SIZE:
+        cache.popitem(last = False)
+    if stats is not None:
+        stats['cache_hits'] = stats.get('cache_hits', 0) + int((~missing).sum())
+        stats['cache_misses'] = stats.get('cache_misses', 0) + int(missing.sum())
+    
+    assigned = np.frombuffer(b"".join([outcome[0] for outcome in outcomes]), 
+                             dtype=lineages['codes'].dtype).reshape(len(outcomes), len(classes))
+    full_classification, classification = lineage_strings(assigned, lineages['names'])
+    queries = pd.DataFrame({'transcript_name': np.asarray(query_names), 
+                            'classification_level': np.array([outcome[1] for outcome in outcomes], 
+                                                             dtype=object)[set_of_query],
+                            'full_classification': full_classification[set_of_query], 
+                            'classification': classification[set_of_query],
+                            'max_pid': best['pident'].to_numpy()[first_hit], 
+                            'counts': best['counts'].to_numpy()[first_hit],
+                            'ambiguous': np.array([outcome[2] for outcome in outcomes])[set_of_query]})
+    return queries[columns]
+
+def alignment_chunksize(alignment_file, mem_budget_gb, sample_lines = 1000):
+    """
+    Estimate how many alignment rows fit in the memory budget from the mean line length
+    at the start of the file. Streams and compressed files cannot be sampled cheaply ahead
+    of reading, so for those a typical tabular line length is assumed.
+    """
+    line_lengths = [STREAM_LINE_BYTES]
+    if (not hasattr(alignment_file, 'read')) and (compression_of(alignment_file) is None):
+        with open(alignment_file, 'r') as f:
+            line_lengths = [len(line) for _, line in zip(range(sample_lines), f)]
+    bytes_per_row = max(1, np.mean(line_lengths)) * CHUNK_MEMORY_FACTOR
+    return max(MIN_CHUNKSIZE, int(float(mem_budget_gb) * 1024 ** 3 / bytes_per_row))
+
+def concat_hits(first, second):
+    """
+    Concatenate two frames of alignment hits, merging the categories of their ID columns
+    so that they stay categorical. Categories the first frame no longer uses are dropped,
+    so that they do not pile up as hits are carried from chunk to chunk.
+    """
+    hits = pd.DataFrame(index = pd.RangeIndex(len(first.index) + len(second.index)))
+    for col in first.columns:
+        if isinstance(first[col].dtype, pd.CategoricalDtype):
+            hits[col] = union_categoricals([first[col].cat.remove_unused_categories(), second[col]])
         else:
-            chunk['counts'] = [0] * len(chunk.qseqid) # if no reads dict, each count is just assumed to be 0 and isn't recorded later
-            use_counts = 0
-            
-        if counter == 0:
-            outdf = apply_parallel(chunk.groupby('qseqid'), match_maker, 
-                                   consensus_cutoff, tax_dict, use_counts, tax_cutoffs)
+            hits[col] = np.concatenate([first[col].to_numpy(), second[col].to_numpy()])
+    return hits
+
+def alignment_chunks(alignment_file, mem_budget_gb = 2):
+    """
+    Stream an alignment file (a path, which may be compressed, or an open text stream such
+    as an aligner's output pipe) in chunks sized from a memory budget. The hits of the last query in each chunk
+    are carried over to the next chunk, so that every query is classified from all of its
+    hits; this relies on the hits of a query being contiguous, as they are in DIAMOND and
+    BLAST tabular output.
+    """
+    chunksize = alignment_chunksize(alignment_file, mem_budget_gb)
+    if (not hasattr(alignment_file, 'read')) and (compression_of(alignment_file) is not None):
+        with open_compressed(alignment_file) as alignment_stream:
+            yield from alignment_chunks(alignment_stream, mem_budget_gb)
+        return
+    carry = None
+    try:
+        reader = pd.read_csv(alignment_file, sep = '\t', header = None, chunksize = chunksize,
+                             usecols = list(ALIGNMENT_DTYPES.keys()), dtype = ALIGNMENT_DTYPES)
+    except pd.errors.EmptyDataError:
+        return
+    for chunk in reader:
+        if carry is not None:
+            chunk = concat_hits(carry, chunk)
+        queries = chunk[0].to_numpy()
+        query_starts = np.flatnonzero(queries[1:] != queries[:-1]) + 1
+        if len(query_starts) == 0:
+            carry = chunk
+            continue
+        carry = chunk.iloc[query_starts[-1]:].copy()
+        yield chunk.iloc[:query_starts[-1]].copy()
+    if carry is not None:
+        yield carry
+
+def best_hits(chunk):
+    """
+    Reduce a raw chunk of alignment hits to the rows that classification depends on: the
+    hits with each query's maximum percent identity, one per subject, with only the query,
+    subject and percent identity columns.
+    """
+    chunk = chunk[[0, 1, 2]]
+    chunk.columns = ALIGNMENT_COLUMNS
+    max_pid = chunk.groupby('qseqid', sort=False, observed=True)['pident'].transform('max')
+    return chunk.loc[chunk['pident'] == max_pid].drop_duplicates(['qseqid', 'sseqid'])
+
+def classify_chunk(chunk, reference):
+    """
+    Reduce a raw chunk of alignment hits to each query's best hits, attach their source IDs
+    and counts, and classify the queries. Returns the classifications along with the number
+    of alignment rows read and kept.
+    """
+    stats = {'rows_in': len(chunk.index)}
+    chunk = best_hits(chunk)
+    chunk['ssqid_TAXID'] = map_protein_ids(chunk.sseqid, reference['pdict'])
+    chunk = chunk.drop_duplicates(['qseqid', 'ssqid_TAXID'])
+    stats['rows_kept'] = len(chunk.index)
+    namestoreads = reference['namestoreads']
+    if namestoreads is not None:
+        chunk['counts'] = query_counts(chunk.qseqid, namestoreads)
+    else:
+        chunk['counts'] = 0 # if no reads dict, each count is just assumed to be 0 and isn't recorded later
+    result = classify_hits(chunk, reference['lineages'], reference['consensus_cutoff'], 
+                           reference['tax_cutoffs'], reference['use_counts'], 
+                           cache = reference['cache'], stats = stats)
+    return result, stats
+
+# Reference tables of a classification pool's worker, by key. Each worker registers its
+# pool's reference once when it starts, rather than receiving a pickled copy with every batch.
+_WORKER_REFERENCES = {}
+
+def pool_context():
+    """
+    The way classification workers are started. Samples are classified from threads, and
+    forking a multithreaded process can deadlock on locks held by other threads and hands
+    other samples' open compressor pipes to the workers, so workers are started from a
+    fork server where there is one, and spawned otherwise. The fork server imports this
+    module once, so that workers forked from it start without importing it again.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["__main__", __name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def _register_reference(key, reference):
+    _WORKER_REFERENCES[key] = reference
+
+def _classify_batch(batch, key):
+    return classify_chunk(batch, _WORKER_REFERENCES[key])
+
+def query_batches(chunk, n_batches):
+    """
+    Split a chunk of alignment hits into roughly equal batches of whole queries.
+    """
+    queries = chunk[0].to_numpy()
+    query_starts = np.flatnonzero(queries[1:] != queries[:-1]) + 1
+    targets = np.linspace(0, len(queries), n_batches + 1)[1:-1]
+    cuts = query_starts[np.minimum(np.searchsorted(query_starts, targets), len(query_starts) - 1)] \
+           if len(query_starts) > 0 else []
+    bounds = [0] + sorted(set(cuts)) + [len(queries)]
+    for batch_start, batch_end in zip(bounds[:-1], bounds[1:]):
+        yield chunk.iloc[batch_start:batch_end]
+
+def classify_in_pool(chunks, reference, n_workers):
+    """
+    Classify alignment chunks on a pool of worker processes. Each chunk is split into
+    several batches of whole queries per worker, and a new batch is dispatched as each of
+    the oldest results comes back, so the next chunk's batches are already running while
+    the last chunk's results drain. No more than one chunk's worth of rows is in flight,
+    so at most POOL_CHUNK_COPIES copies of a chunk are in memory. Results are yielded in
+    file order.
+    """
+    key = id(reference)
+    pool = ProcessPoolExecutor(n_workers, mp_context = pool_context(), initializer = _register_reference, 
+                               initargs = (key, reference))
+    try:
+        pending = collections.deque()
+        rows_in_flight = 0
+        for chunk in chunks:
+            n_batches = max(n_workers, min(n_workers * BATCHES_PER_WORKER, len(chunk.index) // MIN_BATCH_ROWS))
+            for batch in query_batches(chunk, n_batches):
+                pending.append((pool.submit(_classify_batch, batch, key), len(batch.index)))
+                rows_in_flight = rows_in_flight + len(batch.index)
+                while rows_in_flight > len(chunk.index):
+                    future, rows = pending.popleft()
+                    rows_in_flight = rows_in_flight - rows
+                    yield future.result()
+        while len(pending) > 0:
+            yield pending.popleft()[0].result()
+    finally:
+        pool.shutdown()
+
+def classify_taxonomy_parallel(df, lineages, namestoreads, pdict, consensus_cutoff, tax_cutoffs,
+                               mem_budget_gb = 2, n_workers = 1, stats = None):
+    """
+    Classify the queries of an alignment file, yielding the results chunk by chunk in file
+    order so that they can be written out without holding the whole table in memory. The
+    row counts of each chunk are added to stats (a Counter), if one is given.
+    """
+    reference = {'lineages': lineages, 'pdict': pdict, 'namestoreads': namestoreads, 
+                 'consensus_cutoff': consensus_cutoff, 'tax_cutoffs': tax_cutoffs,
+                 'use_counts': int(namestoreads is not None), 'cache': collections.OrderedDict()}
+    ## Samples estimated side by side run in threads; hand their chunks to worker processes ##
+    ## even with a single worker so that they do not contend for the interpreter lock. ##
+    ## Workers share the memory-mapped protein index; a JSON protein map would be copied ##
+    ## into every one of them, so it is only used in this process. ##
+    use_pool = (n_workers > 1) | (threading.current_thread() is not threading.main_thread())
+    if use_pool & (not is_memory_mapped(pdict)):
+        print("The protein map has no binary index (see create_protein_table.py); " + 
+              "classifying in a single process.", flush = True)
+        use_pool = False
+    if use_pool:
+        results = classify_in_pool(alignment_chunks(df, float(mem_budget_gb) / POOL_CHUNK_COPIES), 
+                                   reference, n_workers)
+    else:
+        results = (classify_chunk(chunk, reference) for chunk in alignment_chunks(df, mem_budget_gb))
+    n_results = 0
+    for result, chunk_stats in results:
+        if stats is not None:
+            stats.update(chunk_stats)
+        n_results = n_results + 1
+        yield result
+        
+    ## Return an empty dataframe if no matches made ##
+    if n_results == 0:
+        if namestoreads is not None:
+            yield pd.DataFrame(columns=['transcript_name','classification_level', 'full_classification', 
+                               'classification', 'max_pid', 'counts', 'ambiguous'])
         else:
-            outdf = pd.concat([outdf, apply_parallel(chunk.groupby('qseqid'), 
-                                                     match_maker, consensus_cutoff, tax_dict, 
-                                                     use_counts, tax_cutoffs)], axis = 0)
-        counter = counter + 1
+            yield pd.DataFrame(columns=['transcript_name', 'classification_level', 'full_classification', 
+                               'classification', 'max_pid', 'ambiguous'])
+
+def estimated_taxonomy_files(outfile):
+    """
+    The TSV (compressed or not, whichever is on disk) and Parquet files that the estimated
+    taxonomy of one sample is written to.
+    """
+    return find_compressed(outfile), os.path.splitext(outfile)[0] + ".parquet"
+
+def estimated_taxonomy_exists(outfile, output_format = "tsv"):
+    tsv_file, parquet_file = estimated_taxonomy_files(outfile)
+    if output_format == "tsv":
+        return os.path.isfile(tsv_file)
+    elif output_format == "parquet":
+        return os.path.isfile(parquet_file)
+    return os.path.isfile(tsv_file) & os.path.isfile(parquet_file)
+
+def columnar_taxonomy(classification_df):
+    """
+    Convert estimated taxonomy to the types stored in Parquet: dictionary-encoded lineage
+    columns, with the full classification also split into one column per taxonomic level,
+    and compact numeric columns. Empty classifications become missing values, as they do
+    when the TSV output is read back in.
+    """
+    classes = ['supergroup','division','class','order','family','genus','species']
+    outdf = classification_df.copy()
+    for col in ['classification_level', 'full_classification', 'classification']:
+        outdf[col] = outdf[col].replace("", np.nan).astype("category")
+    lineage_codes = outdf.full_classification.cat.codes.to_numpy()
+    ## A chunk with no classifications at all has an empty (float) category index ##
+    lineage_levels = outdf.full_classification.cat.categories.astype(str).to_series().str.split("; ", expand = True)
+    lineage_levels = lineage_levels.reindex(columns = range(len(classes)))
+    for i, level in enumerate(classes):
+        ## Code -1 (no classification) picks up the missing value appended at the end ##
+        level_names = np.append(lineage_levels[i].to_numpy(dtype=object), np.nan)
+        outdf[level] = pd.Categorical(level_names[lineage_codes])
+    outdf['max_pid'] = outdf.max_pid.astype(np.float32)
+    outdf['ambiguous'] = outdf.ambiguous.astype(np.int8)
     return outdf
 
+def arrow_taxonomy_table(classification_df):
+    """
+    Convert a chunk of estimated taxonomy to an Arrow table whose dictionary columns all use
+    the same index and value types, however many lineages the chunk happens to contain, so
+    that every chunk fits the schema of the Parquet file it is appended to.
+    """
+    table = pyarrow.Table.from_pandas(columnar_taxonomy(classification_df), preserve_index = True)
+    fields = [pyarrow.field(field.name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) 
+              if pyarrow.types.is_dictionary(field.type) else field for field in table.schema]
+    return table.cast(pyarrow.schema(fields, metadata = table.schema.metadata))
+
+def write_estimated_taxonomy(results, outfile, output_format = "tsv", compression = "none"):
+    """
+    Write chunks of estimated taxonomy as TSV (compressed if asked), Parquet, or both,
+    appending each chunk as it arrives. Files are only moved into place once every chunk has
+    been written, and any copy in another format left over from an earlier run is removed
+    so that readers never pick up stale results.
+    """
+    parquet_file = estimated_taxonomy_files(outfile)[1]
+    tsv_file = compressed_name(outfile, compression)
+    tsv_tmp = compressed_name(outfile + ".tmp", compression)
+    write_tsv = output_format in ["tsv", "both"]
+    write_parquet = output_format in ["parquet", "both"]
+    stale_files = [curr for curr in compressed_variants(outfile) if (curr != tsv_file) | (not write_tsv)]
+    if not write_parquet:
+        stale_files.append(parquet_file)
+    for curr_file in stale_files:
+        if os.path.isfile(curr_file):
+            os.remove(curr_file)
+    
+    tsv_writer = None
+    parquet_writer = None
+    first_chunk = True
+    completed = False
+    try:
+        for result in results:
+            if write_tsv:
+                if tsv_writer is None:
+                    tsv_writer = open_compressed(tsv_tmp, "wt")
+                result.to_csv(tsv_writer, sep='\t', header = first_chunk)
+            if write_parquet:
+                table = arrow_taxonomy_table(result)
+                if parquet_writer is None:
+                    parquet_writer = pyarrow.parquet.ParquetWriter(parquet_file + ".tmp", table.schema)
+                parquet_writer.write_table(table.cast(parquet_writer.schema))
+            first_chunk = False
+        completed = True
+    finally:
+        if tsv_writer is not None:
+            tsv_writer.close()
+        if parquet_writer is not None:
+            parquet_writer.close()
+        ## Never leave partly written files behind ##
+        if not completed:
+            for tmp_file in [tsv_tmp, parquet_file + ".tmp"]:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+    if write_tsv:
+        os.replace(tsv_tmp, tsv_file)
+    if write_parquet:
+        os.replace(parquet_file + ".tmp", parquet_file)
+
+def read_estimated_taxonomy(outfile):
+    """
+    Read the estimated taxonomy of one sample, from its Parquet copy when there is one (and
+    pyarrow is installed), and from the TSV otherwise.
+    """
+    tsv_file, parquet_file = estimated_taxonomy_files(outfile)
+    if (pyarrow is not None) & os.path.isfile(parquet_file):
+        return pd.read_parquet(parquet_file)
+    with open_compressed(tsv_file) as tsv:
+        return pd.read_csv(tsv, sep = "\t", index_col=0)
+
+class ReferenceContext:
+    """
+    The reference database pieces used to estimate taxonomy, shared by every sample in a run.
+    Each piece is read the first time a stage asks for it and kept for the rest of the run.
+    """
+    
+    def __init__(self, tax_file, prot_map_file):
+        self.tax_file = tax_file
+        self.prot_map_file = prot_map_file
+        self._pieces = {}
+        self._lock = threading.RLock()
+        
+    def _load(self, key, loader):
+        with self._lock:
+            if key not in self._pieces:
+                self._pieces[key] = loader()
+            return self._pieces[key]
+        
+    def taxonomy(self):
+        return self._load("taxonomy", lambda: read_in_taxonomy(self.tax_file))
+    
+    def lineages(self):
+        return self._load("lineages", lambda: gen_lineage_codes(self.taxonomy()))
+    
+    def protein_map(self):
+        return self._load("protein_map", lambda: read_in_protein_map(self.prot_map_file))
+    
+    def tax_cutoffs(self, cutoff_file):
+        cutoff_path = cutoff_file_path(cutoff_file)
+        return self._load(("tax_cutoffs", cutoff_file), lambda: read_in_tax_cutoffs(cutoff_path))
+
+def cutoff_file_path(cutoff_file):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), "static", cutoff_file)
+
 def place_taxonomy(tax_file,cutoff_file,consensus_cutoff,prot_map_file,
-                   use_counts,names_to_reads,diamond_file,outfile,rerun):
-    if (os.path.isfile(outfile)) & (not rerun):
-        print("Taxonomic placement already complete at", outfile + "; will not re-run step.")
-        return pd.read_csv(outfile, sep = "\t")
-    
-    tax_table = read_in_taxonomy(tax_file)
-    tax_cutoffs = read_in_tax_cutoffs(os.path.join(os.path.dirname(os.path.realpath(__file__)), "static", cutoff_file))
-    pdict = read_in_protein_map(prot_map_file)
-    tax_dict = gen_dict(tax_table)
+                   use_counts,names_to_reads,diamond_file,outfile,rerun,mem_budget_gb=2,n_workers=1,
+                   reference=None,log=None,output_format="tsv",compression="none"):
+    if estimated_taxonomy_exists(outfile, output_format) & (not rerun):
+        print("Taxonomic placement already complete at", outfile + "; will not re-run step.", file = log)
+        return read_estimated_taxonomy(outfile)
+    
+    if reference is None:
+        reference = ReferenceContext(tax_file, prot_map_file)
+    tax_cutoffs = reference.tax_cutoffs(cutoff_file)
+    pdict = reference.protein_map()
+    lineages = reference.lineages()
     consensus_cutoff = float(consensus_cutoff)
+    stats = collections.Counter()
     if (int(use_counts) == 1):
         reads_dict = gen_reads_dict(names_to_reads)
-        classification_df = classify_taxonomy_parallel(diamond_file, tax_dict, reads_dict, 
-                                                       pdict, consensus_cutoff, tax_cutoffs)
+        results = classify_taxonomy_parallel(diamond_file, lineages, reads_dict, 
+                                             pdict, consensus_cutoff, tax_cutoffs,
+                                             mem_budget_gb = mem_budget_gb, n_workers = n_workers,
+                                             stats = stats)
     else:
-        classification_df = classify_taxonomy_parallel(diamond_file, tax_dict, 0, pdict, 
-                                                       consensus_cutoff, tax_cutoffs)
-    classification_df.to_csv(outfile, sep='\t')
+        results = classify_taxonomy_parallel(diamond_file, lineages, None, pdict, 
+                                             consensus_cutoff, tax_cutoffs,
+                                             mem_budget_gb = mem_budget_gb, n_workers = n_workers,
+                                             stats = stats)
+    write_estimated_taxonomy(results, outfile, output_format, compression)
+    print("Alignment rows read: " + str(stats['rows_in']) + "; best hits kept for classification: " + 
+          str(stats['rows_kept']) + " (" + str(round(100 * stats['rows_kept'] / max(1, stats['rows_in']), 1)) + 
+          "%).", file = log)
+    print("Best-hit sets classified: " + str(stats['cache_misses']) + "; reused from the cache: " + 
+          str(stats['cache_hits']) + " (" + 
+          str(round(100 * stats['cache_hits'] / max(1, stats['cache_hits'] + stats['cache_misses']), 1)) + 
+          "% hit rate).", file = log)
+    print("Taxonomic placement written to", compressed_name(outfile, compression) + ".", file = log)
     return outfile
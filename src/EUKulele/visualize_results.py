@@ -8,6 +8,9 @@ import sys
 import yaml
 import argparse
 
+from EUKulele.tax_placement import estimated_taxonomy_files, read_estimated_taxonomy
+from EUKulele.compression import strip_compression, compressed_name, open_compressed
+
 #.loc[[name == curr for name in final_frame.loc[name_level]],["Sum"]] 
 
 def countClassifs(level, level_hierarchy, name_level, df):
@@ -162,7 +165,7 @@ def makeConcatFrame(curr_df, new_df, level, sample_name, use_counts):
     return pd.concat([curr_df, new_df], sort=True)
 
 def visualize_all_results(out_prefix, out_dir, est_dir, samples_dir, prot_extension, nucle_extension, use_counts, 
-                          rerun, core = False):
+                          rerun, core = False, compression = "none"):
     results_frame = dict()
     results_counts_dir = os.path.join(out_dir, "taxonomy_counts")
     results_viz_dir = os.path.join(out_dir, "taxonomy_visualization")
@@ -174,14 +177,15 @@ def visualize_all_results(out_prefix, out_dir, est_dir, samples_dir, prot_extens
     samples = os.listdir(samples_dir)
     good_samples = 0
     for s in samples:
+        s = strip_compression(s)
         file_name = ".".join(s.split(".")[0:-1]) + "-estimated-taxonomy.out"
         if (prot_extension in s.split(".")[-1]) | (nucle_extension in s.split(".")[-1]):
-            if (not os.path.isfile(os.path.join(est_dir, file_name))):
+            if not any([os.path.isfile(curr) for curr in estimated_taxonomy_files(os.path.join(est_dir, file_name))]):
                 print("One of the files, " + s + ", in the sample directory did not complete successfully.")
                 if (not core):
                     sys.exit(1)
             else:
-                results_frame[file_name] = pd.read_csv(os.path.join(est_dir, file_name), sep = "\t", index_col=0)
+                results_frame[file_name] = read_estimated_taxonomy(os.path.join(est_dir, file_name))
         good_samples = good_samples + 1
             
     if (good_samples == 0) & (not core):
@@ -211,9 +215,11 @@ def visualize_all_results(out_prefix, out_dir, est_dir, samples_dir, prot_extens
         ### SAVE THE CSVs OF THE DATA ###
         prefix = out_prefix
         os.system("mkdir -p " + results_counts_dir)
-        counts_all[l].to_csv(os.path.join(results_counts_dir, prefix + "_all_" + l + "_counts.csv"))
+        counts_file = compressed_name(os.path.join(results_counts_dir, prefix + "_all_" + l + "_counts.csv"), compression)
+        with open_compressed(counts_file, "wt") as counts_csv:
+            counts_all[l].to_csv(counts_csv)
         
-        if (not os.path.isfile(os.path.join(results_counts_dir, prefix + "_all_" + l + "_counts.csv"))):
+        if (not os.path.isfile(counts_file)):
             print("Taxonomy counts were not successfully generated. Check log for details.")
             sys.exit(1)
 
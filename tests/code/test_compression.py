@@ -0,0 +1,40 @@
+import pytest
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele.compression import compression_of, compressed_name, find_compressed, open_compressed
+from EUKulele.compression import decompressed_copy, decompressed_input, compress_file
+
+def test_compressed_names():
+    assert compression_of("sample.faa.gz") == "gzip"
+    assert compression_of("sample.faa") is None
+    assert compressed_name("sample.faa.gz", "zstd") == "sample.faa.zst"
+    assert compressed_name("sample.faa.gz", "none") == "sample.faa"
+
+def test_compressed_round_trip(tmp_path):
+    plain = tmp_path / "sample.faa"
+    plain.write_text(">a\nMK\n")
+    compressed = compress_file(str(plain), "gzip")
+    assert (compressed == str(plain) + ".gz") & (not plain.is_file())
+    assert find_compressed(str(plain)) == compressed
+    with open_compressed(compressed, "rt") as infile:
+        assert infile.read() == ">a\nMK\n"
+    copy = decompressed_copy(compressed, str(tmp_path / "scratch"))
+    assert open(copy).read() == ">a\nMK\n"
+
+def test_decompressed_input(tmp_path):
+    with open_compressed(str(tmp_path / "sample.faa.gz"), "wt") as outfile:
+        outfile.write(">a\nMK\n")
+    scratch = str(tmp_path / "scratch")
+    with decompressed_input(str(tmp_path / "sample.faa.gz"), scratch) as plain:
+        assert open(plain).read() == ">a\nMK\n"
+    assert os.listdir(scratch) == []
+    with decompressed_input(str(tmp_path / "sample.faa.gz"), scratch, readable = ["gzip"]) as plain:
+        assert plain == str(tmp_path / "sample.faa.gz")
+
@@ -0,0 +1,44 @@
+import pytest
+import os
+import sys
+import threading
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele.database_cache import build_key, cached_build, link_build, move_build
+
+def test_database_cache(tmp_path):
+    reference = tmp_path / "reference.pep.fa"
+    reference.write_text(">a\nMK\n")
+    builds = []
+    def build(build_dir):
+        builds.append(build_dir)
+        (tmp_path / build_dir / "database.dmnd").write_text("db" + str(len(builds)))
+        return 0
+    name, key = build_key(str(reference), "diamond")
+    threads = [threading.Thread(target = cached_build, args = (str(tmp_path / "cache"), name, key, build)) 
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    build_dir, rc = cached_build(str(tmp_path / "cache"), name, key, build)
+    links = link_build(build_dir, "database", str(tmp_path / "project" / "reference.pep"))
+    assert (rc == 0) & (len(builds) == 1)
+    assert [open(link).read() for link in links] == ["db1"]
+    old_build = os.path.realpath(build_dir)
+    with open(links[0]) as reader:
+        build_dir, rc = cached_build(str(tmp_path / "cache"), name, key, build, rebuild = True)
+        assert (rc == 0) & (len(builds) == 2) & (reader.read() == "db1")
+    assert os.path.realpath(build_dir) != old_build
+    assert open(os.path.join(old_build, "database.dmnd")).read() == "db1"
+    assert [open(link).read() for link in links] == ["db2"]
+    moved = move_build(build_dir, "database", str(tmp_path / "project" / "reference.pep"))
+    assert (moved == links) & (not os.path.islink(moved[0])) & (open(moved[0]).read() == "db2")
+    reference.write_text(">a\nMKL\n")
+    assert build_key(str(reference), "diamond")[0] != name
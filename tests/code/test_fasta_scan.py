@@ -0,0 +1,23 @@
+import pytest
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele.compression import open_compressed
+from EUKulele.fasta_scan import scan_fastas
+
+def test_scan_fastas(tmp_path):
+    with open_compressed(str(tmp_path / "sample.faa.gz"), "wt") as outfile:
+        outfile.write(">a desc\nMKLV\nAG\n>\nMK\n>c\nMKL\n")
+    (tmp_path / "sample.fasta").write_text("ACGT\n>a\nACGTNACGTA\n")
+    cache_file = str(tmp_path / "fasta_scan.json")
+    peptides, nucleotides = scan_fastas([str(tmp_path / "sample.faa"), str(tmp_path / "sample.fasta")], cache_file, 2)
+    assert peptides == {"sequence_type": "protein", "records": 3, "residues": 11, "longest": 6,
+                        "malformed_headers": 1, "malformed_lines": [4]}
+    assert (nucleotides["sequence_type"] == "nucleotide") & (nucleotides["malformed_lines"] == [1])
+    assert scan_fastas([str(tmp_path / "sample.fasta")], cache_file) == [nucleotides]
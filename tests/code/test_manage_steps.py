@@ -0,0 +1,43 @@
+import pytest
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele import resources
+from EUKulele.manage_steps import diamondSettings, batchSamples, splitFasta, shardCount, runToCompressedFile
+
+def test_diamond_settings():
+    assert diamondSettings(4, 100, 5 * 10**6) == (4, 0.4, 1, 7.2)
+    assert diamondSettings(16, 256, 5 * 10**9) == (16, 5.0, 1, 90.0)
+    assert diamondSettings(16, 64, 5 * 10**9)[1:3] == (5.0, 2)
+    threads, block_size, index_chunks, mem_gb = diamondSettings(16, 16, 5 * 10**9)
+    assert (block_size, index_chunks) == (2.6, 4)
+    assert mem_gb <= 16
+
+def test_batch_samples():
+    assert batchSamples([5, 5, 20, 1, 1, 1], 10) == [[0, 1], [2], [3, 4, 5]]
+    assert batchSamples([1, 1, 1], 10, max_samples = 2) == [[0, 1], [2]]
+    assert batchSamples([], 10) == []
+
+def test_split_fasta(tmp_path):
+    fasta = tmp_path / "sample.faa"
+    fasta.write_text(">a\nMK\nLV\n>b\nMK\n>c\nMK\n>d\nMK\n>e\nMK")
+    shards = splitFasta(str(fasta), 5, 2, str(tmp_path / "sample"))
+    assert [open(shard).read() for shard in shards] == [">a\nMK\nLV\n>b\nMK\n>c\nMK\n", ">d\nMK\n>e\nMK\n"]
+    shards = splitFasta(str(fasta), 3, 2, str(tmp_path / "stale"))
+    assert [open(shard).read().count(">") for shard in shards] == [2, 3]
+    pool = resources.ResourcePool(16, 1000)
+    assert shardCount(20 * 10**6, 4 * 10**9, pool) == 4
+    assert shardCount(1000, 10**6, pool) == 1
+
+def test_run_to_compressed_file(tmp_path):
+    outfile = str(tmp_path / "sample.out.gz")
+    assert runToCompressedFile(["sh", "-c", "echo q1; echo q2"], outfile, None) == 0
+    assert os.path.isfile(outfile)
+    assert runToCompressedFile(["sh", "-c", "echo q1; exit 3"], outfile, None) == 3
+    assert not os.path.isfile(outfile)
@@ -0,0 +1,25 @@
+import pytest
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele.manifest import step_is_current, record_step
+
+def test_step_manifest(tmp_path):
+    sample = tmp_path / "sample.faa"
+    sample.write_text(">a\nMK\n")
+    output = tmp_path / "sample.diamond.out"
+    assert not step_is_current(str(output), "alignment", [str(sample)], {"filter_metric": "evalue"})
+    output.write_text("a\tS1\n")
+    record_step(str(output), "alignment", [str(sample)], {"filter_metric": "evalue"})
+    assert step_is_current(str(output), "alignment", [str(sample)], {"filter_metric": "evalue"})
+    assert not step_is_current(str(output), "alignment", [str(sample)], {"filter_metric": "pid"})
+    sample.write_text(">a\nMK\n")
+    assert step_is_current(str(output), "alignment", [str(sample)], {"filter_metric": "evalue"})
+    sample.write_text(">a\nMKL\n")
+    assert not step_is_current(str(output), "alignment", [str(sample)], {"filter_metric": "evalue"})
@@ -0,0 +1,57 @@
+import pytest
+import os
+import sys
+import time
+import threading
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele import resources
+
+def test_cgroup_limits(tmp_path, monkeypatch):
+    (tmp_path / "cgroup").write_text("0::/job\n")
+    (tmp_path / "meminfo").write_text("MemTotal: 8388608 kB\nMemAvailable: 4194304 kB\n")
+    (tmp_path / "fs" / "job").mkdir(parents = True)
+    (tmp_path / "fs" / "job" / "memory.max").write_text(str(3 * 1024 ** 3))
+    (tmp_path / "fs" / "job" / "memory.current").write_text(str(2 * 1024 ** 3))
+    (tmp_path / "fs" / "job" / "memory.stat").write_text("anon 1\ninactive_file " + str(1024 ** 3) + "\n")
+    (tmp_path / "fs" / "job" / "cpu.max").write_text("150000 100000")
+    monkeypatch.setattr(resources, "PROC_CGROUP_FILE", str(tmp_path / "cgroup"))
+    monkeypatch.setattr(resources, "MEMINFO_FILE", str(tmp_path / "meminfo"))
+    monkeypatch.setattr(resources, "CGROUP_ROOT", str(tmp_path / "fs"))
+    monkeypatch.setattr(resources, "POOL", None)
+    resources.cgroup_paths.cache_clear()
+
+    assert resources.memory_available_gb() == 2
+    assert resources.cgroup_cpu_limit() == 2
+    assert resources.configure_pool(4, perc_mem = 1).slots(8, resources.job_memory_gb("alignment", 1024 ** 3 / 10)) == 2
+    (tmp_path / "fs" / "job" / "memory.max").write_text("max")
+    assert resources.memory_available_gb() == 4
+    resources.cgroup_paths.cache_clear()
+
+def test_resource_pool():
+    pool = resources.ResourcePool(4, 10)
+    assert pool.slots(10) == 4
+    assert pool.slots(10, 4) == 2
+    assert pool.share(2) == (2, 5)
+
+    running = []
+    peak = []
+    def job(cpus, mem_gb):
+        with pool.reserve(cpus, mem_gb) as held:
+            running.append(held)
+            peak.append(sum(running))
+            time.sleep(0.01)
+            running.remove(held)
+    threads = [threading.Thread(target = job, args = (2, 4)) for _ in range(6)] + \
+              [threading.Thread(target = job, args = (16, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 4
+    assert (pool.free_cpus, pool.free_mem_gb) == (4, 10)
@@ -0,0 +1,181 @@
+import pytest
+import collections
+import io
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(1, '..')
+sys.path.insert(1, '../src/EUKulele')
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import EUKulele
+from EUKulele.tax_placement import classify_hits, gen_lineage_codes, ReferenceContext, read_in_taxonomy
+from EUKulele.tax_placement import write_estimated_taxonomy, read_estimated_taxonomy, query_counts
+from EUKulele.tax_placement import alignment_chunks, classify_taxonomy_parallel, read_in_protein_map
+from EUKulele.tax_placement import is_memory_mapped, map_protein_ids
+from scripts.create_protein_table import write_protein_index
+from EUKulele.compression import open_compressed
+
+import pandas as pd
+
+tax_cutoffs = {'species': 95, 'genus': 80, 'family': 65, 'order': 50, 'class': 30}
+tax_table = pd.DataFrame([["S1", "Alveolata", "Apicomplexa", "Colpodellidea", "Colpodellida", "Chromeraceae", 
+                           "Chromera", "Chromera velia"],
+                          ["S2", "Alveolata", "Apicomplexa", "Colpodellidea", "Colpodellida", "Chromeraceae", 
+                           "Chromera", "Chromera velia"],
+                          ["S3", "Alveolata", "Apicomplexa", "Colpodellidea", "Vitrelladida", "Vitrellaceae", 
+                           "Vitrella", "Vitrella brassicaformis"],
+                          ["S4", "Alveolata", "Dinoflagellata", "Dinophyceae", "Suessiales", "Symbiodiniaceae", 
+                           "Symbiodinium", "Symbiodinium sp."]],
+                         columns = ['source_id','supergroup','division','class','order','family','genus','species'])
+lineages = gen_lineage_codes(tax_table.set_index('source_id'))
+
+def make_hits(rows):
+    hits = pd.DataFrame(rows, columns = ['qseqid', 'ssqid_TAXID', 'pident'])
+    hits['counts'] = 0
+    return hits
+
+def test_consensus_votes():
+    hits = make_hits([["q1", "S1", 99.0], ["q1", "S2", 99.0], ["q1", "S3", 99.0], ["q1", "S4", 40.0]])
+
+    result = classify_hits(hits, lineages, 0.6, tax_cutoffs, 0).set_index("transcript_name")
+    assert result.loc["q1", "classification"] == "Chromera velia"
+    assert result.loc["q1", "classification_level"] == "species"
+    assert result.loc["q1", "ambiguous"] == 1
+
+def test_lca_fallback():
+    hits = make_hits([["q1", "S1", 99.0], ["q1", "S3", 99.0], ["q2", "S4", 85.0], ["q3", "S9", 99.0]])
+
+    result = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0).set_index("transcript_name")
+    assert result.loc["q1", "classification"] == "Colpodellidea"
+    assert result.loc["q1", "classification_level"] == "class"
+    assert result.loc["q1", "full_classification"] == "Alveolata; Apicomplexa; Colpodellidea"
+    assert result.loc["q2", "classification"] == "Symbiodinium"
+    assert result.loc["q2", "ambiguous"] == 0
+    assert "q3" not in result.index
+
+def test_reference_context_reads_once(tmp_path):
+    tax_file = tmp_path / "tax-table.txt"
+    tax_table.to_csv(tax_file, sep = "\t", index = False)
+    reference = ReferenceContext(str(tax_file), str(tmp_path / "prot-map.json"))
+
+    assert reference.lineages() is reference.lineages()
+    assert reference.taxonomy() is reference.taxonomy()
+    assert reference.tax_cutoffs("tax-cutoffs.yaml")["species"] == 95
+
+def test_taxonomy_cache(tmp_path):
+    tax_file = tmp_path / "tax-table.txt"
+    tax_table.to_csv(tax_file, sep = "\t", index = False)
+
+    first = read_in_taxonomy(str(tax_file))
+    assert (tmp_path / "tax-table.txt.cache.pkl").is_file()
+    assert first.equals(read_in_taxonomy(str(tax_file)))
+
+    tax_table.iloc[:2].to_csv(tax_file, sep = "\t", index = False)
+    assert len(read_in_taxonomy(str(tax_file)).index) == 2
+
+def test_parquet_output(tmp_path):
+    pytest.importorskip("pyarrow")
+    hits = make_hits([["q1", "S1", 99.0], ["q1", "S3", 99.0], ["q2", "S4", 85.0], ["q3", "S1", 10.0]])
+    result = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0)
+    outfile = str(tmp_path / "sample-estimated-taxonomy.out")
+
+    write_estimated_taxonomy([result.iloc[:2], result.iloc[2:]], outfile, "both")
+    columnar = read_estimated_taxonomy(outfile).set_index("transcript_name")
+    assert columnar.full_classification.dtype == "category"
+    assert columnar.loc["q1", "class"] == "Colpodellidea"
+    assert pd.isnull(columnar.loc["q1", "order"])
+    assert columnar.loc["q2", "classification"] == "Symbiodinium"
+
+    write_estimated_taxonomy([result], outfile, "tsv")
+    assert not (tmp_path / "sample-estimated-taxonomy.parquet").is_file()
+
+def test_parquet_unclassified_chunk(tmp_path):
+    pytest.importorskip("pyarrow")
+    hits = make_hits([["q1", "S1", 99.0], ["q3", "S1", 10.0]])
+    result = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0).set_index("transcript_name", drop = False)
+    ## A query without a common ancestor, such as the last query of a file on its own ##
+    result.loc["q3", ["classification_level", "full_classification", "classification"]] = ""
+    outfile = str(tmp_path / "sample-estimated-taxonomy.out")
+    write_estimated_taxonomy([result.loc[["q1"]], result.loc[["q3"]]], outfile, "parquet")
+    write_estimated_taxonomy([result.loc[["q3"]]], outfile, "parquet")
+    columnar = read_estimated_taxonomy(outfile)
+    assert (len(columnar) == 1) & pd.isnull(columnar["species"].iloc[0])
+    assert sorted(curr.name for curr in tmp_path.iterdir()) == ["sample-estimated-taxonomy.parquet"]
+
+def test_query_counts():
+    namestoreads = pd.Series([5, 7], index = ["TRINITY_1", "TRINITY_2"])
+    qseqid = pd.Series(["TRINITY_1.p1", "TRINITY_1.p1", "TRINITY_2:1-300", "TRINITY_3.p2"])
+
+    assert list(query_counts(qseqid, namestoreads)) == [5, 5, 7, 0]
+
+def test_classification_cache():
+    hits = make_hits([["q1", "S1", 99.0], ["q1", "S3", 99.0], ["q2", "S3", 99.0], ["q2", "S1", 99.0],
+                      ["q3", "S3", 85.0], ["q3", "S1", 85.0]])
+    cache = collections.OrderedDict()
+    stats = {}
+
+    first = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0, cache = cache, stats = stats)
+    assert stats == {'cache_hits': 0, 'cache_misses': 2}
+    assert first.loc[0, "full_classification"] == first.loc[1, "full_classification"]
+    second = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0, cache = cache, stats = stats)
+    assert stats == {'cache_hits': 2, 'cache_misses': 2}
+    assert first.equals(second)
+
+def test_stream_alignment_chunks():
+    hits = io.StringIO("q1\tS1\t99.0\nq1\tS3\t98.0\nq2\tS4\t85.0\n")
+    chunks = list(alignment_chunks(hits))
+    assert sum(len(chunk.index) for chunk in chunks) == 3
+    assert list(alignment_chunks(io.StringIO(""))) == []
+
+def test_reduced_alignment_columns():
+    full = "q1\tS1\t99.0\t100\t1\t0\t1\t100\t1\t100\t1e-10\t200\nq2\tS4\t85.5\t100\t1\t0\t1\t100\t1\t100\t1e-8\t150\n"
+    reduced = "q1\tS1\t99.0\nq2\tS4\t85.5\n"
+    full_chunk = pd.concat(alignment_chunks(io.StringIO(full)))
+    reduced_chunk = pd.concat(alignment_chunks(io.StringIO(reduced)))
+    assert reduced_chunk.equals(full_chunk)
+    assert list(reduced_chunk.columns) == [0, 1, 2]
+    assert reduced_chunk[1].dtype == "category"
+    assert reduced_chunk[2].dtype == "float32"
+
+def test_pool_classification(tmp_path, capsys):
+    pmap = {"P" + str(t): "S" + str(t % 4 + 1) for t in range(8)}
+    write_protein_index(pmap, str(tmp_path / "prot-map.json"))
+    protein_index = read_in_protein_map(str(tmp_path / "prot-map.json"))
+    assert is_memory_mapped(protein_index) & (not is_memory_mapped(pmap))
+    alignment = tmp_path / "sample.diamond.out"
+    alignment.write_text("".join(["q" + str(q) + "\tP" + str((q + t) % 8) + "\t" + str(90 + t) + "\n" 
+                                  for q in range(500) for t in range(3)]))
+    serial = pd.concat(classify_taxonomy_parallel(str(alignment), lineages, None, protein_index, 0.75, tax_cutoffs))
+    pooled = pd.concat(classify_taxonomy_parallel(str(alignment), lineages, None, protein_index, 0.75, tax_cutoffs,
+                                                  n_workers = 2))
+    assert pooled.reset_index(drop = True).equals(serial.reset_index(drop = True))
+    in_process = pd.concat(classify_taxonomy_parallel(str(alignment), lineages, None, pmap, 0.75, tax_cutoffs,
+                                                      n_workers = 2))
+    assert in_process.reset_index(drop = True).equals(serial.reset_index(drop = True))
+    assert "single process" in capsys.readouterr().out
+
+def test_map_protein_ids(tmp_path):
+    write_protein_index({"P1": "S1", "P2": "S2"}, str(tmp_path / "prot-map.json"))
+    protein_index = read_in_protein_map(str(tmp_path / "prot-map.json"))
+    mapped = map_protein_ids(pd.Series(["P2", "P3", "P1"]), protein_index)
+    assert list(mapped[[0, 2]]) == ["S2", "S1"]
+    assert mapped.isna().tolist() == [False, True, False]
+    write_protein_index(dict(), str(tmp_path / "empty-map.json"))
+    empty_index = read_in_protein_map(str(tmp_path / "empty-map.json"))
+    assert map_protein_ids(pd.Series(["P1", "P2"]), empty_index).isna().all()
+
+def test_compressed_output(tmp_path):
+    hits = make_hits([["q1", "S1", 99.0], ["q2", "S4", 85.0]])
+    result = classify_hits(hits, lineages, 0.75, tax_cutoffs, 0)
+    outfile = str(tmp_path / "sample-estimated-taxonomy.out")
+
+    write_estimated_taxonomy([result], outfile, "tsv")
+    write_estimated_taxonomy([result], outfile, "tsv", compression = "gzip")
+    assert not (tmp_path / "sample-estimated-taxonomy.out").is_file()
+    assert read_estimated_taxonomy(outfile).set_index("transcript_name").loc["q2", "classification"] == "Symbiodinium"
+
+    with open_compressed(str(tmp_path / "hits.out.gz"), "wt") as alignment:
+        alignment.write("q1\tS1\t99.0\nq2\tS4\t85.0\n")
+    assert sum(len(chunk.index) for chunk in alignment_chunks(str(tmp_path / "hits.out.gz"))) == 2